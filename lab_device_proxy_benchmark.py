@@ -0,0 +1,819 @@
+#!/usr/bin/env python2.7
+# PLEASE LEAVE THE SHEBANG: the proxy benchmark runs as a standalone Python file.
+
+# Google BSD license http://code.google.com/google_bsd_license.html
+# Copyright 2014 Google Inc. wrightt@google.com
+
+"""Lab Device Proxy Benchmarks.
+
+Starts a local proxy server with fake "adb" and "idevice*" commands in its
+$PATH and $IDEVICE_PATH, then measures the proxy's overhead with in-process
+clients, e.g.:
+  ./lab_device_proxy_benchmark.py keepalive
+
+To compare a change against its parent commit, save each run's results as
+JSON, then pass the parent's results as the baseline:
+  git checkout HEAD^ && ./lab_device_proxy_benchmark.py --json base.json
+  git checkout - && ./lab_device_proxy_benchmark.py --baseline base.json
+"""
+
+import argparse
+import cStringIO as StringIO
+import datetime
+import httplib
+import json
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# pylint: disable=g-import-not-at-top
+try:
+  from lab_device_proxy import lab_device_proxy_client as lab_common
+except ImportError:
+  import lab_device_proxy_client as lab_common
+
+SERVER_PORT = 9095
+
+# Port of our FakeAdbServer, for the server's --native_adb.
+FAKE_ADB_PORT = 9097
+
+# The iOS device id of our fake idevice* commands.
+FAKE_UDID = '0123456789abcdef0123456789abcdef01234567'
+
+# Fake commands, written to the server's $PATH.  "adb pull /sdcard/bench/X"
+# copies the server's "bench/X", from BenchmarkServer.AddFiles.
+FAKE_COMMANDS = {
+    'adb': """#!/bin/sh
+if [ "$1" = -s ]; then
+  shift 2
+fi
+case "$1" in
+  push) [ -e "$2" ] ;;
+  pull)
+    case "$2" in
+      /sdcard/sparse) dd if=/dev/zero of="$3" bs=1 count=0 seek=%d 2>/dev/null ;;
+      /sdcard/bench/*) cp -R "bench/${2#/sdcard/bench/}" "$3" ;;
+      *) head -c %d /dev/urandom > "$3" ;;
+    esac ;;
+  logcat)
+    # A burst of small writes, one per line.
+    i=0
+    while [ $i -lt "$3" ]; do
+      echo "I/Bench   ( 1234): line $i of a logcat burst"
+      i=$((i + 1))
+    done ;;
+  shell)
+    case "$2" in
+      tick)
+        # One timestamp line every 10ms, for latency measurements.
+        exec python -u -c "import time
+for _ in range($3):
+  print '%%.6f' %% time.time()
+  time.sleep(0.01)" ;;
+      *) shift; echo "shell $*" ;;
+    esac ;;
+  *) echo "List of devices attached" ;;
+esac
+""" % (2 << 30, 64 << 20),
+    'idevice_id': """#!/bin/sh
+echo %s
+""" % FAKE_UDID,
+    'ideviceinfo': """#!/bin/sh
+echo "ProductVersion: 9.3.2"
+""",
+}
+
+# Commands whose round-trip latency we measure, by name.
+LATENCY_COMMANDS = (
+    ('adb_devices', ['adb', 'devices']),
+    ('adb_shell', ['adb', '-s', 'serial0', 'shell', 'echo', 'hi']),
+    ('idevice_id', ['idevice_id', '-l']),
+    ('ideviceinfo', ['ideviceinfo', '-u', FAKE_UDID, '-k', 'ProductVersion']),
+)
+
+# Files and directories that we push and pull, by name, as lists of (relative
+# path, size) tuples.  A path of '' is a single file.
+TRANSFER_SHAPES = (
+    ('file_4k', [('', 4 << 10)]),
+    ('file_1m', [('', 1 << 20)]),
+    ('file_16m', [('', 16 << 20)]),
+    ('dir_1000x1k', [('d%d/f%d' % (i % 10, i), 1 << 10) for i in range(1000)]),
+    ('dir_4x4m', [('f%d' % i, 4 << 20) for i in range(4)]),
+    ('dir_deep', [('/'.join(['d'] * depth + ['f']), 16 << 10)
+                  for depth in range(1, 33)]),
+)
+
+# Numbers of concurrent clients, for BenchmarkScaling.
+SCALING_CLIENTS = (1, 4, 16, 64, 256)
+
+
+def main(args):
+  """Runs the named benchmarks and prints their results.
+
+  Args:
+    args: List of strings, e.g. ['./lab_device_proxy_benchmark.py', '-n',
+        '500', 'keepalive'].
+  """
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('-p', '--port', default=SERVER_PORT, type=int,
+                         help='Port for the local proxy server.')
+  argparser.add_argument('-n', '--count', default=1000, type=int,
+                         help='Number of commands per measurement.')
+  argparser.add_argument('--json',
+                         help='File to write the results to, as JSON.')
+  argparser.add_argument('--baseline',
+                         help='JSON results file, e.g. from a parent commit, '
+                         'to compare the results with.')
+  argparser.add_argument('benchmarks', nargs='*',
+                         help='Benchmarks to run, defaults to all of: %s' %
+                         ', '.join(sorted(BENCHMARKS)))
+  parsed_args = argparser.parse_args(args[1:])
+  parsed_args.benchmarks = (parsed_args.benchmarks or sorted(BENCHMARKS))
+  for name in parsed_args.benchmarks:
+    if name not in BENCHMARKS:
+      argparser.error('Unknown benchmark: %s' % name)
+
+  baseline = {}
+  if parsed_args.baseline:
+    with open(parsed_args.baseline) as f:
+      baseline = json.load(f)['results']
+
+  all_results = {}
+  for name in parsed_args.benchmarks:
+    benchmark, server_args = BENCHMARKS[name]
+    if server_args is None:
+      results = benchmark(None, parsed_args)
+    else:
+      with BenchmarkServer(parsed_args.port, server_args) as server:
+        results = benchmark(server, parsed_args)
+    for key, value in results:
+      full_key = '%s.%s' % (name, key)
+      all_results[full_key] = float(value)
+      print '%s: %s%s' % (full_key, value,
+                          FormatChange(float(value), baseline.get(full_key)))
+
+  if parsed_args.json:
+    with open(parsed_args.json, 'w') as f:
+      json.dump({
+          'time': datetime.datetime.utcnow().isoformat() + 'Z',
+          'commit': GetCommit(),
+          'python': sys.version.split()[0],
+          'count': parsed_args.count,
+          'results': all_results,
+      }, f, indent=2, sort_keys=True)
+      f.write('\n')
+
+
+def FormatChange(value, baseline_value):
+  """Formats a result's change from its baseline, e.g. ' (+5.0% vs 10.2)'.
+
+  Args:
+    value: float result.
+    baseline_value: float baseline result, or None.
+  Returns:
+    The string change, or '' if there's no baseline.
+  """
+  if baseline_value is None:
+    return ''
+  if not baseline_value:
+    return ' (vs %s)' % baseline_value
+  return ' (%+.1f%% vs %s)' % (
+      100.0 * (value - baseline_value) / baseline_value, baseline_value)
+
+
+def GetCommit():
+  """Returns the git commit of our source tree, or None if it's unknown."""
+  try:
+    with open(os.devnull, 'w') as devnull:
+      return subprocess.check_output(
+          ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+          cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def GetPercentiles(latencies, prefix='latency'):
+  """Returns the p50 and p99 of a list of latencies.
+
+  Args:
+    latencies: List of float seconds.
+    prefix: string result key prefix.
+  Returns:
+    List of (key, value) results, in milliseconds.
+  """
+  latencies = sorted(latencies)
+  return [('%s_p%d_ms' % (prefix, percentile), '%.2f' % (
+      1000 * latencies[(len(latencies) - 1) * percentile // 100]))
+          for percentile in (50, 99)]
+
+
+class BenchmarkServer(object):
+  """A local proxy server that runs our fake commands."""
+
+  def __init__(self, port, server_args=None, fake_commands=None):
+    """Creates the server, which __enter__ starts.
+
+    Args:
+      port: int server port.
+      server_args: optional List of extra server args.
+      fake_commands: optional dict of command names to script contents,
+          defaults to FAKE_COMMANDS.
+    """
+    self.port = port
+    self.url = 'http://localhost:%s' % port
+    self._server_args = (server_args if server_args is not None else [])
+    self._fake_commands = (fake_commands if fake_commands is not None else
+                           FAKE_COMMANDS)
+    self._server_proc = None
+    self._server_temp = None
+
+  def __enter__(self):
+    """Starts the server and waits until it's up."""
+    self._server_temp = tempfile.mkdtemp(prefix='bench_server', dir='/tmp')
+    for cmd, content in self._fake_commands.iteritems():
+      fn = os.path.join(self._server_temp, cmd)
+      with open(fn, 'w') as f:
+        f.write(content)
+      os.chmod(fn, 0755)
+
+    server_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'lab_device_proxy_server.py')
+    python_path = os.path.dirname(os.path.abspath(sys.executable))
+    server_env = {'PATH': ':'.join([self._server_temp, python_path, '/bin',
+                                    '/usr/bin']),
+                  'IDEVICE_PATH': self._server_temp}
+    self._server_proc = subprocess.Popen(
+        [sys.executable, server_path, '--port=%s' % self.port,
+         '--cache_mb=0'] + self._server_args,
+        close_fds=True,
+        cwd=self._server_temp,
+        stderr=open(os.devnull, 'w'),  # hide log_message output
+        env=server_env)
+
+    timeout_time = time.time() + 5  # Arbitrary timeout
+    while True:
+      time.sleep(0.2)
+      try:
+        conn = httplib.HTTPConnection('localhost', self.port, timeout=5)
+        conn.request('GET', '/healthz')
+        if conn.getresponse().status == httplib.OK:
+          conn.close()
+          return self
+      except IOError:
+        if time.time() > timeout_time:
+          raise
+
+  def AddFiles(self, name, files):
+    """Writes a file or directory that "adb pull /sdcard/bench/NAME" copies.
+
+    Args:
+      name: string file or directory name.
+      files: List of (relative path, size) tuples, as in TRANSFER_SHAPES.
+    """
+    WriteFiles(os.path.join(self._server_temp, 'bench', name), files)
+
+  def __exit__(self, *unused_exc_info):
+    """Stops the server and cleans up."""
+    if self._server_proc:
+      self._server_proc.kill()
+      self._server_proc.wait()
+      self._server_proc = None
+    if self._server_temp:
+      shutil.rmtree(self._server_temp)
+      self._server_temp = None
+
+  def Call(self, args, connection_pool=None, stdout=None, stderr=None,
+           priority=None):
+    """Runs a command via an in-process client.
+
+    Args:
+      args: List of strings, e.g. ['adb', 'devices'].
+      connection_pool: optional ConnectionPool.
+      stdout: optional file object, defaults to a discarded buffer.
+      stderr: optional file object, defaults to a discarded buffer.
+      priority: optional string, one of lab_common.PRIORITIES.
+    Returns:
+      The exit code.
+    """
+    client = lab_common.LabDeviceProxyClient(
+        self.url,
+        stdout if stdout is not None else StringIO.StringIO(),
+        stderr if stderr is not None else StringIO.StringIO(),
+        connection_pool, priority)
+    return client.Call(*lab_common.PARSER.parse_args(args))
+
+
+def BenchmarkKeepAlive(server, parsed_args):
+  """Measures commands per second with and without connection reuse.
+
+  Args:
+    server: BenchmarkServer.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  """
+  ret = []
+  for name, max_idle in (('new_connection', 0), ('keepalive', 8)):
+    pool = lab_common.ConnectionPool(max_idle=max_idle)
+    start_time = time.time()
+    for _ in range(parsed_args.count):
+      server.Call(['adb', 'devices'], pool)
+    ret.append(('%s_qps' % name,
+                '%.1f' % (parsed_args.count / (time.time() - start_time))))
+    pool.Close()
+  return ret
+
+
+def BenchmarkPriority(server, parsed_args):
+  """Measures "adb devices" latency while bulk pulls are running.
+
+  The server runs at most two commands at once, plus its reserved slots for
+  high priority commands, and four clients keep it busy with 64MB pulls.  We
+  compare the "devices" latency with no load, at its default high priority,
+  and when it's forced to bulk priority.
+
+  Args:
+    server: BenchmarkServer.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  """
+  count = max(1, parsed_args.count // 5)
+  temp_dn = tempfile.mkdtemp(prefix='bench_client', dir='/tmp')
+  is_done = threading.Event()
+
+  def Pull(index):
+    to_fn = os.path.join(temp_dn, 'pull%d' % index)
+    while not is_done.is_set():
+      server.Call(['adb', 'pull', '/sdcard/bulk', to_fn],
+                  lab_common.ConnectionPool())
+
+  ret = []
+  threads = []
+  try:
+    for name, priority in (('idle', None), ('high', None), ('bulk', 'bulk')):
+      if name != 'idle' and not threads:
+        threads = [threading.Thread(target=Pull, args=(i,)) for i in range(4)]
+        for thread in threads:
+          thread.start()
+        time.sleep(1)  # Let the pulls fill the server's slots
+      latencies = []
+      for _ in range(count):
+        start_time = time.time()
+        server.Call(['adb', 'devices'], priority=priority)
+        latencies.append(time.time() - start_time)
+      latencies.sort()
+      for percentile in (50, 99):
+        ret.append(('%s_p%d_ms' % (name, percentile), '%.1f' % (
+            1000 * latencies[(len(latencies) - 1) * percentile // 100])))
+  finally:
+    is_done.set()
+    for thread in threads:
+      thread.join()
+    shutil.rmtree(temp_dn)
+  return ret
+
+
+def BenchmarkPull(server, parsed_args):
+  """Measures the throughput of a 2GB "adb pull".
+
+  The fake "adb pull" writes a sparse file, so this mostly measures how fast
+  the server copies the file to its socket.  Compare the "pull" and
+  "pull_nosendfile" results to see the sendfile speedup.
+
+  Args:
+    server: BenchmarkServer.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  """
+  count = max(1, parsed_args.count // 200)
+  temp_dn = tempfile.mkdtemp(prefix='bench_client', dir='/tmp')
+  try:
+    start_time = time.time()
+    for index in range(count):
+      to_fn = os.path.join(temp_dn, 'pull%d' % index)
+      server.Call(['adb', 'pull', '/sdcard/sparse', to_fn])
+      os.remove(to_fn)
+    mb_per_second = count * 2048 / (time.time() - start_time)
+  finally:
+    shutil.rmtree(temp_dn)
+  return [('mb_per_second', '%.1f' % mb_per_second)]
+
+
+class LatencyRecorder(object):
+  """A stdout that records the age of each received timestamp line."""
+
+  def __init__(self):
+    self.latencies = []
+    self._partial = ''
+
+  def write(self, data):  # pylint: disable=g-bad-name
+    now = time.time()
+    lines = (self._partial + data).split('\n')
+    self._partial = lines.pop()
+    for line in lines:
+      self.latencies.append(now - float(line))
+
+  def flush(self):  # pylint: disable=invalid-name
+    pass
+
+
+def BenchmarkStream(server, parsed_args):
+  """Measures streamed output throughput and latency.
+
+  The throughput is for a fake "adb logcat" that writes a burst of lines,
+  one write per line, and the latency is the age of periodic timestamp lines
+  when the client receives them.  Compare the "stream" and
+  "stream_nocoalesce" results to see the effect of batching command output.
+
+  Args:
+    server: BenchmarkServer.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  """
+  ret = []
+  num_lines = parsed_args.count * 100
+  stdout = StringIO.StringIO()
+  start_time = time.time()
+  server.Call(['adb', 'logcat', '-t', str(num_lines)], stdout=stdout)
+  duration = time.time() - start_time
+  ret.append(('lines_per_second', '%.1f' % (num_lines / duration)))
+  ret.append(('mb_per_second', '%.1f' % (stdout.tell() / duration / (1 << 20))))
+
+  recorder = LatencyRecorder()
+  server.Call(['adb', 'shell', 'tick', str(max(1, parsed_args.count // 5))],
+              stdout=recorder)
+  latencies = sorted(recorder.latencies)
+  for percentile in (50, 99):
+    ret.append(('latency_p%d_ms' % percentile, '%.1f' % (
+        1000 * latencies[(len(latencies) - 1) * percentile // 100])))
+  return ret
+
+
+class FakeAdbServer(threading.Thread):
+  """A local adb server stand-in, whose one device's shell echoes commands."""
+
+  def __init__(self, port):
+    super(FakeAdbServer, self).__init__()
+    self.daemon = True
+    self._sock = socket.socket()
+    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._sock.bind(('127.0.0.1', port))
+    self._sock.listen(64)
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self._sock.shutdown(socket.SHUT_RDWR)  # Wakes our accept
+    self._sock.close()
+    self.join()
+
+  def run(self):
+    while True:
+      try:
+        conn, _ = self._sock.accept()
+      except socket.error:
+        return  # We've been closed
+      thread = threading.Thread(target=self._Serve, args=(conn,))
+      thread.daemon = True
+      thread.start()
+
+  @staticmethod
+  def _Serve(conn):
+    fp = conn.makefile('rb')
+    try:
+      while True:
+        length = fp.read(4)
+        if not length:
+          return
+        service = fp.read(int(length, 16))
+        if service.endswith(':features'):
+          conn.sendall('OKAY0008shell_v2')
+        elif service.startswith('host:transport'):
+          conn.sendall('OKAY')
+        elif service.startswith('shell,v2:'):
+          conn.sendall('OKAY')
+          fp.read(5)  # Close stdin
+          out = 'shell %s\n' % service.split(':', 1)[1]
+          conn.sendall(struct.pack('<BI', 1, len(out)) + out +
+                       struct.pack('<BIB', 3, 1, 0))
+          return
+        else:
+          conn.sendall('FAIL0000')
+          return
+    finally:
+      fp.close()
+      conn.close()
+
+
+def BenchmarkShell(server, parsed_args):
+  """Measures the round-trip latency of a short "adb shell" command.
+
+  Compare the "shell" and "shell_native" results to see the cost of starting
+  an adb process per command.  The latter's server talks to a FakeAdbServer
+  in our process, so neither result includes a real device's latency.
+
+  Args:
+    server: BenchmarkServer.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  """
+  count = max(1, parsed_args.count // 2)
+  pool = lab_common.ConnectionPool()
+  latencies = []
+  with FakeAdbServer(FAKE_ADB_PORT):
+    for _ in range(count):
+      start_time = time.time()
+      server.Call(['adb', '-s', 'serial0', 'shell', 'getprop',
+                   'ro.build.version.sdk'], pool)
+      latencies.append(time.time() - start_time)
+  pool.Close()
+  latencies.sort()
+  return [('qps', '%.1f' % (count / sum(latencies)))] + [
+      ('latency_p%d_ms' % percentile, '%.2f' % (
+          1000 * latencies[(len(latencies) - 1) * percentile // 100]))
+      for percentile in (50, 99)]
+
+
+def WriteFiles(path, files):
+  """Writes a file or directory of random content.
+
+  Args:
+    path: string file or directory path.
+    files: List of (relative path, size) tuples, as in TRANSFER_SHAPES.
+  """
+  for relative_path, size in files:
+    fn = (os.path.join(path, relative_path) if relative_path else path)
+    if not os.path.isdir(os.path.dirname(fn)):
+      os.makedirs(os.path.dirname(fn))
+    with open(fn, 'wb') as f:
+      f.write(os.urandom(size))
+
+
+def BenchmarkLatency(server, parsed_args):
+  """Measures the round-trip latency of quick adb and idevice* commands.
+
+  The server's result cache is off, so each command runs its fake command.
+
+  Args:
+    server: BenchmarkServer.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  """
+  count = max(1, parsed_args.count // len(LATENCY_COMMANDS))
+  pool = lab_common.ConnectionPool()
+  ret = []
+  for name, args in LATENCY_COMMANDS:
+    latencies = []
+    for _ in range(count):
+      start_time = time.time()
+      server.Call(args, pool)
+      latencies.append(time.time() - start_time)
+    ret += GetPercentiles(latencies, name)
+  pool.Close()
+  return ret
+
+
+def BenchmarkTransfer(server, parsed_args):
+  """Measures push and pull throughput for each of the TRANSFER_SHAPES.
+
+  The fake "adb push" only checks that its input exists, and the fake
+  "adb pull" copies a local file, so this measures the proxy's transfer and
+  tar overhead.
+
+  Args:
+    server: BenchmarkServer.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  """
+  count = max(1, parsed_args.count // 100)
+  temp_dn = tempfile.mkdtemp(prefix='bench_client', dir='/tmp')
+  pool = lab_common.ConnectionPool()
+  ret = []
+  try:
+    for name, files in TRANSFER_SHAPES:
+      num_mb = float(sum(size for _, size in files)) / (1 << 20)
+      from_path = os.path.join(temp_dn, name)
+      WriteFiles(from_path, files)
+      server.AddFiles(name, files)
+      to_path = os.path.join(temp_dn, 'pulled')
+      for direction, args in (
+          ('push', ['adb', '-s', 'serial0', 'push', from_path, '/sdcard']),
+          ('pull', ['adb', '-s', 'serial0', 'pull', '/sdcard/bench/' + name,
+                    to_path])):
+        start_time = time.time()
+        for _ in range(count):
+          if server.Call(args, pool):
+            raise RuntimeError('Failed: %s' % ' '.join(args))
+          if os.path.isdir(to_path):
+            shutil.rmtree(to_path)
+          elif os.path.exists(to_path):
+            os.remove(to_path)
+        duration = (time.time() - start_time) / count
+        ret.append(('%s_%s_mb_per_second' % (direction, name),
+                    '%.1f' % (num_mb / duration)))
+        ret.append(('%s_%s_ms' % (direction, name), '%.1f' % (
+            1000 * duration)))
+  finally:
+    pool.Close()
+    shutil.rmtree(temp_dn)
+  return ret
+
+
+def BenchmarkScaling(server, parsed_args):
+  """Measures "adb shell" throughput and latency with concurrent clients.
+
+  Each client is a thread with its own keep-alive connection, which runs its
+  share of the commands back to back.
+
+  Args:
+    server: BenchmarkServer.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  """
+  ret = []
+  for num_clients in SCALING_CLIENTS:
+    count = max(num_clients, parsed_args.count)
+    latencies = []
+    errors = []
+    start_event = threading.Event()
+
+    def RunClient(num_commands):
+      pool = lab_common.ConnectionPool()
+      start_event.wait()
+      try:
+        for _ in range(num_commands):
+          start_time = time.time()
+          if server.Call(['adb', '-s', 'serial0', 'shell', 'echo', 'hi'],
+                         pool):
+            errors.append('exit code')
+          latencies.append(time.time() - start_time)
+      except Exception, e:  # pylint: disable=broad-except
+        errors.append(str(e))
+      finally:
+        pool.Close()
+
+    threads = [threading.Thread(target=RunClient, args=(
+        count // num_clients + (1 if i < count % num_clients else 0),))
+               for i in range(num_clients)]
+    for thread in threads:
+      thread.start()
+    start_time = time.time()
+    start_event.set()
+    for thread in threads:
+      thread.join()
+    duration = time.time() - start_time
+    if errors:
+      raise RuntimeError('%d of %d commands failed, e.g.: %s' % (
+          len(errors), count, errors[0]))
+    prefix = 'clients%d' % num_clients
+    ret.append(('%s_qps' % prefix, '%.1f' % (count / duration)))
+    ret += GetPercentiles(latencies, prefix)
+  return ret
+
+
+def BenchmarkStartup(server, parsed_args):
+  """Measures the client's startup time, when it's run via an "adb" symlink.
+
+  Harnesses that shell out to "adb" start a new client per command.  We time
+  "adb devices" in a new client process, and subtract the same command's
+  round trip from an in-process client, which leaves the time that the
+  process spends starting up, parsing its command and exiting.  The
+  interpreter's own startup is reported separately, as "python_p50_ms", and
+  "agent_p50_ms" times the same process when it calls a LabDeviceProxyAgent.
+
+  Args:
+    server: BenchmarkServer.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  """
+  count = max(1, parsed_args.count // 20)
+  temp_dn = tempfile.mkdtemp(prefix='bench_client', dir='/tmp')
+  client_path = os.path.join(
+      os.path.dirname(os.path.abspath(__file__)), 'lab_device_proxy_client.py')
+  adb_path = os.path.join(temp_dn, 'adb')
+  os.symlink(client_path, adb_path)
+  socket_fn = os.path.join(temp_dn, 'agent.sock')
+  env = {'PATH': os.path.dirname(os.path.abspath(sys.executable)),
+         'LAB_DEVICE_PROXY_URL': server.url,
+         lab_common.AGENT_ENV: socket_fn}
+
+  def Time(args):
+    latencies = []
+    with open(os.devnull, 'w') as devnull:
+      for _ in range(count):
+        start_time = time.time()
+        if subprocess.call(args, stdout=devnull, env=env):
+          raise RuntimeError('Failed: %s' % ' '.join(args))
+        latencies.append(time.time() - start_time)
+    return sorted(latencies)[(count - 1) // 2]
+
+  try:
+    python_time = Time([sys.executable, '-c', 'pass'])
+    process_time = Time([adb_path, 'devices'])  # No agent yet
+    agent = lab_common.LabDeviceProxyAgent(socket_fn)
+    agent.Start()
+    thread = threading.Thread(target=agent.Serve)
+    thread.start()
+    try:
+      agent_time = Time([adb_path, 'devices'])
+    finally:
+      agent.Stop()
+      thread.join()
+  finally:
+    shutil.rmtree(temp_dn)
+  latencies = []
+  for _ in range(count):
+    pool = lab_common.ConnectionPool(max_idle=0)  # A new connection, as above
+    start_time = time.time()
+    server.Call(['adb', 'devices'], pool)
+    latencies.append(time.time() - start_time)
+  call_time = sorted(latencies)[(count - 1) // 2]
+  return [('python_p50_ms', '%.1f' % (1000 * python_time)),
+          ('process_p50_ms', '%.1f' % (1000 * process_time)),
+          ('agent_p50_ms', '%.1f' % (1000 * agent_time)),
+          ('call_p50_ms', '%.1f' % (1000 * call_time)),
+          ('client_p50_ms', '%.1f' % (1000 * (process_time - call_time)))]
+
+
+def BenchmarkFraming(unused_server, parsed_args):
+  """Measures the chunk frames per second of each framing codec.
+
+  This is a microbenchmark, without a server: we encode logcat-sized stdout
+  chunks into a buffer, then decode them.
+
+  Args:
+    unused_server: None.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  """
+  num_frames = parsed_args.count * 100
+  data = 'I/Bench   ( 1234): line 0 of a logcat burst\n'
+  ret = []
+  for name, framing in (('text', lab_common.TEXT_FRAMING),
+                        ('binary', lab_common.BINARY_FRAMING)):
+    to_stream = StringIO.StringIO()
+    start_time = time.time()
+    for _ in range(num_frames):
+      lab_common.SendChunk(lab_common.ChunkHeader('1'), data, to_stream,
+                           framing)
+    encode_time = time.time() - start_time
+    lab_common.SendEnd(to_stream, framing)
+
+    from_stream = StringIO.StringIO(to_stream.getvalue())
+    start_time = time.time()
+    while True:
+      header = framing.ReadHeader(from_stream)
+      if header is None:
+        break
+      from_stream.read(header.len_)
+      framing.ReadTrailer(from_stream)
+    decode_time = time.time() - start_time
+
+    ret.append(('%s_encode_fps' % name, '%.0f' % (num_frames / encode_time)))
+    ret.append(('%s_decode_fps' % name, '%.0f' % (num_frames / decode_time)))
+    ret.append(('%s_overhead_bytes' % name, '%.1f' % (
+        float(to_stream.tell()) / num_frames - len(data))))
+  return ret
+
+
+# Benchmark functions and their server args, or None if they don't need a
+# server.
+BENCHMARKS = {
+    'framing': (BenchmarkFraming, None),
+    'keepalive': (BenchmarkKeepAlive, []),
+    'latency': (BenchmarkLatency, ['--noresult_cache']),
+    'priority': (BenchmarkPriority, ['--max_per_host=2']),
+    'pull': (BenchmarkPull, []),
+    'pull_nosendfile': (BenchmarkPull, ['--nosendfile']),
+    'scaling': (BenchmarkScaling, []),
+    'scaling_eventloop': (BenchmarkScaling, ['--engine=eventloop']),
+    'shell': (BenchmarkShell, []),
+    'shell_native': (BenchmarkShell, ['--native_adb',
+                                      '--adb_port=%d' % FAKE_ADB_PORT]),
+    'startup': (BenchmarkStartup, []),
+    'stream': (BenchmarkStream, []),
+    'stream_nocoalesce': (BenchmarkStream, ['--coalesce_ms=0']),
+    'transfer': (BenchmarkTransfer, []),
+}
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -10,21 +10,208 @@ Forwards the commands to a proxy server that runs them on its machine.
 """
 
 # Only Python built-in imports! Runs as a standalone Python file.
+#
+# Each "adb" or "idevice*" call starts a new client, so imports that only some
+# commands need (e.g. tarfile and multiprocessing.pool, for input and output
+# directories) are deferred to their first use.  A call via a local agent
+# (see CallAgent) only needs these first few modules, so it's made before the
+# rest are imported.
+import os
+import signal
+import socket
+import struct
+import sys
+
+# Environment variable with the path of the local agent's Unix socket, which
+# defaults to a "socket" in a private per-user directory under $TMPDIR.
+AGENT_ENV = 'LAB_DEVICE_PROXY_AGENT'
+
+# Version of our shim-to-agent protocol, see CallAgent.
+AGENT_VERSION = '1'
+
+
+def ParseArgs(args):
+  """Parses the client's args and environment, as described in main.
+
+  Args:
+    args: List of command and arguments, e.g. ['./adb', 'install', 'foo.apk'].
+  Returns:
+    Tuple of (args, url, priority, compression, is_timed, is_agent,
+    device_ids), where args is the command, e.g. ['adb', 'install', 'foo.apk'],
+    is_agent is True if the args were "lab_device_proxy_client.py --agent",
+    and device_ids is the list of "--each-device" ids, or None.
+  """
+  args = list(args)
+
+  url = os.environ.get('LAB_DEVICE_PROXY_URL')
+  priority = os.environ.get('LAB_DEVICE_PROXY_PRIORITY')
+  compression = os.environ.get('LAB_DEVICE_PROXY_COMPRESSION')
+  is_timed = bool(os.environ.get('LAB_DEVICE_PROXY_TIMING'))
+  is_agent = False
+  device_ids = None
+
+  if 'lab_device_proxy_client' in args[0]:
+    args.pop(0)  # happens when there are no symlinks.
+    while len(args) > 1 and args[0] in ('--url', '--priority', '--compression',
+                                        '--timing', '--each-device'):
+      flag = args.pop(0)
+      if flag == '--timing':
+        is_timed = True
+      elif flag == '--url':
+        url = args.pop(0)
+      elif flag == '--priority':
+        priority = args.pop(0)
+      elif flag == '--each-device':
+        device_ids = args.pop(0).replace(',', ' ').split()
+      else:
+        compression = args.pop(0)
+    is_agent = (args == ['--agent'])
+
+  if args:
+    args[0] = os.path.basename(args[0])
+  return args, url, priority, compression, is_timed, is_agent, device_ids
+
+
+def GetAgentSocket():
+  """Returns the path of the local agent's Unix socket."""
+  return os.environ.get(AGENT_ENV) or os.path.join(
+      os.environ.get('TMPDIR', '/tmp'),
+      'lab_device_proxy_agent.%d' % os.getuid(), 'socket')
+
+
+def CallAgent(args):
+  """Runs a command via the local agent and exits, if an agent is running.
+
+  The agent (see LabDeviceProxyAgent) keeps warm connections to the proxy
+  servers, so a call via the agent saves this process the client's imports,
+  parser and connection setup.  We send it a length-prefixed, NUL-separated
+  request:
+    AGENT_VERSION, cwd, url, priority, compression, is_timed, args...
+  and it replies with frames of a one-byte kind ("1" for stdout, "2" for
+  stderr, "x" for the exit code, or "r" if we should run the command
+  ourselves, e.g. to print a parser error), a 4-byte length and data.
+
+  Args:
+    args: List of command and arguments, as in main.
+  Returns:
+    None if there's no agent, or if it asked us to run the command ourselves.
+  """
+  (args, url, priority, compression, is_timed, is_agent,
+   device_ids) = ParseArgs(args)
+  if is_agent or device_ids is not None or not url or not args:
+    return
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(GetAgentSocket())
+  except socket.error:
+    sock.close()
+    return  # No agent
+  request = '\0'.join(
+      [AGENT_VERSION, os.getcwd(), url, priority or '', compression or '',
+       ('1' if is_timed else '')] + args)
+  sock.sendall(struct.pack('!I', len(request)) + request)
+  from_stream = sock.makefile('rb')
+  while True:
+    frame = from_stream.read(5)
+    if len(frame) < 5:
+      sys.exit('Lost the lab device proxy agent')
+    kind, num_bytes = frame[0], struct.unpack('!I', frame[1:])[0]
+    data = from_stream.read(num_bytes)
+    if kind == '1':
+      os.write(sys.stdout.fileno(), data)
+    elif kind == '2':
+      os.write(sys.stderr.fileno(), data)
+    elif kind == 'x':
+      sys.exit(int(data))
+    else:
+      sock.close()
+      return  # Run it ourselves
+
+
+if __name__ == '__main__':
+  signal.signal(signal.SIGINT, signal.SIG_DFL)  # Exit on Ctrl-C
+  CallAgent(sys.argv)
+
+# pylint: disable=g-import-not-at-top
 import argparse
+import collections
 import cStringIO as StringIO
+import errno
+import hashlib
 import httplib
-import os
-import os.path
 import re
-import signal
-import sys
-import tarfile
+import select
 import threading
-import traceback
+import time
 import urlparse
+import zlib
+# pylint: enable=g-import-not-at-top
 
 MAX_READ = 8192
 
+# Request header with the batch parallelism, for CallBatch and CallFanout
+# requests.
+BATCH_HEADER = 'X-Lab-Device-Proxy-Batch'
+
+# Request header with space-separated device ids, for CallFanout requests.
+FANOUT_HEADER = 'X-Lab-Device-Proxy-Fanout'
+
+# Request header with the priority of the request's commands, one of
+# PRIORITIES, to override the priority that the server derives from each
+# command.
+PRIORITY_HEADER = 'X-Lab-Device-Proxy-Priority'
+
+# Request header with the response framings that the client accepts, and
+# response header with the framing that the server chose, e.g. "2" for
+# BinaryFraming.  Without it, responses use TextFraming.
+FRAMING_HEADER = 'X-Lab-Device-Proxy-Framing'
+
+# Request header that asks the server to end its response with a "timing"
+# chunk: a JSON object with the request's id, phase durations and file sizes,
+# which the client merges into its RequestTiming.  Older servers ignore it.
+TIMING_HEADER = 'X-Lab-Device-Proxy-Timing'
+
+# Response header that's "1" if the server has an upload cache, i.e. it
+# accepts digest-only input files.  Older servers would read a digest-only
+# chunk as an empty file, so clients only send them after seeing this header.
+UPLOAD_CACHE_HEADER = 'X-Lab-Device-Proxy-Upload-Cache'
+
+# If False, clients don't ask for BinaryFraming, e.g. for benchmarking.
+USE_BINARY_FRAMING = True
+
+# Priority classes, highest first.  "high" is for quick, latency-sensitive
+# commands (e.g. "adb devices"), and "bulk" is for file transfers and installs.
+PRIORITIES = ('high', 'normal', 'bulk')
+
+# Tar compression modes.  "auto" picks a gzip level for each block of the tar,
+# based on how compressible the block is and how fast the stream is, "none"
+# sends a plain tar, and "fast" and "best" use gzip levels 1 and 9.  Tars
+# are read with "r|*", so the reader accepts every mode.
+COMPRESSIONS = ('auto', 'none', 'fast', 'best')
+
+# Number of threads that compress tar blocks, 0 for one per CPU.  zlib
+# releases the GIL while it compresses, so threads use every core.
+COMPRESSION_THREADS = 0
+
+# If False, SendFileChunk never uses sendfile, e.g. for benchmarking.
+USE_SENDFILE = True
+
+# SendChunk joins a chunk's header and data into one write if the data is at
+# most JOIN_SIZE bytes, since copying a small chunk is cheaper than a second
+# send.  Unlike COALESCE_SIZE, the server's flags don't change this.
+JOIN_SIZE = 64 * 1024
+
+# Command output is batched into chunks of up to COALESCE_SIZE bytes, and sent
+# at most COALESCE_DELAY seconds after it's read, so a burst of small writes
+# (e.g. "adb logcat" lines) is framed and sent as a few large chunks.  The
+# server sets these from its flags.
+COALESCE_DELAY = 0.002
+COALESCE_SIZE = 64 * 1024
+
+# Input files at least this large are first sent as a digest, in case the
+# server already has them in its upload cache.
+MIN_CACHED_SIZE = 64 * 1024
+
 
 def main(args):
   """Runs the client, exits when done.
@@ -50,21 +237,32 @@ def main(args):
       is equivalent to:
         os.environ['LAB_DEVICE_PROXY_URL'] = 'http://x:80804'
         ['ideviceinfo'].
+      Similarly, an optional "--priority PRIORITY" argument is equivalent to
+      setting the "$LAB_DEVICE_PROXY_PRIORITY" environment variable, and an
+      optional "--compression COMPRESSION" argument is equivalent to setting
+      the "$LAB_DEVICE_PROXY_COMPRESSION" environment variable.  An optional
+      "--timing" argument, or a non-empty "$LAB_DEVICE_PROXY_TIMING", prints
+      the request's RequestTiming report to stderr.
+
+      An optional "--each-device IDS" argument, where IDS are comma- or
+      space-separated Android serials or iOS UDIDs, runs the command on each
+      device at once and prints each line of output prefixed by its device
+      id, e.g.:
+        ['lab_device_proxy_client.py', '--each-device', 'X,Y', 'adb',
+         'shell', 'getprop', 'ro.build.id']
+
+      "lab_device_proxy_client.py --agent" runs a LabDeviceProxyAgent, until
+      it's killed.  While it runs, calls are forwarded to it by CallAgent,
+      before we get here.
   """
   signal.signal(signal.SIGINT, signal.SIG_DFL)  # Exit on Ctrl-C
 
-  args = list(args)
-
-  url = os.environ.get('LAB_DEVICE_PROXY_URL')
-
-  if 'lab_device_proxy_client' in args[0]:
-    args.pop(0)  # happens when there are no symlinks.
-    if len(args) > 1 and args[0] == '--url':
-      args.pop(0)
-      url = args.pop(0)
+  (args, url, priority, compression, is_timed, is_agent,
+   device_ids) = ParseArgs(args)
 
-  if args:
-    args[0] = os.path.basename(args[0])
+  if is_agent:
+    LabDeviceProxyAgent(GetAgentSocket()).Serve()
+    sys.exit(0)
 
   if not url:
     sys.exit(
@@ -75,6 +273,14 @@ def main(args):
         '  lab_device_proxy_client.py --url http://mylab:8084 %s ...' %
         (args[0] if args else ''))
 
+  if priority and priority not in PRIORITIES:
+    sys.exit('Unknown priority "%s", expecting one of: %s' % (
+        priority, ', '.join(PRIORITIES)))
+
+  if compression and compression not in COMPRESSIONS:
+    sys.exit('Unknown compression "%s", expecting one of: %s' % (
+        compression, ', '.join(COMPRESSIONS)))
+
   try:
     params = PARSER.parse_args(args)
   except ValueError:
@@ -85,96 +291,346 @@ def main(args):
   sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
   sys.stderr = os.fdopen(sys.stderr.fileno(), 'w', 0)
 
+  if device_ids is not None:
+    session = LabDeviceProxySession(url, max_output_bytes=sys.maxint,
+                                    priority=priority, compression=compression)
+    try:
+      results = session.RunOnEachDevice(args, device_ids)
+    except ValueError, e:
+      sys.exit(str(e))
+    sys.exit(PrintDeviceResults(results, sys.stdout, sys.stderr, is_timed))
+
   # TODO(user) support os.environ.get('ANDROID_SERIAL')?
   exit_code = 1
+  client = None
   try:
-    client = LabDeviceProxyClient(url, sys.stdout, sys.stderr)
+    client = LabDeviceProxyClient(url, sys.stdout, sys.stderr,
+                                  priority=priority, compression=compression)
     exit_code = client.Call(*params)
   except:  # pylint: disable=bare-except
     sys.stderr.write(GetStack())
+  if is_timed and client and client.last_timing:
+    sys.stderr.write(client.last_timing.Format())
   sys.exit(exit_code)
 
 
+def PrintDeviceResults(results, stdout, stderr, is_timed=False):
+  """Prints RunOnEachDevice results, prefixing each line by its device id.
+
+  Args:
+    results: Iterator of (device_id, SessionResult) tuples.
+    stdout: file object for the devices' stdout.
+    stderr: file object for the devices' stderr, non-zero exit codes and, if
+        is_timed, RequestTiming reports.
+    is_timed: bool, print each device's RequestTiming report.
+  Returns:
+    0 if every device's command exited with 0, else 1.
+  """
+  def Print(device_id, data, to_stream):
+    if data:
+      to_stream.write(''.join('%s: %s\n' % (device_id, line)
+                              for line in data.rstrip('\n').split('\n')))
+
+  exit_code = 0
+  for device_id, result in results:
+    Print(device_id, result.stdout, stdout)
+    Print(device_id, result.stderr, stderr)
+    if result.exit_code != 0:
+      Print(device_id, 'exit code %s' % result.exit_code, stderr)
+      exit_code = 1
+    if is_timed and result.timing:
+      Print(device_id, result.timing.Format(), stderr)
+  return exit_code
+
+
 class LabDeviceProxyClient(object):
   """The Proxy Client."""
 
-  def __init__(self, url, stdout, stderr):
+  def __init__(self, url, stdout, stderr, connection_pool=None,
+               priority=None, compression=None):
+    """Creates a client.
+
+    Args:
+      url: string server URL, e.g. 'http://mylab:8084'.
+      stdout: file object for the command's stdout.
+      stderr: file object for the command's stderr.
+      connection_pool: optional ConnectionPool, defaults to a pool that's
+          shared by all clients in this process.
+      priority: optional string, one of PRIORITIES, defaults to the priority
+          that the server derives from each command.
+      compression: optional string, one of COMPRESSIONS, for the tars of
+          input and output directories, defaults to "auto".
+    """
     self._url = (url if '://' in url else ('http://%s' % url))
     self._stdout = stdout
     self._stderr = stderr
+    self._connection_pool = (
+        connection_pool if connection_pool is not None else CONNECTION_POOL)
+    self._priority = priority
+    self._compression = compression
+    self.last_timing = None  # RequestTiming of our last request
 
   def Call(self, *params):
     """Calls the proxy.
 
+    Large input files are first sent as digests.  If the server doesn't have
+    them in its upload cache, it rejects the request with an HTTP-417 and we
+    re-send the request with the file contents.
+
     Args:
       *params: A vararg array of Parameters.
     Returns:
       The exit code
     """
-    connection = _LabHTTPConnection(urlparse.urlsplit(self._url).netloc)
+    return self._CallWithRetry([params], [(self._stdout, self._stderr)])[0]
+
+  def CallBatch(self, params_list, parallel=1):
+    """Calls the proxy with a batch of commands, in a single request.
+
+    Args:
+      params_list: List of Parameter lists, e.g. from PARSER.parse_args.
+      parallel: int maximum number of commands for the server to run at once,
+          which the server may further limit.
+    Returns:
+      List of BatchResults, in params_list order.
+    """
+    outputs = [(StringIO.StringIO(), StringIO.StringIO())
+               for _ in params_list]
+    exit_codes = self._CallWithRetry(params_list, outputs, parallel)
+    return [BatchResult(exit_code, stdout.getvalue(), stderr.getvalue())
+            for exit_code, (stdout, stderr) in zip(exit_codes, outputs)]
+
+  def CallFanout(self, device_ids, params, parallel=1):
+    """Calls the proxy to run a command on many devices of the same server.
+
+    The input files are uploaded once and shared by all the devices, e.g. to
+    install the same APK on a rack of devices.
+
+    Args:
+      device_ids: List of Android serials or iOS UDIDs.
+      params: List of Parameters without a device id or output files, e.g.
+          from PARSER.parse_args(['adb', 'install', 'foo.apk']).
+      parallel: int maximum number of devices for the server to run the
+          command on at once, which the server may further limit.
+    Returns:
+      List of BatchResults, in device_ids order.
+    Raises:
+      ValueError: if there are no device ids or the command has an output
+          file.
+    """
+    if not device_ids:
+      raise ValueError('Fan-out requires device ids')
+    if any(isinstance(param, OutputFileParameter) for param in params):
+      raise ValueError('Fan-out commands can\'t have output files')
+    outputs = [(StringIO.StringIO(), StringIO.StringIO())
+               for _ in device_ids]
+    exit_codes = self._CallWithRetry([params], outputs, parallel, device_ids)
+    return [BatchResult(exit_code, stdout.getvalue(), stderr.getvalue())
+            for exit_code, (stdout, stderr) in zip(exit_codes, outputs)]
+
+  def _CallWithRetry(self, batch, outputs, parallel=None, device_ids=None):
+    """Calls the proxy, re-sending on an upload cache miss.
+
+    Large input files are only sent as digests if the server has an upload
+    cache, which we ask it about if we don't know yet.
+
+    Args:
+      batch: List of Parameter lists.
+      outputs: List of (stdout, stderr) file objects, one per command.
+      parallel: int batch parallelism, or None if this isn't a batch.
+      device_ids: optional list of device ids to fan the batch's single
+          command out to.
+    Returns:
+      List of exit codes, one per command.
+    """
+    netloc = urlparse.urlsplit(self._url).netloc
+    has_digests = any(
+        isinstance(param, InputFileParameter) and param.GetDigest()
+        for params in batch for param in params)
+    if has_digests:
+      has_upload_cache = self._connection_pool.HasUploadCache(netloc)
+      if has_upload_cache is None:
+        has_upload_cache = self._GetHasUploadCache(netloc)
+      if has_upload_cache:
+        try:
+          return self._Call(batch, outputs, parallel, device_ids, True)
+        except CacheMissError:
+          pass
+    return self._Call(batch, outputs, parallel, device_ids, False)
+
+  def _GetHasUploadCache(self, netloc):
+    """Asks the server if it has an upload cache, via its "/healthz" page.
+
+    Args:
+      netloc: string server host:port.
+    Returns:
+      True if the server's response has our UPLOAD_CACHE_HEADER.
+    """
+    connection, is_reused = self._connection_pool.Get(netloc)
     try:
-      self._SendRequest(params, connection)
-      return self._ReadResponse(params, connection)
-    finally:
+      if not is_reused:
+        connection.connect()
+      connection.request('GET', '/healthz')
+      response = connection.getresponse()
+      response.read()
+    except (httplib.HTTPException, socket.error):
       connection.close()
+      return False  # We'll find out from our request's response
+    has_upload_cache = (response.status == httplib.OK and
+                        response.getheader(UPLOAD_CACHE_HEADER) == '1')
+    self._connection_pool.SetHasUploadCache(netloc, has_upload_cache)
+    if response.will_close:
+      connection.close()
+    else:
+      self._connection_pool.Put(netloc, connection)
+    return has_upload_cache
+
+  def _Call(self, batch, outputs, parallel, device_ids, digest_only):
+    """Sends a single request and reads its response.
 
-  def _SendRequest(self, params, connection):
+    Args:
+      batch: List of Parameter lists.
+      outputs: List of (stdout, stderr) file objects, one per command.
+      parallel: int batch parallelism, or None if this isn't a batch.
+      device_ids: optional list of device ids to fan the batch's single
+          command out to.
+      digest_only: bool, send large input files as digests.
+    Returns:
+      List of exit codes, one per command.
+    """
+    netloc = urlparse.urlsplit(self._url).netloc
+    while True:
+      timing = RequestTiming()
+      connection, is_reused = self._connection_pool.Get(netloc)
+      is_sent = False
+      is_done = False
+      try:
+        try:
+          if not is_reused:
+            connection.connect()
+          timing.AddClientPhase('connect')
+          self._SendRequest(batch, connection, digest_only, parallel,
+                            device_ids)
+          is_sent = True
+          timing.AddClientPhase('send')
+          response = connection.getresponse()
+          timing.AddClientPhase('first byte')
+          if response.status == httplib.OK:
+            self._connection_pool.SetHasUploadCache(
+                netloc, response.getheader(UPLOAD_CACHE_HEADER) == '1')
+        except (httplib.BadStatusLine, socket.error):
+          if is_reused and not is_sent:
+            # The server closed our idle connection before we could send our
+            # whole request, so it didn't run our commands and it's safe to
+            # re-send it on a new connection.  Once it's sent, we can't tell,
+            # so we don't risk running e.g. "adb install" twice.
+            continue
+          raise
+        self.last_timing = timing
+        exit_codes = self._ReadResponse(
+            (batch * len(device_ids) if device_ids else batch), outputs,
+            response, parallel is not None, timing)
+        timing.AddClientPhase('read')
+        is_done = True
+        return exit_codes
+      finally:
+        if is_done and not response.will_close:
+          self._connection_pool.Put(netloc, connection)
+        else:
+          connection.close()
+
+  def _SendRequest(self, batch, connection, digest_only=False, parallel=None,
+                   device_ids=None):
     """Sends a command to an HTTPConnection, chunk-encoded.
 
     Args:
-      params: List of Parameters.
+      batch: List of Parameter lists.
       connection: HTTPConnection.
+      digest_only: bool, send large input files as digests.
+      parallel: int batch parallelism, or None if this isn't a batch.
+      device_ids: optional list of device ids to fan the batch's single
+          command out to.
     """
     connection.putrequest('POST', ''.join(urlparse.urlsplit(self._url)[2:]))
     connection.putheader('Content-Type', 'text/plain; charset=utf=8')
     connection.putheader('Transfer-Encoding', 'chunked')
     connection.putheader('Content-Encoding', 'UTF-8')
+    if parallel is not None:
+      connection.putheader(BATCH_HEADER, str(parallel))
+    if device_ids:
+      connection.putheader(FANOUT_HEADER, ' '.join(device_ids))
+    if self._priority:
+      connection.putheader(PRIORITY_HEADER, self._priority)
+    if USE_BINARY_FRAMING:
+      connection.putheader(FRAMING_HEADER, BINARY_FRAMING.VERSION)
+    connection.putheader(TIMING_HEADER, '1')
     connection.endheaders()
-    for param in params:
-      param.SendTo(connection)
+    for cmd_index, params in enumerate(batch):
+      # A fan-out request sends its single command as a non-batch command.
+      to_stream = (connection if parallel is None or device_ids else
+                   BatchCommandStream(connection, cmd_index))
+      for param in params:
+        if isinstance(param, InputFileParameter):
+          param.SendTo(to_stream, digest_only, self._compression)
+        elif isinstance(param, OutputFileParameter):
+          param.SendTo(to_stream, self._compression)
+        else:
+          param.SendTo(to_stream)
     connection.send('0\r\n\r\n')
 
-  def _ReadResponse(self, params, connection):
+  def _ReadResponse(self, batch, outputs, response, is_batch=False,
+                    timing=None):
     """Reads the response chunks from the server.
 
     Args:
-      params: a sequence of command line arguments.
-      connection: an HTTPConnection.
+      batch: List of Parameter lists.
+      outputs: List of (stdout, stderr) file objects, one per command.
+      response: an HTTPResponse.
+      is_batch: bool, expect chunks tagged with their "cmd" index.
+      timing: optional RequestTiming, to merge the server's timing into.
     Returns:
-      int exitcode
+      List of int exitcodes, one per command.
     Raises:
+      CacheMissError: if the server lacks a digest-only input file.
       RuntimeError: if the server rejected the request.
       ValueError: if the response is invalid.
     """
     # Check status
-    response = connection.getresponse()
+    if response.status == httplib.EXPECTATION_FAILED:
+      raise CacheMissError('Request failed: %s %s' % (
+          response.status, response.reason))
     if response.status != httplib.OK:
       raise RuntimeError('Request failed: %s %s' % (
           response.status, response.reason))
-    if response.getheader('Transfer-Encoding') != 'chunked':
+    if response.getheader(FRAMING_HEADER) == BINARY_FRAMING.VERSION:
+      framing = BINARY_FRAMING
+    elif response.getheader('Transfer-Encoding') == 'chunked':
+      framing = TEXT_FRAMING
+    else:
       raise RuntimeError('Invalid response headers: %s' % response.msg)
     from_stream = response
 
-    # Map chunk "id" to writable file_pointer ("fp").
-    id_to_fp = {}
-    id_to_fp['1'] = self._stdout
-    id_to_fp['2'] = self._stderr
-    id_to_fp['exit'] = StringIO.StringIO()
-
-    # Map chunk "id" to output file_name ("fn").
-    id_to_fn = {}
-    for index, param in enumerate(params):
-      if isinstance(param, OutputFileParameter):
-        id_to_fn['o%d' % index] = param.value
+    # Map chunk ("cmd", "id") to writable file_pointer ("fp").  The server
+    # only sets the "cmd" index in batch responses.
+    id_to_fp = {(None, 'timing'): StringIO.StringIO()}
+    id_to_fn = {}  # Map chunk ("cmd", "id") to output file_name ("fn").
+    for cmd_index, params in enumerate(batch):
+      cmd = (str(cmd_index) if is_batch else None)
+      id_to_fp[cmd, '1'] = outputs[cmd_index][0]
+      id_to_fp[cmd, '2'] = outputs[cmd_index][1]
+      id_to_fp[cmd, 'exit'] = StringIO.StringIO()
+      for index, param in enumerate(params):
+        if isinstance(param, OutputFileParameter):
+          id_to_fn[cmd, 'o%d' % index] = param.value
 
     # Read chunks
     try:
       while True:
-        header = ChunkHeader()
-        header.Parse(from_stream.readline())
-        if header.len_ <= 0:
+        header = framing.ReadHeader(from_stream)
+        if header is None:
+          response.close()
           break
-        handler_id = header.id_
+        handler_id = (header.cmd_, header.id_)
         fp = id_to_fp.get(handler_id)
         if not fp and handler_id not in id_to_fn:
           raise ValueError('Unknown output stream id: %s' % header)
@@ -196,20 +652,398 @@ class LabDeviceProxyClient(object):
             data = from_stream.read(min(MAX_READ, header.len_ - bytes_read))
             bytes_read += len(data)
             fp.write(data)
-        if ReadExactly(from_stream, 2) != '\r\n':
-          raise ValueError('Chunk does not end with crlf')
+        framing.ReadTrailer(from_stream)
     finally:
       for handler_id in id_to_fn:
         if handler_id in id_to_fp:
           id_to_fp[handler_id].close()
 
-    errcode_stream = id_to_fp['exit']
-    return int(errcode_stream.getvalue()) if errcode_stream.tell() else None
+    timing_stream = id_to_fp[None, 'timing']
+    if timing and timing_stream.tell():
+      import json  # pylint: disable=g-import-not-at-top
+      timing.MergeServerTiming(json.loads(timing_stream.getvalue()))
+
+    exit_codes = []
+    for cmd_index in range(len(batch)):
+      cmd = (str(cmd_index) if is_batch else None)
+      errcode_stream = id_to_fp[cmd, 'exit']
+      exit_codes.append(
+          int(errcode_stream.getvalue()) if errcode_stream.tell() else None)
+    return exit_codes
+
+
+class RequestTiming(object):
+  """Where a request's time went, as measured by the client and server.
+
+  The client measures its "connect", "send", "first byte" (until the
+  response headers) and "read" phases.  The server's timing trailer adds its
+  request id, its "upload", "validate", "queue", "command" and "download"
+  phases, and the input and output file sizes, which older servers omit.
+  """
+
+  def __init__(self):
+    self.request_id = None  # string, from the server
+    self.client_phases = []  # List of (phase, float seconds) tuples
+    self.server_phases = []  # List of (phase, float seconds) tuples
+    self.bytes = {}  # Map 'input' and 'output' to int file sizes
+    self._start_time = time.time()
+    self._last_time = self._start_time
+
+  def AddClientPhase(self, phase):
+    """Ends a client phase, which started when the previous one ended."""
+    now = time.time()
+    self.client_phases.append((phase, now - self._last_time))
+    self._last_time = now
+
+  def MergeServerTiming(self, timing):
+    """Merges the server's timing trailer.
+
+    Args:
+      timing: dict, the trailer's decoded JSON.
+    """
+    self.request_id = timing.get('id')
+    self.server_phases = [(str(phase), seconds)
+                          for phase, seconds in timing.get('phases', [])]
+    self.bytes = dict(timing.get('bytes', {}))
+
+  def GetTotal(self):
+    """Returns the float seconds from the start to the last client phase."""
+    return self._last_time - self._start_time
+
+  def Format(self):
+    """Returns a multi-line report, e.g. for the client's "--timing"."""
+    lines = ['Request %s took %.3fs' % (self.request_id or '(no id)',
+                                        self.GetTotal())]
+    for side, phases in (('client', self.client_phases),
+                         ('server', self.server_phases)):
+      if phases:
+        lines.append('  %s: %s' % (side, ', '.join(
+            '%s %.3fs' % phase for phase in phases)))
+    if self.bytes:
+      lines.append('  bytes: %s' % ', '.join(
+          '%s %d' % item for item in sorted(self.bytes.items())))
+    return '\n'.join(lines) + '\n'
+
+
+class BatchResult(object):
+  """The result of a CallBatch command."""
+
+  def __init__(self, exit_code, stdout, stderr):
+    self.exit_code = exit_code  # int, or None if the command didn't exit
+    self.stdout = stdout  # string
+    self.stderr = stderr  # string
+
+  def __repr__(self):
+    return 'BatchResult(%r, %r, %r)' % (self.exit_code, self.stdout,
+                                        self.stderr)
+
+
+class CacheMissError(RuntimeError):
+  """The server's upload cache lacks one of our digest-only input files."""
+  pass
+
+
+class LabDeviceProxySession(object):
+  """A library API to run commands via a proxy server, in this process.
+
+  Unlike main, which runs a single command and exits, a session runs any
+  number of commands from any number of threads, and returns their exit codes
+  and output, e.g.:
+    session = LabDeviceProxySession('http://mylab:8084')
+    print session.Run(['adb', 'devices']).stdout
+    calls = [session.RunAsync(['adb', '-s', serial, 'install', 'foo.apk'])
+             for serial in serials]
+    exit_codes = [call.Wait().exit_code for call in calls]
+
+  Each command gets its own LabDeviceProxyClient, which share our
+  ConnectionPool.
+  """
+
+  def __init__(self, url, max_parallel=64, max_output_bytes=(1 << 20),
+               connection_pool=None, priority=None, compression=None):
+    """Creates a session.
+
+    Args:
+      url: string server URL, e.g. 'http://mylab:8084'.
+      max_parallel: int maximum number of our commands to send at once, and
+          number of idle connections to keep for them.  Later commands wait.
+      max_output_bytes: int default maximum number of bytes of each command's
+          stdout and stderr to keep in its SessionResult.
+      connection_pool: optional ConnectionPool, defaults to a new pool that's
+          shared by our commands.
+      priority: optional string, one of PRIORITIES, as in
+          LabDeviceProxyClient.
+      compression: optional string, one of COMPRESSIONS, as in
+          LabDeviceProxyClient.
+    """
+    self._url = url
+    self._max_parallel = max_parallel
+    self._semaphore = threading.Semaphore(max_parallel)
+    self._max_output_bytes = max_output_bytes
+    self._connection_pool = (
+        connection_pool if connection_pool is not None else
+        ConnectionPool(max_idle=max_parallel))
+    self._priority = priority
+    self._compression = compression
+
+  def Run(self, args, max_output_bytes=None):
+    """Runs a command.
+
+    Args:
+      args: List of command and arguments, e.g. ['adb', 'devices'].
+      max_output_bytes: optional int maximum number of bytes of stdout and
+          stderr to keep, defaults to our max_output_bytes.
+    Returns:
+      SessionResult.
+    Raises:
+      ValueError: if the command is invalid.
+    """
+    if max_output_bytes is None:
+      max_output_bytes = self._max_output_bytes
+    stdout = BoundedBuffer(max_output_bytes)
+    stderr = BoundedBuffer(max_output_bytes)
+    exit_code, timing = self._Call(args, stdout, stderr)
+    return SessionResult(exit_code, stdout, stderr, timing)
+
+  def RunAsync(self, args, max_output_bytes=None):
+    """Starts a command, as Run does, in a new thread.
+
+    Args:
+      args: List of command and arguments, e.g. ['adb', 'devices'].
+      max_output_bytes: optional int, as in Run.
+    Returns:
+      SessionCall, whose Wait returns Run's SessionResult.
+    """
+    return SessionCall(self.Run, args, max_output_bytes)
+
+  def RunOnEachDevice(self, args, device_ids, max_output_bytes=None):
+    """Runs a command on many devices, e.g. "adb shell dumpsys battery".
+
+    Unlike LabDeviceProxyClient.CallFanout, each device's command is a
+    separate request, so a slow device doesn't delay the others' results.  Up
+    to max_parallel of our threads send the requests.
+
+    Args:
+      args: List of command and arguments, without a device id, e.g.
+          ['adb', 'logcat', '-c'].  The "-s" or "-u" option and device id are
+          inserted after args[0].
+      device_ids: List of Android serials or iOS UDIDs.
+      max_output_bytes: optional int, as in Run.
+    Returns:
+      Iterator of (device_id, SessionResult) tuples, as they complete.  If a
+      device's request fails, its exit_code is None and its stderr ends with
+      the error.
+    Raises:
+      ValueError: if the command is invalid, has a device id or output file.
+    """
+    import Queue  # pylint: disable=g-import-not-at-top
+    for param in PARSER.parse_args(list(args)):
+      if isinstance(param, (AndroidSerialParameter, IOSDeviceIdParameter)):
+        raise ValueError('Command already has a device id: %s' % param)
+      if isinstance(param, OutputFileParameter):
+        raise ValueError('Command has an output file: %s' % param)
+    if max_output_bytes is None:
+      max_output_bytes = self._max_output_bytes
+    device_option = ('-s' if args[0] == 'adb' else '-u')
+    device_queue = Queue.Queue()
+    for device_id in device_ids:
+      device_queue.put(device_id)
+    result_queue = Queue.Queue()
+
+    def RunDevices():
+      while True:
+        try:
+          device_id = device_queue.get_nowait()
+        except Queue.Empty:
+          return
+        stdout = BoundedBuffer(max_output_bytes)
+        stderr = BoundedBuffer(max_output_bytes)
+        try:
+          exit_code, timing = self._Call(
+              [args[0], device_option, device_id] + list(args[1:]), stdout,
+              stderr)
+        except Exception, e:  # pylint: disable=broad-except
+          exit_code, timing = None, None
+          stderr.write('%s\n' % (e or type(e).__name__))
+        result_queue.put(
+            (device_id, SessionResult(exit_code, stdout, stderr, timing)))
+
+    threads = []
+    for _ in range(min(self._max_parallel, len(device_ids))):
+      thread = threading.Thread(target=RunDevices)
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+
+    def GetResults():
+      for _ in device_ids:
+        yield result_queue.get()
+      for thread in threads:
+        thread.join()  # They're done, so our caller can exit cleanly
+    return GetResults()
+
+  def Push(self, from_fn, to_path, serial=None):
+    """Runs "adb push", to copy a local file or directory to a device.
+
+    Args:
+      from_fn: string local path.
+      to_path: string device path.
+      serial: optional string Android device id.
+    Returns:
+      SessionResult.
+    """
+    return self.Run(['adb'] + (['-s', serial] if serial else []) +
+                    ['push', from_fn, to_path])
+
+  def Pull(self, from_path, to_fn, serial=None):
+    """Runs "adb pull", to copy a device file or directory to a local path.
+
+    Args:
+      from_path: string device path.
+      to_fn: string local path.
+      serial: optional string Android device id.
+    Returns:
+      SessionResult.
+    """
+    return self.Run(['adb'] + (['-s', serial] if serial else []) +
+                    ['pull', from_path, to_fn])
+
+  def Stream(self, args, on_stdout, on_stderr=None):
+    """Runs a command and passes its output to callbacks, as it arrives.
+
+    E.g. for "adb logcat", whose output doesn't fit in a buffer.  The
+    callbacks run in the calling thread.
+
+    Args:
+      args: List of command and arguments, e.g. ['adb', 'logcat'].
+      on_stdout: function that's called with each string of stdout.
+      on_stderr: optional function that's called with each string of stderr,
+          defaults to ignoring stderr.
+    Returns:
+      The exit code.
+    Raises:
+      ValueError: if the command is invalid.
+    """
+    exit_code, _ = self._Call(args, _CallbackStream(on_stdout),
+                              _CallbackStream(on_stderr))
+    return exit_code
+
+  def _Call(self, args, stdout, stderr):
+    """Runs a command.
+
+    Args:
+      args: List of command and arguments.
+      stdout: file object for the command's stdout.
+      stderr: file object for the command's stderr.
+    Returns:
+      (exit_code, RequestTiming) tuple.
+    """
+    params = PARSER.parse_args(list(args))
+    client = LabDeviceProxyClient(
+        self._url, stdout, stderr, connection_pool=self._connection_pool,
+        priority=self._priority, compression=self._compression)
+    with self._semaphore:
+      exit_code = client.Call(*params)
+    return exit_code, client.last_timing
+
+
+class SessionResult(BatchResult):
+  """The result of a LabDeviceProxySession command."""
+
+  def __init__(self, exit_code, stdout, stderr, timing):
+    """Creates a result.
+
+    Args:
+      exit_code: int, or None if the command didn't exit.
+      stdout: BoundedBuffer of the command's stdout.
+      stderr: BoundedBuffer of the command's stderr.
+      timing: RequestTiming of the command's request.
+    """
+    super(SessionResult, self).__init__(
+        exit_code, stdout.getvalue(), stderr.getvalue())
+    self.stdout_size = stdout.size  # int, including bytes that weren't kept
+    self.stderr_size = stderr.size
+    self.timing = timing
+
+
+class SessionCall(object):
+  """A LabDeviceProxySession.RunAsync command, which runs in its own thread."""
+
+  def __init__(self, target, *args):
+    self._target = target
+    self._args = args
+    self._result = None
+    self._exc_info = None
+    self._thread = threading.Thread(target=self._Run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _Run(self):
+    try:
+      self._result = self._target(*self._args)
+    except:  # pylint: disable=bare-except
+      self._exc_info = sys.exc_info()
+
+  def IsDone(self):
+    """Returns True if the command has finished."""
+    return not self._thread.is_alive()
+
+  def Wait(self, timeout=None):
+    """Waits for the command to finish.
+
+    Args:
+      timeout: optional float seconds to wait, defaults to forever.
+    Returns:
+      The command's result, or None if it's still running after the timeout.
+    Raises:
+      The command's exception, e.g. a ValueError if it's invalid.
+    """
+    self._thread.join(timeout)
+    if self._thread.is_alive():
+      return None
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+class BoundedBuffer(object):
+  """A file object that keeps the first max_bytes written to it."""
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0  # Bytes written, including those that we didn't keep
+    self._pieces = []
+
+  def write(self, data):  # pylint: disable=g-bad-name
+    if self.size < self.max_bytes:
+      self._pieces.append(data[:self.max_bytes - self.size])
+    self.size += len(data)
+
+  def getvalue(self):  # pylint: disable=g-bad-name
+    return ''.join(self._pieces)
+
+
+class _CallbackStream(object):
+  """A file object that passes its writes to a callback, if any."""
+
+  def __init__(self, callback):
+    self._callback = callback
+
+  def write(self, data):  # pylint: disable=g-bad-name
+    if self._callback and data:
+      self._callback(data)
 
 
 class _LabHTTPResponse(httplib.HTTPResponse):
   """Provides _ReadResponse access to the underlying reader stream."""
 
+  def begin(self):  # pylint: disable=g-bad-name
+    httplib.HTTPResponse.begin(self)
+    if self.getheader(FRAMING_HEADER) == BINARY_FRAMING.VERSION:
+      # The frames mark the end of the response, so the connection can be
+      # reused even though there's no Content-Length.
+      self.will_close = False
+
   def readline(self):  # pylint: disable=g-bad-name
     return self.fp.readline()
 
@@ -221,6 +1055,239 @@ class _LabHTTPResponse(httplib.HTTPResponse):
 class _LabHTTPConnection(httplib.HTTPConnection):
   response_class = _LabHTTPResponse
 
+  def connect(self):
+    httplib.HTTPConnection.connect(self)
+    # Our small writes would otherwise stall on reused connections, due to
+    # Nagle's algorithm and the server's delayed ACKs.
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class ConnectionPool(object):
+  """A thread-safe pool of idle keep-alive connections to proxy servers."""
+
+  def __init__(self, max_idle=8, idle_timeout=30):
+    """Creates a pool.
+
+    Args:
+      max_idle: int maximum number of idle connections per server, 0 to
+          disable pooling.
+      idle_timeout: seconds before we close an idle connection, which should
+          be less than the server's keep-alive timeout.
+    """
+    self._max_idle = max_idle
+    self._idle_timeout = idle_timeout
+    self._lock = threading.Lock()
+    self._idle = {}  # Map netloc to list of (connection, idle_since) tuples
+    self._has_upload_cache = {}  # Map netloc to bool, see UPLOAD_CACHE_HEADER
+
+  def Get(self, netloc):
+    """Gets an idle connection or creates a new one.
+
+    Args:
+      netloc: string server host:port.
+    Returns:
+      (HTTPConnection, is_reused) tuple.
+    """
+    with self._lock:
+      idle = self._idle.get(netloc, [])
+      while idle:
+        connection, idle_since = idle.pop()
+        if (time.time() - idle_since < self._idle_timeout and
+            not select.select([connection.sock], [], [], 0)[0]):
+          return connection, True
+        # Expired, or readable, i.e. the server closed it
+        connection.close()
+    return _LabHTTPConnection(netloc), False
+
+  def Put(self, netloc, connection):
+    """Returns a connection, which must be idle, to the pool.
+
+    Args:
+      netloc: string server host:port.
+      connection: HTTPConnection.
+    """
+    with self._lock:
+      idle = self._idle.setdefault(netloc, [])
+      if len(idle) < self._max_idle:
+        idle.append((connection, time.time()))
+        return
+    connection.close()
+
+  def HasUploadCache(self, netloc):
+    """Returns True if the server has an upload cache, or None if unknown.
+
+    Args:
+      netloc: string server host:port.
+    """
+    with self._lock:
+      return self._has_upload_cache.get(netloc)
+
+  def SetHasUploadCache(self, netloc, has_upload_cache):
+    """Notes whether the server has an upload cache, e.g. after a response.
+
+    Args:
+      netloc: string server host:port.
+      has_upload_cache: bool.
+    """
+    with self._lock:
+      self._has_upload_cache[netloc] = has_upload_cache
+
+  def Close(self):
+    """Closes all idle connections."""
+    with self._lock:
+      idle, self._idle = self._idle, {}
+    for connections in idle.values():
+      for connection, _ in connections:
+        connection.close()
+
+
+# The default pool, shared by all clients.
+CONNECTION_POOL = ConnectionPool()
+
+
+class LabDeviceProxyAgent(object):
+  """A local agent that runs commands for CallAgent shims, via a Unix socket.
+
+  Each "adb" or "idevice*" call starts a new client, which would connect to
+  the server anew.  The agent instead runs every shim's command in its own
+  thread, via clients that share the agent's ConnectionPool, so calls reuse
+  warm connections to each server that they name.
+
+  The agent reads and writes files for its shims, so its socket is only
+  accessible by our user.
+  """
+
+  def __init__(self, socket_fn, connection_pool=None):
+    """Creates an agent.
+
+    Args:
+      socket_fn: string path of our Unix socket, e.g. GetAgentSocket().
+      connection_pool: optional ConnectionPool, defaults to the pool that's
+          shared by all clients in this process.
+    """
+    self._socket_fn = socket_fn
+    self._connection_pool = connection_pool
+    self._sock = None
+    self._is_stopped = False
+    self._lock = threading.Lock()  # Guards num_calls
+    self.num_calls = 0
+
+  def Start(self):
+    """Listens on our socket.
+
+    Raises:
+      ValueError: if another agent is already listening on it.
+    """
+    dn = os.path.dirname(self._socket_fn)
+    if dn and not os.path.isdir(dn):
+      os.makedirs(dn, 0700)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self._socket_fn)
+    except socket.error:
+      if os.path.exists(self._socket_fn):
+        os.remove(self._socket_fn)  # From an agent that was killed
+    else:
+      raise ValueError('An agent is already running: %s' % self._socket_fn)
+    finally:
+      sock.close()
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0077)
+    try:
+      self._sock.bind(self._socket_fn)
+    finally:
+      os.umask(old_umask)
+    self._sock.listen(socket.SOMAXCONN)
+
+  def Serve(self):
+    """Serves shims until we're stopped, starting us if needed."""
+    if self._sock is None:
+      self.Start()
+    try:
+      while True:
+        conn, _ = self._sock.accept()
+        if self._is_stopped:
+          conn.close()
+          break
+        thread = threading.Thread(target=self._Handle, args=(conn,))
+        thread.daemon = True
+        thread.start()
+    finally:
+      self._sock.close()
+      os.remove(self._socket_fn)
+
+  def Stop(self):
+    """Stops serving new shims, e.g. from another thread."""
+    self._is_stopped = True
+    # Wake up our accept
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self._socket_fn)
+    except socket.error:
+      pass
+    sock.close()
+
+  def _Handle(self, conn):
+    """Runs a shim's command and sends back its output and exit code.
+
+    Args:
+      conn: socket.socket, connected to the shim.
+    """
+    lock = threading.Lock()
+    stdout = _AgentStream(conn, '1', lock)
+    stderr = _AgentStream(conn, '2', lock)
+    try:
+      from_stream = conn.makefile('rb')
+      num_bytes = struct.unpack('!I', ReadExactly(from_stream, 4))[0]
+      fields = ReadExactly(from_stream, num_bytes).split('\0')
+      params = None
+      if len(fields) > 6 and fields[0] == AGENT_VERSION:
+        cwd, url, priority, compression, is_timed = fields[1:6]
+        if ((not priority or priority in PRIORITIES) and
+            (not compression or compression in COMPRESSIONS)):
+          try:
+            params = PARSER.parse_args(fields[6:])
+          except ValueError:
+            pass
+      if params is None:
+        # The shim reports the error, as it would without an agent.
+        _AgentStream(conn, 'r', lock).write('')
+        return
+      with self._lock:
+        self.num_calls += 1
+      for param in params:
+        if isinstance(param, (InputFileParameter, OutputFileParameter)):
+          param.value = os.path.join(cwd, param.value)
+      exit_code = 1
+      client = None
+      try:
+        client = LabDeviceProxyClient(
+            url, stdout, stderr, connection_pool=self._connection_pool,
+            priority=(priority or None), compression=(compression or None))
+        exit_code = client.Call(*params)
+      except:  # pylint: disable=bare-except
+        stderr.write(GetStack())
+      if is_timed and client and client.last_timing:
+        stderr.write(client.last_timing.Format())
+      _AgentStream(conn, 'x', lock).write(str(exit_code))
+    except (socket.error, ValueError):
+      pass  # The shim exited, e.g. on Ctrl-C
+    finally:
+      conn.close()
+
+
+class _AgentStream(object):
+  """A file object that sends its writes to a shim, as CallAgent frames."""
+
+  def __init__(self, conn, kind, lock):
+    self._conn = conn
+    self._kind = kind
+    self._lock = lock  # Shared by the shim's streams
+
+  def write(self, data):  # pylint: disable=g-bad-name
+    with self._lock:
+      self._conn.sendall(self._kind + struct.pack('!I', len(data)) + data)
+
 
 #
 # THE REST IS SHARED CLIENT & SERVER CODE
@@ -283,16 +1350,38 @@ class InputFileParameter(Parameter):
   "adb install INPUT_APK".
   """
 
-  def SendTo(self, to_stream):
+  def __init__(self, value):
+    super(InputFileParameter, self).__init__(value)
+    self._digest = None
+
+  def GetDigest(self):
+    """Returns the SHA-1 hex digest of our input file, or None if too small."""
+    if self._digest is None and os.path.isfile(self.value):
+      if os.path.getsize(self.value) >= MIN_CACHED_SIZE:
+        self._digest = GetFileDigest(self.value)
+    return self._digest
+
+  def SendTo(self, to_stream, digest_only=False, compression=None):
     """Sends a chunked input file to the server.
 
     Args:
       to_stream: A socket.socket or a file object (e.g. StringIO buffer).
+      digest_only: bool, if the file is at least MIN_CACHED_SIZE then only
+          send its digest, for the server to look up in its upload cache.
+      compression: optional string, one of COMPRESSIONS, for a directory's
+          tar.
     """
     in_fn = self.value
     header = ChunkHeader('i%d' % self.index)
     header.in_ = os.path.basename(in_fn)
     if os.path.isfile(in_fn):
+      # Include the digest even when we send the content, so the server can
+      # add the file to its upload cache.
+      header.digest_ = self.GetDigest()
+      if header.digest_ and digest_only:
+        header.is_cached_ = True
+        SendChunk(header, None, to_stream)
+        return
       # We could send this as a tar, as noted below.
       #   Pros: simplified code, preserves file attributes, compressed.
       #   Cons: server must support tars, added tar header/block data.
@@ -306,7 +1395,8 @@ class InputFileParameter(Parameter):
             data = file_object.read(MAX_READ)
     elif os.path.exists(in_fn):
       header.is_tar_ = True
-      SendTar(in_fn, os.path.basename(in_fn) + '/', header, to_stream)
+      SendTar(in_fn, os.path.basename(in_fn) + '/', header, to_stream,
+              compression)
     else:
       header.is_absent_ = True
       SendChunk(header, None, to_stream)
@@ -322,14 +1412,17 @@ class OutputFileParameter(Parameter):
   "adb pull foo OUTPUT_PATH".
   """
 
-  def SendTo(self, to_stream):
+  def SendTo(self, to_stream, compression=None):
     """Sends a chunked output-file placeholder to the server.
 
     Args:
       to_stream: A socket.socket or a file object (e.g. StringIO buffer).
+      compression: optional string, one of COMPRESSIONS, for the server to
+          use if it returns a tar.
     """
     out_fn = self.value
     header = ChunkHeader('o%d' % self.index)
+    header.compression_ = compression
     if os.path.isdir(out_fn):
       header.is_tar_ = True
       header.out_ = '.'
@@ -350,7 +1443,8 @@ class ParameterNamespace(argparse.Namespace):
 
   def __init__(self, params=None):
     super(ParameterNamespace, self).__init__()
-    self.params = (params if params is not None else [])
+    super(ParameterNamespace, self).__setattr__(
+        'params', (params if params is not None else []))
 
   def _Append(self, value):
     param = (value if isinstance(value, Parameter) else Parameter(value))
@@ -358,6 +1452,11 @@ class ParameterNamespace(argparse.Namespace):
     self.params.append(param)
 
   def __setattr__(self, name, value):
+    if isinstance(value, SubParameters):
+      # A sub-parser's params, already in order.
+      for v in value:
+        self._Append(v)
+      return
     super(ParameterNamespace, self).__setattr__(name, value)
     if name and name[0] == '_':
       # Restore _l/__list back to -l/--list
@@ -370,6 +1469,29 @@ class ParameterNamespace(argparse.Namespace):
       self._Append(value)
 
 
+class SubParameters(list):
+  """A sub-parser's ordered list of parameters.
+
+  Newer argparse versions (2.7.9+) parse each sub-command into a fresh
+  Namespace and then copy its attributes into ours, in arbitrary dict order.
+  Our sub-parsers instead return their params as a single SubParameters
+  attribute, which ParameterNamespace appends in the original order.
+  """
+  pass
+
+
+class _ArgumentParser(argparse.ArgumentParser):
+  """An ArgumentParser that preserves the sub-parser parameter order."""
+
+  def parse_known_args(self, args=None, namespace=None):  # pylint: disable=g-bad-name
+    if namespace is not None:
+      return super(_ArgumentParser, self).parse_known_args(args, namespace)
+    params = SubParameters()
+    _, args = super(_ArgumentParser, self).parse_known_args(
+        args, ParameterNamespace(params))
+    return argparse.Namespace(params=params), args
+
+
 class ParameterDecl(object):
   """A ParameterParser.AddParameter value."""
 
@@ -379,31 +1501,60 @@ class ParameterDecl(object):
 
 
 class ParameterParser(object):
-  """An argparse wrapper that saves the parameter order."""
+  """An argparse wrapper that saves the parameter order.
+
+  The argparse parser is built on first use, so a client only builds the
+  parsers of the command that it runs.
+  """
 
   def __init__(self, prog, *decls, **kwargs):
-    m = kwargs
-    if 'add_help' not in m:
-      m['add_help'] = False
-    self.p = argparse.ArgumentParser(prog=prog, **m)
-    for decl in decls:
-      self.AddParameter(*decl.args, **decl.kwargs)
+    self.prog = prog
+    self._decls = list(decls)
+    self._subparsers = None  # List of ParameterParsers, from AddSubparsers
+    self._kwargs = kwargs
+    self._p = None  # _ArgumentParser
+
+  @property
+  def p(self):  # pylint: disable=invalid-name
+    """Returns our _ArgumentParser, which is built on first use."""
+    if self._p is None:
+      m = self._kwargs
+      if 'add_help' not in m:
+        m['add_help'] = False
+      p = _ArgumentParser(prog=self.prog, **m)
+      for decl in self._decls:
+        self._AddArgument(p, *decl.args, **decl.kwargs)
+      if self._subparsers is not None:
+        def GetParser(**kwargs):
+          return kwargs['parser']
+        sp = p.add_subparsers(parser_class=GetParser, dest='command')
+        for parser in self._subparsers:
+          sp.add_parser(parser.prog, parser=parser.p)
+      self._p = p
+    return self._p
 
   def AddSubparsers(self, *args):
-    def GetParser(**kwargs):
-      return kwargs['parser']
-    sp = self.p.add_subparsers(parser_class=GetParser, dest='command')
-    for parser in args:
-      sp.add_parser(parser.p.prog, parser=parser.p)
+    """Adds sub-command parsers and returns self."""
+    if self._p is not None or self._subparsers is not None:
+      raise ValueError('Sub-parsers must be added once, before first use')
+    self._subparsers = list(args)
     return self
 
   def AddParameter(self, *args, **kwargs):
     """Adds a parameter and returns self."""
-    m = kwargs
+    if self._p is not None:
+      self._AddArgument(self._p, *args, **kwargs)
+    self._decls.append(ParameterDecl(*args, **kwargs))
+    return self
+
+  @staticmethod
+  def _AddArgument(p, *args, **kwargs):
+    """Adds a parameter to an _ArgumentParser."""
+    m = dict(kwargs)
     if 'default' not in m:
       m['default'] = argparse.SUPPRESS
     if 'dest' in m:
-      self.p.add_argument(*args, **m)
+      p.add_argument(*args, **m)
     else:
       for arg in args:
         if 'dest' in m:
@@ -411,8 +1562,7 @@ class ParameterParser(object):
         if arg[0] == '-':
           # Rename -l/--list to _l/__list, to preserve the '-/--' prefix
           m['dest'] = '_%s%s' % ('_' if arg[1] == '-' else arg[1], arg[2:])
-        self.p.add_argument(arg, **m)
-    return self
+        p.add_argument(arg, **m)
 
   def parse_args(self, args, namespace=None):  # pylint: disable=g-bad-name
     ret = []
@@ -425,6 +1575,47 @@ class ParameterParser(object):
     return ret
 
 
+class CommandParser(object):
+  """Our top-level parser, which accepts any of its commands.
+
+  It only builds the parser of the command that it's asked to parse, i.e.
+  args[0], e.g. "adb", rather than the parsers of every command.
+  """
+
+  def __init__(self, *parsers):
+    """Creates the parser.
+
+    Args:
+      *parsers: ParameterParsers, one per command, e.g. for "adb".
+    """
+    self._parsers = list(parsers)
+    self._roots = {}  # args[0], or None if unknown -> ParameterParser
+    self._lock = threading.Lock()  # The server's threads share our PARSER
+
+  def parse_args(self, args):  # pylint: disable=g-bad-name
+    """Parses a command, as ParameterParser.parse_args does.
+
+    Args:
+      args: List of strings, e.g. ['adb', 'devices'].
+    Returns:
+      List of Parameters.
+    Raises:
+      ValueError: if the command is invalid.
+    """
+    parsers = [parser for parser in self._parsers
+               if args and parser.prog == args[0]]
+    name = (args[0] if parsers else None)
+    with self._lock:
+      root = self._roots.get(name)
+      if root is None:
+        # An unknown command gets every command's parser, so argparse's
+        # error lists them.
+        root = ParameterParser(None).AddSubparsers(*(parsers or self._parsers))
+        root.p  # pylint: disable=pointless-statement
+        self._roots[name] = root
+    return root.parse_args(args)
+
+
 class DAction(argparse.Action):
   """An argparse action that concatenates "-D" "x=y" to "-Dx=y"."""
 
@@ -436,7 +1627,7 @@ def _CreateParser():
   """Creates our parameter parser, which accepts a restricted set of commands.
 
   Returns:
-     A new ParameterParser.
+     A new CommandParser.
   """
 
   idevice_app_runner = ParameterParser(
@@ -614,18 +1805,11 @@ def _CreateParser():
       ParameterDecl('-s', type=AndroidSerialParameter))
   adb_parser.AddSubparsers(*adb_parsers)
 
-  parser = ParameterParser(None)
-  parser.AddSubparsers(adb_parser, *idevice_parser)
-
-  return parser
+  return CommandParser(adb_parser, *idevice_parser)
 
 
-# Must be defined after _CreateParser().
-#
-# We could define this at the top of our file, but only if we wrap it to defer
-# the eval to first use, e.g.:
-#   PARSER = LazyProxy(lambda: _CreateParser())  # intercept __getattribute__
-# but that's more confusing than it's worth.
+# Must be defined after _CreateParser().  Its argparse parsers are built on
+# first use, per command.
 PARSER = _CreateParser()
 
 
@@ -642,9 +1826,13 @@ class ChunkHeader(object):
   def __init__(self, id_=None):
     self.len_ = None
     self.id_ = id_
+    self.cmd_ = None
     self.in_ = None
     self.out_ = None
+    self.compression_ = None
+    self.digest_ = None
     self.is_absent_ = None
+    self.is_cached_ = None
     self.is_empty_ = None
     self.is_tar_ = None
 
@@ -659,34 +1847,56 @@ class ChunkHeader(object):
         raise ValueError('Missing "\\r\\n" suffix')
       len_and_csv = line[:-2].split(';', 1)
       if len(len_and_csv) > 1:
-        for item in len_and_csv[1].split(','):
-          k, v = item.strip().split('=', 1)
-          self._Validate(k, v)
-          k += '_'  # Add our suffix
-          if not hasattr(self, k):
-            pass  # Ignore unknown keys
-          if k.startswith('is_'):
-            # Parse 'false' to False, not bool('false')
-            v = ('true' == v.lower())
-          setattr(self, k, v)
+        self.ParseFields(len_and_csv[1])
       self.len_ = max(0, int(len_and_csv[0].strip(), 16))
     except:
       raise ValueError('Invalid chunk header: %s', line)
 
+  def ParseFields(self, csv):
+    """Parses formatted fields.
+
+    Args:
+      csv: a string, e.g. 'id=3,out=q'
+    """
+    for item in csv.split(','):
+      k, v = item.strip().split('=', 1)
+      self._Validate(k, v)
+      k += '_'  # Add our suffix
+      if not hasattr(self, k):
+        pass  # Ignore unknown keys
+      if k.startswith('is_'):
+        # Parse 'false' to False, not bool('false')
+        v = ('true' == v.lower())
+      setattr(self, k, v)
+
   def Format(self):
     """Format the header into a Parse-able string.
 
     Returns:
       string, e.g. 'A;id=3,out=q\\r\\n'.
     """
+    return '%X;%s\r\n' % (self.len_, self.FormatFields())
+
+  def FormatFields(self, keys=None):
+    """Formats our fields into a ParseFields-able string.
+
+    Args:
+      keys: optional list of field names to format, e.g. ['in_'], defaults
+          to all of our fields except len_.
+    Returns:
+      string, e.g. 'id=3,out=q'.
+    """
+    if keys is None:
+      items = sorted(vars(self).iteritems())
+    else:
+      items = [(k, getattr(self, k)) for k in keys]
     ret = ''
-    for k, v in sorted(vars(self).iteritems()):
+    for k, v in items:
       if v is not None and k[-1] == '_' and k != 'len_':
         k = k[:-1]  # Remove our suffix
         v = str(v)
         self._Validate(k, v)
         ret += '%s%s=%s' % (',' if ret else '', k, v)
-    ret = '%X;%s\r\n' % (self.len_, ret)
     return ret
 
   def _Validate(self, key, value):
@@ -718,26 +1928,320 @@ class ChunkHeader(object):
     return self.Format()[:-2]
 
 
-def SendChunk(header, data, to_stream):
+class TextFraming(object):
+  """Our original chunk framing, which is HTTP/1.1 chunked encoding.
+
+  Each chunk is "LEN;k=v,...\r\nDATA\r\n", with the ChunkHeader fields as
+  chunk extensions, and an empty chunk ends the body.
+  """
+
+  EMPTY_DATA = '-'  # Dummy data, since an empty chunk would end the body
+  TRAILER = '\r\n'
+  END = '0\r\n\r\n'
+
+  def FormatHeader(self, header):
+    return header.Format()
+
+  def ReadHeader(self, from_stream):
+    """Reads a chunk header.
+
+    Args:
+      from_stream: stream to read from
+    Returns:
+      A ChunkHeader, or None at the end of the chunks.
+    Raises:
+      ValueError: if the header is invalid.
+    """
+    header = ChunkHeader()
+    header.Parse(from_stream.readline())
+    if header.len_ <= 0:
+      # Read the empty trailer, so the connection can be reused.
+      if from_stream.readline() != '\r\n':
+        raise ValueError('Response does not end with crlf')
+      return None
+    return header
+
+  def ReadTrailer(self, from_stream):
+    if ReadExactly(from_stream, 2) != '\r\n':
+      raise ValueError('Chunk does not end with crlf')
+
+
+class BinaryFraming(object):
+  """A compact chunk framing, which clients request via FRAMING_HEADER.
+
+  Each frame is a fixed header, its id, its other fields, then its data:
+    uint32 data length
+    uint16 "cmd" index, or NO_CMD
+    uint8  flags, see FLAGS
+    uint8  id length
+    uint16 fields length, e.g. of "out=foo.txt", usually 0
+  in network byte order.  Unlike TextFraming, an empty frame has no data
+  and there's no trailer, and an END flag ends the body.
+  """
+
+  VERSION = '2'
+  STRUCT = struct.Struct('!IHBBH')
+  NO_CMD = 0xFFFF
+  END_FLAG = 0x80
+  FLAGS = (('is_absent_', 0x01), ('is_cached_', 0x02), ('is_empty_', 0x04),
+           ('is_tar_', 0x08))
+  FIELDS = ['compression_', 'digest_', 'in_', 'out_']  # Formatted as text
+
+  EMPTY_DATA = ''
+  TRAILER = ''
+  END = STRUCT.pack(0, NO_CMD, END_FLAG, 0, 0)
+
+  def FormatHeader(self, header):
+    flags = 0
+    for name, flag in self.FLAGS:
+      if getattr(header, name):
+        flags |= flag
+    fields = ''
+    if (header.in_ is not None or header.out_ is not None or
+        header.digest_ is not None or header.compression_ is not None):
+      fields = header.FormatFields(self.FIELDS)
+    id_ = str(header.id_)
+    return ''.join((self.STRUCT.pack(
+        header.len_, (self.NO_CMD if header.cmd_ is None else
+                      int(header.cmd_)), flags, len(id_), len(fields)),
+                    id_, fields))
+
+  def ReadHeader(self, from_stream):
+    """Reads a frame header.
+
+    Args:
+      from_stream: stream to read from
+    Returns:
+      A ChunkHeader, or None at the end of the frames.
+    Raises:
+      ValueError: if the header is invalid.
+    """
+    len_, cmd, flags, id_len, fields_len = self.STRUCT.unpack(
+        ReadExactly(from_stream, self.STRUCT.size))
+    if flags & self.END_FLAG:
+      return None
+    header = ChunkHeader(ReadExactly(from_stream, id_len))
+    header.len_ = len_
+    if cmd != self.NO_CMD:
+      header.cmd_ = str(cmd)
+    for name, flag in self.FLAGS:
+      if flags & flag:
+        setattr(header, name, True)
+    if fields_len:
+      header.ParseFields(ReadExactly(from_stream, fields_len))
+    return header
+
+  def ReadTrailer(self, unused_from_stream):
+    pass
+
+
+TEXT_FRAMING = TextFraming()
+BINARY_FRAMING = BinaryFraming()
+
+
+class FramedStream(object):
+  """A stream wrapper that sends its chunks in the given framing."""
+
+  def __init__(self, to_stream, framing):
+    self._to_stream = to_stream
+    self.framing = framing
+    self.num_bytes = collections.defaultdict(int)  # Chunk id -> data size
+
+  def SendChunk(self, header, data, unused_framing=None):
+    self.num_bytes[header.id_] += len(data or '')
+    SendChunk(header, data, self._to_stream, self.framing)
+
+  def SendFileChunk(self, header, fp, num_bytes, unused_framing=None):
+    is_sent = SendFileChunk(header, fp, num_bytes, self._to_stream,
+                            self.framing)
+    if is_sent:
+      self.num_bytes[header.id_] += num_bytes
+    return is_sent
+
+  def SendEnd(self, unused_framing=None):
+    SendEnd(self._to_stream, self.framing)
+
+  def flush(self):  # pylint: disable=invalid-name
+    self._to_stream.flush()
+
+
+def SendChunk(header, data, to_stream, framing=None):
   """Sends a header and chunked data to the given stream.
 
   Args:
     header: A ChunkHeader, may be modified.
     data: Optional chunk content.
     to_stream: A socket.socket or a file object (e.g. StringIO buffer).
+    framing: Optional TextFraming or BinaryFraming, defaults to TextFraming.
   """
+  send_chunk = getattr(to_stream, 'SendChunk', None)
+  if send_chunk is not None:
+    # E.g. a BatchCommandStream
+    send_chunk(header, data, framing)
+    return
+
+  framing = (framing or TEXT_FRAMING)
   send = getattr(to_stream, 'send', None)
   if send is None:
     send = getattr(to_stream, 'write')
 
   if not data:
-    # Send dummy data -- anything with length > 0
     header.is_empty_ = True
-    data = '-'
+    data = framing.EMPTY_DATA
   header.len_ = len(data)
-  send(header.Format())
-  send(data)
-  send('\r\n')
+  if len(data) <= JOIN_SIZE:
+    # One write, so the chunk isn't split into several small packets.  Python
+    # 2.7 lacks a vectored socket write, but the copy is cheaper than the
+    # extra syscalls.
+    send(''.join((framing.FormatHeader(header), data, framing.TRAILER)))
+  else:
+    send(framing.FormatHeader(header))
+    send(data)
+    if framing.TRAILER:
+      send(framing.TRAILER)
+
+
+def SendEnd(to_stream, framing=None):
+  """Sends the end of the chunks to the given stream.
+
+  Args:
+    to_stream: A socket.socket or a file object (e.g. StringIO buffer).
+    framing: Optional TextFraming or BinaryFraming, defaults to TextFraming.
+  """
+  send_end = getattr(to_stream, 'SendEnd', None)
+  if send_end is not None:
+    send_end(framing)
+    return
+  to_stream.write((framing or TEXT_FRAMING).END)
+
+
+def SendFileChunk(header, fp, num_bytes, to_stream, framing=None):
+  """Sends a header and the next num_bytes of a file as a single chunk.
+
+  The kernel copies the data from the file to the socket via sendfile, so we
+  don't read it into Python strings.
+
+  Args:
+    header: A ChunkHeader, may be modified.
+    fp: A file object, positioned at the data to send.
+    num_bytes: int data length, > 0.
+    to_stream: A socket.socket or socket file object.
+    framing: Optional TextFraming or BinaryFraming, defaults to TextFraming.
+  Returns:
+    True if the chunk was sent, or False (with nothing sent) if we can't use
+    sendfile, in which case the caller should use SendChunk.
+  Raises:
+    IOError: if the file is shorter than expected.
+  """
+  send_file_chunk = getattr(to_stream, 'SendFileChunk', None)
+  if send_file_chunk is not None:
+    # E.g. a BatchCommandStream
+    return send_file_chunk(header, fp, num_bytes, framing)
+
+  sendfile = GetSendfile()
+  if sendfile is None or not hasattr(to_stream, 'fileno'):
+    return False
+
+  send = getattr(to_stream, 'send', None)
+  if send is None:
+    send = getattr(to_stream, 'write')
+
+  framing = (framing or TEXT_FRAMING)
+  header.len_ = num_bytes
+  send(framing.FormatHeader(header))
+  if hasattr(to_stream, 'flush'):
+    to_stream.flush()
+  out_fd = to_stream.fileno()
+  offset = fp.tell()
+  end_offset = offset + num_bytes
+  while offset < end_offset:
+    try:
+      sent = sendfile(out_fd, fp.fileno(), offset, end_offset - offset)
+    except OSError, e:
+      if e.errno == errno.EINTR:
+        continue
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        select.select([], [out_fd], [])  # E.g. a socket with a timeout
+        continue
+      raise
+    if not sent:
+      raise IOError('Unexpected end of file: %s' % fp.name)
+    offset += sent
+  fp.seek(offset)
+  if framing.TRAILER:
+    send(framing.TRAILER)
+  return True
+
+
+def GetSendfile():
+  """Returns a sendfile(out_fd, in_fd, offset, count) function, or None.
+
+  The function returns the number of bytes sent, or raises an OSError.
+  """
+  if not USE_SENDFILE:
+    return None
+  if not _SENDFILE:
+    _SENDFILE.append(_LoadSendfile())
+  return _SENDFILE[0]
+
+
+def _LoadSendfile():
+  """Loads the platform's sendfile function, if it has a compatible one."""
+  sendfile = getattr(os, 'sendfile', None)  # Python 3.3+
+  if sendfile is not None:
+    return sendfile
+  if not sys.platform.startswith('linux'):
+    return None  # E.g. OS X's sendfile only sends to sockets, with more args
+  try:
+    # pylint: disable=g-import-not-at-top
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    c_sendfile = libc.sendfile64
+  except (AttributeError, ImportError, OSError):
+    return None
+  c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+  c_sendfile.restype = ctypes.c_ssize_t
+
+  def Sendfile(out_fd, in_fd, offset, count):
+    c_offset = ctypes.c_int64(offset)
+    sent = c_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+    if sent < 0:
+      error = ctypes.get_errno()
+      raise OSError(error, os.strerror(error))
+    return sent
+
+  return Sendfile
+
+_SENDFILE = []  # The cached GetSendfile function
+
+
+def GetCompressionPool():
+  """Returns the ThreadPool that GzipBlockWriters share.
+
+  Returns:
+    A (ThreadPool, int num_threads) tuple.  The ThreadPool is None if we'd
+    only have one thread, in which case the caller should compress inline.
+  """
+  with _COMPRESSION_POOL_LOCK:
+    if not _COMPRESSION_POOL:
+      import multiprocessing.pool  # pylint: disable=g-import-not-at-top
+      num_threads = COMPRESSION_THREADS
+      if num_threads <= 0:
+        try:
+          num_threads = multiprocessing.cpu_count()
+        except NotImplementedError:
+          num_threads = 1
+      _COMPRESSION_POOL.append((
+          multiprocessing.pool.ThreadPool(num_threads) if num_threads > 1 else
+          None, num_threads))
+    return _COMPRESSION_POOL[0]
+
+
+_COMPRESSION_POOL = []  # The cached GetCompressionPool pool
+_COMPRESSION_POOL_LOCK = threading.Lock()
 
 
 def ReadExactly(from_stream, num_bytes):
@@ -746,13 +2250,28 @@ def ReadExactly(from_stream, num_bytes):
   bytes_read = 0
   while bytes_read < num_bytes:
     data = from_stream.read(min(MAX_READ, num_bytes - bytes_read))
+    if not data:
+      raise ValueError('Unexpected end of stream')
     bytes_read += len(data)
     pieces.append(data)
   return ''.join(pieces)
 
 
+def GetFileDigest(fn):
+  """Returns the SHA-1 hex digest of a file's content."""
+  digest = hashlib.sha1()
+  with open(fn, 'rb') as fp:
+    while True:
+      data = fp.read(MAX_READ * 8)
+      if not data:
+        break
+      digest.update(data)
+  return digest.hexdigest()
+
+
 def GetStack():
   # Get full_stack; see http://stackoverflow.com/questions/6086976
+  import traceback  # pylint: disable=g-import-not-at-top
   trc = 'Traceback (most recent call last):\n'
   stackstr = (
       trc + ''.join(traceback.format_list(
@@ -761,6 +2280,25 @@ def GetStack():
   return stackstr
 
 
+class BatchCommandStream(object):
+  """A stream wrapper that tags each chunk with its batch command index."""
+
+  def __init__(self, to_stream, cmd_index):
+    self._to_stream = to_stream
+    self._cmd_index = cmd_index
+
+  def SendChunk(self, header, data, framing=None):
+    header.cmd_ = self._cmd_index
+    SendChunk(header, data, self._to_stream, framing)
+
+  def SendFileChunk(self, header, fp, num_bytes, framing=None):
+    header.cmd_ = self._cmd_index
+    return SendFileChunk(header, fp, num_bytes, self._to_stream, framing)
+
+  def flush(self):  # pylint: disable=invalid-name
+    self._to_stream.flush()
+
+
 class ChunkedOutputStream(object):
   """A chunked writer."""
 
@@ -779,7 +2317,68 @@ class ChunkedOutputStream(object):
     pass
 
 
-def SendTar(from_fn, to_arcname, header, to_stream):
+class CoalescingOutputStream(ChunkedOutputStream):
+  """A chunked writer that batches small writes into fewer, larger chunks.
+
+  Written data is buffered until it reaches max_size bytes or the oldest data
+  is max_delay seconds old.  The caller must call SendDue once GetTimeout
+  seconds have passed, and flush or close the stream when it's done.
+  """
+
+  def __init__(self, header, to_stream, max_delay=None, max_size=None):
+    """Creates a stream.
+
+    Args:
+      header: ChunkHeader
+      to_stream: stream to write to
+      max_delay: optional float seconds, defaults to COALESCE_DELAY
+      max_size: optional int bytes, defaults to COALESCE_SIZE
+    """
+    super(CoalescingOutputStream, self).__init__(header, to_stream)
+    self._max_delay = (max_delay if max_delay is not None else COALESCE_DELAY)
+    self._max_size = (max_size if max_size is not None else COALESCE_SIZE)
+    self._buf = []
+    self._buf_len = 0
+    self._send_time = None  # When our buffered data is due
+
+  def write(self, buf):  # pylint: disable=g-bad-name
+    if not buf:
+      return
+    if not self._buf:
+      self._send_time = time.time() + self._max_delay
+    self._buf.append(buf)
+    self._buf_len += len(buf)
+    if self._buf_len >= self._max_size or self._max_delay <= 0:
+      self._SendBuffer()
+
+  def GetTimeout(self):
+    """Returns the float seconds until SendDue, or None if nothing's buffered."""
+    if not self._buf:
+      return None
+    return max(0, self._send_time - time.time())
+
+  def SendDue(self):
+    """Sends our buffered data, if it's due."""
+    if self._buf and time.time() >= self._send_time:
+      self._SendBuffer()
+
+  def flush(self):  # pylint: disable=invalid-name
+    if self._buf:
+      self._SendBuffer()
+
+  def close(self):  # pylint: disable=invalid-name
+    self.flush()
+
+  def _SendBuffer(self):
+    data = ''.join(self._buf)
+    self._buf = []
+    self._buf_len = 0
+    self._send_time = None
+    SendChunk(self._header, data, self._to_stream)
+    self._to_stream.flush()
+
+
+def SendTar(from_fn, to_arcname, header, to_stream, compression=None):
   """Sends a tar to an output stream.
 
   Args:
@@ -787,49 +2386,282 @@ def SendTar(from_fn, to_arcname, header, to_stream):
     to_arcname: archive name.
     header: chunk header line.
     to_stream: A socket.socket or a file object (e.g. StringIO buffer).
+    compression: optional string, one of COMPRESSIONS, defaults to "auto".
   """
+  import tarfile  # pylint: disable=g-import-not-at-top
   tar_stream = ChunkedOutputStream(header, to_stream)
-  to_tar = tarfile.open(mode='w|gz', fileobj=tar_stream)
+  if compression != 'none':
+    tar_stream = GzipBlockWriter(tar_stream, compression or 'auto')
+  to_tar = tarfile.open(mode='w|', fileobj=tar_stream)
   # The from_fn has already been validated, so this is safe.
   to_tar.add(from_fn, arcname=to_arcname)
   to_tar.close()
+  tar_stream.close()
+
+
+class GzipBlockWriter(object):
+  """A gzip writer that compresses each block of data independently.
+
+  Each block is deflated by its own compressor and sync-flushed, so the
+  blocks form a single gzip stream that any gzip reader accepts, yet each
+  block may use a different compression level.
+
+  In "auto" mode we pick each block's level by compressing a sample of it at
+  the fast and best levels, then estimating which level (or none) would send
+  the block soonest, given our measured to_stream throughput.  E.g. APKs and
+  PNGs are already compressed, so they aren't worth compressing on a fast
+  link, but text is.
+
+  Since the blocks are independent, we compress them in parallel on the
+  GetCompressionPool threads, and send them in order.
+  """
+
+  BLOCK_SIZE = 1 << 20
+  SAMPLE_SIZE = 64 * 1024
+  LEVELS = {'none': 0, 'fast': 1, 'best': 9}
+
+  # Our initial throughput guess, as if we'd already sent this many bytes at
+  # 100MB/s, so our first few writes (into empty socket buffers) don't make
+  # the link look infinitely fast.
+  INITIAL_BYTES = 4 << 20
+  INITIAL_SECONDS = INITIAL_BYTES / 100e6
+
+  def __init__(self, to_stream, compression='auto'):
+    """Creates a writer.
+
+    Args:
+      to_stream: stream to write the gzip data to
+      compression: string, one of COMPRESSIONS other than "none"
+    """
+    self._to_stream = to_stream
+    self._compression = compression
+    self._buf = []
+    self._buf_len = 0
+    self._crc = zlib.crc32('')
+    self._size = 0
+    self._sent_bytes = self.INITIAL_BYTES
+    self._sent_seconds = self.INITIAL_SECONDS
+    self._is_closed = False
+    self._pool, num_threads = GetCompressionPool()
+    self._max_pending = 2 * num_threads  # Limits our blocks' memory
+    # (block, AsyncResult) of the blocks that are being compressed, in order
+    self._pending = collections.deque()
+    # A gzip header without a filename, mtime or flags
+    self._Send(struct.pack('<BBBBIBB', 0x1f, 0x8b, zlib.DEFLATED, 0, 0, 0,
+                           255))
+
+  def write(self, data):  # pylint: disable=g-bad-name
+    if not data:
+      return
+    self._buf.append(data)
+    self._buf_len += len(data)
+    if self._buf_len >= self.BLOCK_SIZE:
+      data = ''.join(self._buf)
+      num_blocks = len(data) // self.BLOCK_SIZE
+      for offset in range(0, num_blocks * self.BLOCK_SIZE, self.BLOCK_SIZE):
+        self._SubmitBlock(data[offset:offset + self.BLOCK_SIZE], False)
+      data = data[num_blocks * self.BLOCK_SIZE:]
+      self._buf = ([data] if data else [])
+      self._buf_len = len(data)
+
+  def flush(self):  # pylint: disable=invalid-name
+    pass
+
+  def close(self):  # pylint: disable=invalid-name
+    """Writes the final block and the gzip trailer."""
+    if self._is_closed:
+      return
+    self._is_closed = True
+    self._SubmitBlock(''.join(self._buf), True)
+    self._buf = []
+    self._SendBlocks(0)
+    self._Send(struct.pack('<II', self._crc & 0xffffffff,
+                           self._size & 0xffffffff))
+
+  def _SubmitBlock(self, data, is_last):
+    """Compresses a block, then sends the blocks that are ready.
+
+    Args:
+      data: string
+      is_last: bool, True to end the deflate stream
+    """
+    if self._pool is None:
+      self._SendBlock(data, self._CompressBlock(data, is_last))
+      return
+    self._pending.append(
+        (data, self._pool.apply_async(self._CompressBlock, (data, is_last))))
+    self._SendBlocks(self._max_pending)
+
+  def _SendBlocks(self, max_pending):
+    """Sends our compressed blocks, in order.
+
+    Args:
+      max_pending: int, wait for blocks until at most this many are pending
+    """
+    while self._pending and (len(self._pending) > max_pending or
+                             self._pending[0][1].ready()):
+      data, result = self._pending.popleft()
+      self._SendBlock(data, result.get())
+
+  def _CompressBlock(self, data, is_last):
+    """Returns a block's deflate data, called by our pool's threads.
+
+    Args:
+      data: string
+      is_last: bool, True to end the deflate stream
+    """
+    level = self._GetLevel(data)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+
+  def _SendBlock(self, data, compressed_data):
+    self._Send(compressed_data)
+    self._crc = zlib.crc32(data, self._crc)
+    self._size += len(data)
+
+  def _GetLevel(self, data):
+    """Returns the zlib compression level for a block.
+
+    Args:
+      data: string block
+    Returns:
+      int level
+    """
+    if self._compression != 'auto':
+      return self.LEVELS[self._compression]
+    sample = data[:self.SAMPLE_SIZE]
+    if not sample:
+      return self.LEVELS['fast']
+    # Estimate the seconds per sample byte to compress then send it.
+    seconds_per_byte = self._sent_seconds / self._sent_bytes
+    best_level = self.LEVELS['none']
+    best_cost = seconds_per_byte
+    for name in ('fast', 'best'):
+      start_time = time.time()
+      compressor = zlib.compressobj(self.LEVELS[name], zlib.DEFLATED,
+                                    -zlib.MAX_WBITS)
+      ratio = float(len(compressor.compress(sample) +
+                        compressor.flush())) / len(sample)
+      cost = ((time.time() - start_time) / len(sample) +
+              ratio * seconds_per_byte)
+      if cost < best_cost:
+        best_level = self.LEVELS[name]
+        best_cost = cost
+      elif name == 'fast':
+        break  # If fast doesn't pay off, best won't either
+    return best_level
+
+  def _Send(self, data):
+    """Writes data to our stream, and measures its throughput."""
+    start_time = time.time()
+    self._to_stream.write(data)
+    self._sent_seconds += time.time() - start_time
+    self._sent_bytes += len(data)
 
 
 class UntarPipe(object):
-  """A pipe from the Response stream to the UntarThread reader."""
+  """A bounded pipe from the Response stream to the UntarThread reader.
 
-  def __init__(self):
+  The data is held in a fixed-capacity ring buffer, so if the reader falls
+  behind, e.g. writing files to a slow disk, then write blocks until there's
+  room, rather than buffering the whole tar in memory.
+  """
+
+  CAPACITY = 4 << 20
+
+  def __init__(self, capacity=None):
     self.cv = threading.Condition()
-    self.buf = []
+    self._ring = bytearray(capacity or self.CAPACITY)
+    self._view = memoryview(self._ring)
+    self._start = 0  # Offset of our oldest unread byte
+    self._len = 0  # Number of unread bytes
     self.closed = False
+    self.is_reader_done = False
+    self.reader = None  # Thread that we join on close, e.g. an UntarThread
+    # Stats
+    self.high_water = 0  # Most unread bytes at once
+    self.num_full_waits = 0  # Number of writes that waited for room
 
   def write(self, data):  # pylint: disable=g-bad-name
     """Writes data, called by the Response stream."""
+    data = memoryview(data)
+    offset = 0
     with self.cv:
       if self.closed:
         raise RuntimeError('closed')
-      self.buf.append(data)
-      if len(self.buf) == 1:
-        self.cv.notify()
+      while offset < len(data):
+        if self.is_reader_done:
+          return  # E.g. the trailing padding after the end of the tar
+        capacity = len(self._ring)
+        if self._len == capacity:
+          self.num_full_waits += 1
+          self.cv.wait()
+          continue
+        end = (self._start + self._len) % capacity
+        num_bytes = min(len(data) - offset, capacity - self._len,
+                        capacity - end)
+        self._view[end:end + num_bytes] = data[offset:offset + num_bytes]
+        offset += num_bytes
+        self._len += num_bytes
+        self.high_water = max(self.high_water, self._len)
+        self.cv.notify_all()
 
   def read(self, max_bytes):  # pylint: disable=g-bad-name
     """Reads at most max_bytes, called by the UntarThread."""
     with self.cv:
-      while not self.buf:
-        if self.closed:
-          return ''
-        self.cv.wait()
-      if len(self.buf[0]) <= max_bytes:
-        return self.buf.pop(0)
-      ret = self.buf[0][:max_bytes]
-      self.buf[0] = self.buf[0][max_bytes:]
+      view = self._Peek(max_bytes)
+      ret = view.tobytes()
+      self._Consume(len(ret))
       return ret
 
+  def readinto(self, buf):  # pylint: disable=g-bad-name
+    """Reads into a bytearray, without an intermediate string.
+
+    Args:
+      buf: bytearray or other writable buffer
+    Returns:
+      The number of bytes read, 0 at the end of the pipe.
+    """
+    with self.cv:
+      view = self._Peek(len(buf))
+      memoryview(buf)[:len(view)] = view
+      self._Consume(len(view))
+      return len(view)
+
+  def _Peek(self, max_bytes):
+    """Waits for data, then returns a view of our next unread bytes.
+
+    Args:
+      max_bytes: int
+    Returns:
+      A memoryview, empty at the end of the pipe.
+    """
+    while not self._len and not self.closed:
+      self.cv.wait()
+    num_bytes = min(max_bytes, self._len, len(self._ring) - self._start)
+    return self._view[self._start:self._start + num_bytes]
+
+  def _Consume(self, num_bytes):
+    if num_bytes:
+      self._start = (self._start + num_bytes) % len(self._ring)
+      self._len -= num_bytes
+      self.cv.notify_all()
+
+  def CloseReader(self):
+    """Notes that our reader is done, so we'll discard any further data."""
+    with self.cv:
+      self.is_reader_done = True
+      self.cv.notify_all()
+
   def close(self):  # pylint: disable=g-bad-name
+    """Closes the pipe, then waits for the reader to finish."""
     with self.cv:
       if not self.closed:
         self.closed = True
-        self.cv.notify()
+        self.cv.notify_all()
+    if self.reader and self.reader is not threading.current_thread():
+      self.reader.join()
 
 
 class UntarThread(threading.Thread):
@@ -845,10 +2677,18 @@ class UntarThread(threading.Thread):
     self._to_dn = to_dn
 
   def run(self):
+    try:
+      self._Untar()
+    finally:
+      # Don't block our writer if we've stopped, e.g. due to an invalid tar.
+      self._from_fp.CloseReader()
+
+  def _Untar(self):
     # We used to set bufsize=512 here to prevent the tar buffer from reading
     # too many bytes (10k or EOF), which often ate into the next param's
     # chunks.  This is apparently no longer necessary, but I'm not sure
     # what changed, so let's keep this comment for now :/
+    import tarfile  # pylint: disable=g-import-not-at-top
     from_tar = tarfile.open(mode='r|*', fileobj=self._from_fp)
     while True:
       tar_entry = from_tar.next()
@@ -865,13 +2705,16 @@ class UntarThread(threading.Thread):
 def Untar(to_fn):
   """Creates a threaded UntarPipe that accepts "write(data)" calls.
 
+  Closing the pipe waits until the tar has been extracted.
+
   Args:
     to_fn: Filename to untar into.
   Returns:
     An UntarPipe.
   """
   ret = UntarPipe()
-  UntarThread(ret, to_fn).start()
+  ret.reader = UntarThread(ret, to_fn)
+  ret.reader.start()
   return ret
 
 
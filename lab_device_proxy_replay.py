@@ -0,0 +1,490 @@
+#!/usr/bin/env python2.7
+# PLEASE LEAVE THE SHEBANG: the proxy replay runs as a standalone Python file.
+
+# Google BSD license http://code.google.com/google_bsd_license.html
+# Copyright 2014 Google Inc. wrightt@google.com
+
+"""Lab Device Proxy Traffic Replay.
+
+Replays a proxy server's "--record_file" log as load on a local proxy server
+with fake "adb" and "idevice*" commands, e.g. to see how a lab host would
+handle four times its recorded traffic before adding devices to it:
+  ./lab_device_proxy_replay.py --speedup 4 traffic.log
+
+Requests are sent at their recorded times, divided by the speedup, by up to
+"--concurrency" clients at once.  Each input file is replaced by random
+content of its recorded size, and each command by a fake that takes the
+command's recorded time and writes its recorded output and output file sizes.
+Args after a "--" are passed to the server, e.g. to match the lab host's
+flags:
+  ./lab_device_proxy_replay.py traffic.log -- --max_per_device=2
+"""
+
+import argparse
+import collections
+import cStringIO as StringIO
+import datetime
+import hashlib
+import json
+import os
+import Queue
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# pylint: disable=g-import-not-at-top
+try:
+  from lab_device_proxy import lab_device_proxy_benchmark as benchmark
+  from lab_device_proxy import lab_device_proxy_client as lab_common
+except ImportError:
+  import lab_device_proxy_benchmark as benchmark
+  import lab_device_proxy_client as lab_common
+
+SERVER_PORT = 9093
+
+# The replay server's upload cache size, as the server's default, so repeated
+# uploads of the same file are sent as digests as they were when recorded.
+CACHE_MB = 2048
+
+# A recorded command's stand-in, which is written to the server's $PATH and
+# $IDEVICE_PATH under each recorded command name, after a shebang and a
+# BEHAVIORS_DN assignment.  It reads its behavior from the file that
+# GetBehaviorKey names, with the server's temporary input and output paths
+# replaced by "IN" and "OUT".
+FAKE_COMMAND = r'''
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+args = [os.path.basename(sys.argv[0])] + [
+    re.sub(r'^/tmp/proxy_[^/]+/(in|out)\d+_[^/]+/.*$',
+           lambda match: match.group(1).upper(), arg)
+    for arg in sys.argv[1:]]
+try:
+  with open(os.path.join(BEHAVIORS_DN,
+                         hashlib.sha1(json.dumps(args)).hexdigest())) as f:
+    behavior = json.load(f)
+except IOError:
+  sys.exit(0)  # Not recorded
+
+start_time = time.time()
+block = os.urandom(1 << 16)
+for arg, key in zip(sys.argv[1:], args[1:]):
+  if key != 'OUT' or not behavior['output_files']:
+    continue
+  if behavior['output_dir']:
+    os.makedirs(arg)
+    fns = [os.path.join(arg, 'f%d' % i)
+           for i in range(behavior['output_files'])]
+  else:
+    fns = [arg]
+  for fn in fns:
+    size = behavior['output_size'] // len(fns)
+    with open(fn, 'wb') as f:
+      while size > 0:
+        f.write(block[:size])
+        size -= len(block)
+
+# Spread the output over the command's time, as a streaming command would.
+num_writes = max(1, min(100, behavior['stdout'] // 64))
+for index in range(num_writes):
+  for fp, num_bytes in ((sys.stdout, behavior['stdout']),
+                        (sys.stderr, behavior['stderr'])):
+    size = (num_bytes // num_writes +
+            (1 if index < num_bytes % num_writes else 0))
+    fp.write((('.' * 63 + '\n') * (size // 64 + 1))[:size])
+    fp.flush()
+  time.sleep(max(0, start_time + behavior['seconds'] * (index + 1) /
+                 num_writes - time.time()))
+'''
+
+
+def main(args):
+  """Replays a traffic log and prints the results.
+
+  Args:
+    args: List of strings, e.g. ['./lab_device_proxy_replay.py',
+        '--speedup', '4', 'traffic.log'].
+  """
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('-p', '--port', default=SERVER_PORT, type=int,
+                         help='Port for the local proxy server.')
+  argparser.add_argument('--speedup', default=1.0, type=float,
+                         help='Send the requests this many times faster than '
+                         'they were recorded.  The commands still take their '
+                         'recorded time.')
+  argparser.add_argument('--concurrency', default=16, type=int,
+                         help='Maximum number of requests in flight; later '
+                         'requests wait for a client, which the "lag" '
+                         'results report.')
+  argparser.add_argument('--max_command_seconds', default=0, type=float,
+                         help='Limit each fake command\'s time, e.g. for '
+                         'recorded "adb logcat" tails, 0 for no limit.')
+  argparser.add_argument('--json',
+                         help='File to write the results to, as JSON.')
+  argparser.add_argument('--baseline',
+                         help='JSON results file, e.g. of another server '
+                         'configuration, to compare the results with.')
+  argparser.add_argument('log', help='A server\'s --record_file log.')
+  argparser.add_argument('server_args', nargs='*',
+                         help='Extra server args, after a "--".')
+  parsed_args = argparser.parse_args(args[1:])
+  if parsed_args.speedup <= 0 or parsed_args.concurrency <= 0:
+    argparser.error('The speedup and concurrency must be positive')
+
+  entries, num_skipped = ReadLog(parsed_args.log)
+  if not entries:
+    argparser.error('No successful requests in %s' % parsed_args.log)
+
+  baseline = {}
+  if parsed_args.baseline:
+    with open(parsed_args.baseline) as f:
+      baseline = json.load(f)['results']
+
+  temp_dn = tempfile.mkdtemp(prefix='replay', dir='/tmp')
+  try:
+    behaviors_dn = os.path.join(temp_dn, 'behaviors')
+    names = WriteBehaviors(entries, behaviors_dn,
+                           parsed_args.max_command_seconds)
+    fake_command = '#!%s\nBEHAVIORS_DN = %r\n%s' % (
+        sys.executable, behaviors_dn, FAKE_COMMAND)
+    inputs = WriteInputs(entries, os.path.join(temp_dn, 'in'))
+    server_args = ['--cache_mb=%d' % CACHE_MB,
+                   '--cache_dir=%s' % os.path.join(temp_dn, 'cache')]
+    with benchmark.BenchmarkServer(
+        parsed_args.port, server_args + parsed_args.server_args,
+        dict((name, fake_command) for name in names)) as server:
+      results = Replay(server, entries, inputs, os.path.join(temp_dn, 'out'),
+                       parsed_args)
+  finally:
+    shutil.rmtree(temp_dn)
+
+  results.insert(0, ('skipped', num_skipped))
+  all_results = {}
+  for key, value in results:
+    full_key = 'replay.%s' % key
+    all_results[full_key] = float(value)
+    print '%s: %s%s' % (full_key, value, benchmark.FormatChange(
+        float(value), baseline.get(full_key)))
+
+  if parsed_args.json:
+    with open(parsed_args.json, 'w') as f:
+      json.dump({
+          'time': datetime.datetime.utcnow().isoformat() + 'Z',
+          'commit': benchmark.GetCommit(),
+          'python': sys.version.split()[0],
+          'log': parsed_args.log,
+          'speedup': parsed_args.speedup,
+          'concurrency': parsed_args.concurrency,
+          'server_args': parsed_args.server_args,
+          'results': all_results,
+      }, f, indent=2, sort_keys=True)
+      f.write('\n')
+
+
+def ReadLog(fn):
+  """Reads a traffic log's successful requests.
+
+  Failed requests, e.g. upload cache misses that the client re-sent, are
+  skipped.
+
+  Args:
+    fn: string log filename.
+  Returns:
+    A (entries, int num_skipped) tuple, where entries is a List of dicts,
+    as TrafficRecorder wrote them, in time order.
+  """
+  entries = []
+  num_skipped = 0
+  with open(fn) as f:
+    for line in f:
+      entry = json.loads(line)
+      if entry['status'] == 200:
+        entries.append(entry)
+      else:
+        num_skipped += 1
+  entries.sort(key=lambda entry: entry['time'])
+  return entries, num_skipped
+
+
+def GetCommands(entry):
+  """Returns the commands that a recorded request's server ran.
+
+  Args:
+    entry: dict, from ReadLog.
+  Returns:
+    List of recorded commands, with a fan-out expanded per device, as
+    the server's _FanOutCommand does.
+  """
+  if 'devices' not in entry:
+    return entry['commands']
+  command = entry['commands'][0]
+  device_option = ('-s' if os.path.basename(command[0]) == 'adb' else '-u')
+  return [command[:1] + [device_option, device_id] + command[1:]
+          for device_id in entry['devices']]
+
+
+def GetBehaviorKey(command):
+  """Returns the key that a command's fake looks up its behavior by.
+
+  Args:
+    command: List of recorded args.
+  Returns:
+    string SHA-1 hex digest.
+  """
+  args = [os.path.basename(command[0])] + [
+      arg if not isinstance(arg, dict) else ('IN' if 'in' in arg else 'OUT')
+      for arg in command[1:]]
+  return hashlib.sha1(json.dumps(args)).hexdigest()
+
+
+def WriteBehaviors(entries, behaviors_dn, max_command_seconds=0):
+  """Writes a behavior file per distinct recorded command, for its fake.
+
+  A command's behavior is its average time, stdout, stderr and output file
+  size.  A batch's commands share its command time, as they ran up to its
+  parallel limit at once, and its stdout and stderr sizes.
+
+  Args:
+    entries: List of dicts, from ReadLog.
+    behaviors_dn: string directory to write to.
+    max_command_seconds: float time limit, or 0 for no limit.
+  Returns:
+    The set of command names, e.g. set(['adb', 'idevice_id']).
+  """
+  totals = collections.defaultdict(lambda: collections.defaultdict(float))
+  outputs = {}  # key -> (output_files, output_dir), from the last entry
+  names = set()
+  for entry in entries:
+    commands = GetCommands(entry)
+    parallel = min(int(entry.get('parallel') or 1), len(commands))
+    seconds = entry['phases'].get('command', 0) * parallel / len(commands)
+    if max_command_seconds > 0:
+      seconds = min(seconds, max_command_seconds)
+    for command in commands:
+      key = GetBehaviorKey(command)
+      names.add(os.path.basename(command[0]))
+      total = totals[key]
+      total['count'] += 1
+      total['seconds'] += seconds
+      for name in ('stdout', 'stderr'):
+        total[name] += entry['bytes'][name] // len(commands)
+      for arg in command:
+        if isinstance(arg, dict) and 'out' in arg:
+          total['output_size'] += arg['size']
+          outputs[key] = (arg['files'], arg.get('dir', False))
+
+  os.makedirs(behaviors_dn)
+  for key, total in totals.iteritems():
+    count = total['count']
+    output_files, output_dir = outputs.get(key, (0, False))
+    with open(os.path.join(behaviors_dn, key), 'w') as f:
+      json.dump({
+          'seconds': total['seconds'] / count,
+          'stdout': int(total['stdout'] / count),
+          'stderr': int(total['stderr'] / count),
+          'output_size': int(total['output_size'] / count),
+          'output_files': output_files,
+          'output_dir': output_dir,
+      }, f)
+  return names
+
+
+def WriteInputs(entries, in_dn):
+  """Writes a synthetic input file per distinct recorded input file.
+
+  Inputs with the same recorded digest share a synthetic file, so the
+  replay server's upload cache hits and misses as the recorded server's
+  did.
+
+  Args:
+    entries: List of dicts, from ReadLog.
+    in_dn: string directory to write to.
+  Returns:
+    dict of input keys, from _GetInputKey, to local paths.  An input that
+    was absent when recorded maps to a path that doesn't exist.
+  """
+  inputs = {}
+  os.makedirs(in_dn)
+  for entry in entries:
+    for command in entry['commands']:
+      for arg in command:
+        if not isinstance(arg, dict) or 'in' not in arg:
+          continue
+        key = _GetInputKey(arg)
+        if key in inputs:
+          continue
+        parent_dn = os.path.join(in_dn, str(len(inputs)))
+        os.makedirs(parent_dn)
+        path = os.path.join(parent_dn,
+                            os.path.basename(arg['in'].rstrip('/')) or 'in')
+        inputs[key] = path
+        if arg.get('dir'):
+          os.makedirs(path)
+          benchmark.WriteFiles(path, [
+              ('f%d' % i, arg['size'] // arg['files'])
+              for i in range(arg['files'])])
+        elif arg['files']:
+          benchmark.WriteFiles(path, [('', arg['size'])])
+  return inputs
+
+
+def _GetInputKey(arg):
+  """Returns a recorded input file's key, for WriteInputs."""
+  return arg.get('digest') or json.dumps(arg, sort_keys=True)
+
+
+def GetLabel(entry):
+  """Returns a recorded request's label, as the server's /metrics labels it.
+
+  Args:
+    entry: dict, from ReadLog.
+  Returns:
+    string, e.g. 'adb shell', or 'batch' for a batch or fan-out.
+  """
+  commands = GetCommands(entry)
+  if len(commands) > 1:
+    return 'batch'
+  command = commands[0]
+  label = [os.path.basename(command[0])]
+  if label[0] == 'adb':
+    # The first arg that isn't an option or the "-s" option's serial
+    label += [arg for index, arg in enumerate(command[1:], 1)
+              if not isinstance(arg, dict) and not arg.startswith('-') and
+              command[index - 1] != '-s'][:1]
+  return ' '.join(label)
+
+
+def Replay(server, entries, inputs, out_dn, parsed_args):
+  """Sends the recorded requests at their recorded times.
+
+  Args:
+    server: BenchmarkServer, with our fake commands.
+    entries: List of dicts, from ReadLog.
+    inputs: dict, from WriteInputs.
+    out_dn: string directory for the output files, which are deleted as
+        each request finishes.
+    parsed_args: argparse Namespace.
+  Returns:
+    List of (key, value) results.
+  Raises:
+    RuntimeError: if a request failed.
+  """
+  os.makedirs(out_dn)
+  work = Queue.Queue()
+  replies = []  # (label, float lag, float latency, error) tuples
+
+  def RunClient():
+    pool = lab_common.ConnectionPool()
+    try:
+      while True:
+        item = work.get()
+        if item is None:
+          return
+        due_time, index, entry = item
+        start_time = time.time()
+        try:
+          error = _Send(server, entry, inputs,
+                        os.path.join(out_dn, str(index)), pool)
+        except Exception, e:  # pylint: disable=broad-except
+          error = str(e)
+        replies.append((GetLabel(entry), start_time - due_time,
+                        time.time() - start_time, error))
+    finally:
+      pool.Close()
+
+  threads = [threading.Thread(target=RunClient)
+             for _ in range(parsed_args.concurrency)]
+  for thread in threads:
+    thread.start()
+  start_time = time.time()
+  first_time = entries[0]['time']
+  try:
+    for index, entry in enumerate(entries):
+      due_time = start_time + (entry['time'] - first_time) / parsed_args.speedup
+      delay = due_time - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      work.put((due_time, index, entry))
+  finally:
+    for _ in threads:
+      work.put(None)
+    for thread in threads:
+      thread.join()
+  duration = time.time() - start_time
+
+  errors = [error for _, _, _, error in replies if error]
+  if errors:
+    raise RuntimeError('%d of %d requests failed, e.g.: %s' % (
+        len(errors), len(replies), errors[0]))
+  ret = [('requests', len(replies)),
+         ('duration_s', '%.1f' % duration),
+         ('qps', '%.1f' % (len(replies) / duration))]
+  ret += benchmark.GetPercentiles(
+      [latency for _, _, latency, _ in replies], 'latency')
+  ret += benchmark.GetPercentiles(
+      [sum(entry['phases'].values()) for entry in entries],
+      'recorded_latency')
+  ret += benchmark.GetPercentiles([lag for _, lag, _, _ in replies], 'lag')
+  latencies = collections.defaultdict(list)
+  for label, _, latency, _ in replies:
+    latencies[label].append(latency)
+  for label in sorted(latencies):
+    ret += benchmark.GetPercentiles(
+        latencies[label], re.sub(r'\W+', '_', label) + '_latency')
+  return ret
+
+
+def _Send(server, entry, inputs, out_dn, pool):
+  """Sends a recorded request, with synthetic files.
+
+  Args:
+    server: BenchmarkServer.
+    entry: dict, from ReadLog.
+    inputs: dict, from WriteInputs.
+    out_dn: string directory for the output files, which we delete.
+    pool: ConnectionPool.
+  Returns:
+    A string error, or None if every command exited 0.
+  """
+  os.makedirs(out_dn)
+  try:
+    params_list = []
+    for command in entry['commands']:
+      args = []
+      for arg in command:
+        if not isinstance(arg, dict):
+          args.append(arg)
+        elif 'in' in arg:
+          args.append(inputs[_GetInputKey(arg)])
+        else:
+          args.append(os.path.join(
+              out_dn, os.path.basename(arg['out'].rstrip('/')) or 'out'))
+      params_list.append(lab_common.PARSER.parse_args(args))
+    client = lab_common.LabDeviceProxyClient(
+        server.url, StringIO.StringIO(), StringIO.StringIO(), pool,
+        entry.get('priority'))
+    parallel = int(entry.get('parallel') or 1)
+    if 'devices' in entry:
+      exit_codes = [result.exit_code for result in client.CallFanout(
+          entry['devices'], params_list[0], parallel)]
+    elif 'parallel' in entry:
+      exit_codes = [result.exit_code for result in client.CallBatch(
+          params_list, parallel)]
+    else:
+      exit_codes = [client.Call(*params_list[0])]
+  finally:
+    shutil.rmtree(out_dn)
+  if any(exit_codes):
+    return 'Exit codes %s: %s' % (exit_codes, entry['commands'])
+  return None
+
+
+if __name__ == '__main__':
+  main(sys.argv)
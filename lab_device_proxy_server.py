@@ -8,17 +8,33 @@
 
 import argparse
 import BaseHTTPServer
+import bisect
+import cgi
+import collections
+import cStringIO as StringIO
 import datetime
+import errno
+import fcntl
+import functools
+import hashlib
+import heapq
 import httplib
+import itertools
+import json
+import mimetools
 import os
 import re
 import select
 import shutil
 import signal
+import socket
 import SocketServer
+import stat
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 # Reuse the client's parameter parser and tar/untar functions.
@@ -33,8 +49,83 @@ except ImportError:
 IDEVICE_PATH = 'IDEVICE_PATH'
 SERVER_PORT = 8084
 
+# Idle keep-alive connections are closed after this many seconds.
+KEEP_ALIVE_TIMEOUT = 60
+
+# Default maximum number of commands that a batch or fan-out request may run
+# at once.
+MAX_PARALLEL = 16
+
+# Quick, latency-sensitive commands, which run at "high" priority.  Commands
+# with input or output files run at "bulk" priority, and the rest at "normal".
+HIGH_PRIORITY_COMMANDS = [
+    ['adb', 'devices'],
+    ['adb', 'shell', 'getprop'],
+    ['idevice_id'],
+    ['ideviceinfo'],
+    ['idevicedate'],
+]
+
+# Idempotent, read-only commands whose results are cached, with their
+# time-to-live in seconds.  Test harnesses poll these every few seconds.
+CACHED_COMMANDS = [
+    (['adb', 'devices'], 1),
+    (['idevice_id', '-l'], 1),
+    (['idevice_id', '--list'], 1),
+    (['ideviceinfo'], 5),
+]
+
+# Seconds between the device inventory's "idevice_id -l" polls, and between
+# its retries of a failed "adb track-devices".
+INVENTORY_INTERVAL = 5
+
+# The local adb server's default port, for --native_adb.
+ADB_PORT = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+
+# Seconds that an idle "adb shell" session is kept, for --shell_sessions.
+SHELL_SESSION_TIMEOUT = 60
+
+# Commands that modify a device, which invalidate its cached results.
+MUTATING_COMMANDS = [
+    ['adb', 'connect'],
+    ['adb', 'install'],
+    ['adb', 'root'],
+    ['adb', 'uninstall'],
+    ['idevicediagnostics'],
+    ['ideviceinstaller'],
+]
+
+# A POST request's phases, as (name, start timestamp, end timestamp) tuples of
+# the timestamps that do_POST logs.  The "upload" timestamp is when we've read
+# the request's chunks, which the log's "req" phase includes.
+REQUEST_PHASES = (
+    ('upload', '', 'upload'),
+    ('validate', 'upload', 'req'),
+    ('queue', 'req', 'wait'),
+    ('command', 'wait', 'cmd'),
+    ('download', 'cmd', 'resp'))
+
+# Upper bounds, in seconds, of the /metrics latency histograms' buckets.
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300)
+
+# Default number of slots, beyond the --max_per_device and --max_per_host
+# limits, that only "high" priority commands may use.
+RESERVED_SLOTS = 2
+
+CACHE_DIR = '/tmp/lab_device_proxy_cache'
+CACHE_MB = 2048
+
 MAX_READ = 8192
 
+# Output files at least this large are sent via sendfile, if possible, in
+# chunks of up to MAX_SENDFILE_CHUNK bytes.
+MIN_SENDFILE_SIZE = 64 * 1024
+MAX_SENDFILE_CHUNK = 1 << 30
+
+# The event loop engine rejects request chunks larger than this.
+MAX_CHUNK = 16 << 20
+
 
 def main(args):
   """Runs the server, forever.
@@ -47,92 +138,652 @@ def main(args):
   argparser = argparse.ArgumentParser()
   argparser.add_argument('-p', '--port', default=SERVER_PORT, type=int,
                          help='Port the web server should listen on.')
+  argparser.add_argument('--engine', default='threaded',
+                         choices=['threaded', 'eventloop'],
+                         help='Serve each connection from its own thread, or '
+                         'all connections from a single event loop.')
+  argparser.add_argument('--max_parallel', default=MAX_PARALLEL, type=int,
+                         help='Maximum number of commands that a batch or '
+                         'fan-out request may run at once.')
+  argparser.add_argument('--max_per_device', default=0, type=int,
+                         help='Maximum number of commands that may run at '
+                         'once on each device, 0 for no limit.')
+  argparser.add_argument('--max_per_host', default=0, type=int,
+                         help='Maximum number of commands that may run at '
+                         'once, 0 for no limit.')
+  argparser.add_argument('--reserved_slots', default=RESERVED_SLOTS,
+                         type=int,
+                         help='Number of slots, beyond the above limits, that '
+                         'only high priority commands may use.')
+  argparser.add_argument('--queueing', default='fifo',
+                         choices=CommandScheduler.POLICIES,
+                         help='Admit queued commands in arrival order, or '
+                         'take turns between clients.')
+  argparser.add_argument('--cache_dir', default=CACHE_DIR,
+                         help='Directory of the uploaded input file cache.')
+  argparser.add_argument('--cache_mb', default=CACHE_MB, type=int,
+                         help='Upload cache size limit, 0 to disable.')
+  argparser.add_argument('--noresult_cache', dest='result_cache',
+                         default=True, action='store_false',
+                         help='Run every command, rather than reuse the '
+                         'recent results of read-only commands such as '
+                         '"adb devices".')
+  argparser.add_argument('--nometrics', dest='metrics', default=True,
+                         action='store_false',
+                         help='Don\'t collect the request latencies and '
+                         'counters that /metrics serves.')
+  argparser.add_argument('--record_file',
+                         help='Append each request\'s commands, file sizes '
+                         'and timing to this file, as JSON lines, for '
+                         'lab_device_proxy_replay.py.')
+  argparser.add_argument('--device_inventory', default=False,
+                         action='store_true',
+                         help='Track the host\'s devices in the background, '
+                         'and answer "adb devices" and "idevice_id -l" from '
+                         'memory.')
+  argparser.add_argument('--inventory_interval', default=INVENTORY_INTERVAL,
+                         type=float,
+                         help='Seconds between the device inventory\'s iOS '
+                         'device polls.')
+  argparser.add_argument('--native_adb', default=False, action='store_true',
+                         help='Run "adb devices", "shell", "push", "pull" '
+                         'and "install" commands in-process, via the local '
+                         'adb server, rather than via the adb binary.')
+  argparser.add_argument('--adb_port', default=ADB_PORT, type=int,
+                         help='Port of the local adb server, for '
+                         '--native_adb.')
+  argparser.add_argument('--shell_sessions', default=0, type=int,
+                         help='Run "adb -s X shell CMD" commands in up to '
+                         'this many long-lived "adb shell" sessions per '
+                         'device, 0 to start a new shell per command.')
+  argparser.add_argument('--shell_session_timeout',
+                         default=SHELL_SESSION_TIMEOUT, type=float,
+                         help='Seconds that an idle shell session is kept.')
+  argparser.add_argument('--coalesce_ms',
+                         default=lab_common.COALESCE_DELAY * 1000, type=float,
+                         help='Maximum time to batch command output before '
+                         'sending it, 0 to send each read at once.')
+  argparser.add_argument('--coalesce_kb',
+                         default=lab_common.COALESCE_SIZE >> 10, type=int,
+                         help='Send batched command output once it reaches '
+                         'this size.')
+  argparser.add_argument('--compression_threads',
+                         default=lab_common.COMPRESSION_THREADS, type=int,
+                         help='Number of threads that compress pulled '
+                         'directories, 0 for one per CPU.')
+  argparser.add_argument('--nosendfile', dest='sendfile', default=True,
+                         action='store_false',
+                         help='Copy output files through Python instead of '
+                         'via sendfile.')
   parsed_args = argparser.parse_args(args[1:])
+  lab_common.USE_SENDFILE = parsed_args.sendfile
+  lab_common.COALESCE_DELAY = max(0, parsed_args.coalesce_ms) / 1000.0
+  lab_common.COALESCE_SIZE = max(1, parsed_args.coalesce_kb) << 10
+  lab_common.COMPRESSION_THREADS = parsed_args.compression_threads
   server_port = parsed_args.port
 
   server = None
   try:
-    server = ThreadedHTTPServer(
-        ('', server_port), LabDeviceProxyRequestHandler)
+    if parsed_args.engine == 'eventloop':
+      server = EventLoopHTTPServer(('', server_port))
+    else:
+      server = ThreadedHTTPServer(
+          ('', server_port), LabDeviceProxyRequestHandler)
+    server.max_parallel = max(1, parsed_args.max_parallel)
+    server.scheduler = CommandScheduler(
+        max(0, parsed_args.max_per_device), max(0, parsed_args.max_per_host),
+        parsed_args.queueing, max(0, parsed_args.reserved_slots))
+    if parsed_args.cache_mb > 0:
+      server.upload_cache = UploadCache(
+          parsed_args.cache_dir, parsed_args.cache_mb << 20)
+    if parsed_args.result_cache:
+      server.result_cache = ResultCache()
+    if parsed_args.metrics:
+      server.metrics = ServerMetrics()
+    if parsed_args.record_file:
+      server.recorder = TrafficRecorder(parsed_args.record_file)
+    if parsed_args.native_adb:
+      server.adb_port = parsed_args.adb_port
+    if parsed_args.shell_sessions > 0:
+      server.shell_pool = ShellSessionPool(
+          parsed_args.shell_sessions,
+          max(1, parsed_args.shell_session_timeout))
+      server.shell_pool.Start()
+    if parsed_args.device_inventory:
+      server.inventory = DeviceInventory(
+          max(0.1, parsed_args.inventory_interval))
+      server.inventory.Start()
     server.serve_forever(poll_interval=0.5)
   finally:
     if server:
+      if server.inventory:
+        server.inventory.Stop()
+      if server.shell_pool:
+        server.shell_pool.Stop()
       server.shutdown()
 
 
+def LogMessage(hostname, fmt, *args):
+  """Logs to stderr.
+
+  Args:
+    hostname: string client hostname or IP address
+    fmt: string format
+    *args: format args
+  """
+  # Sample log output: I0313 14:23:49.512168 hostname adb logcat
+  now = datetime.datetime.now()
+  timestamp = now.strftime('I%m%d %T') + ('.%06d' % now.microsecond)
+  print >>sys.stderr, '%s %s - %s' % (timestamp, hostname, fmt % args)
+
+
+def KillProcess(proc):
+  """Kills and reaps a subprocess.Popen, if it's not None."""
+  if proc and proc.poll() is None:
+    try:
+      proc.kill()
+    except OSError:
+      pass  # It just exited
+  if proc:
+    proc.wait()
+
+
+def ShellQuote(text):
+  """Quotes a string for a device's shell, e.g. "it's" as "'it'\\''s'"."""
+  return "'%s'" % text.replace("'", "'\\''")
+
+
 class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
                          BaseHTTPServer.HTTPServer):
   """Spawns a thread per request."""
 
-  pass
+  # As in EventLoopHTTPServer, rather than SocketServer's 5, so a burst of
+  # new clients isn't reset.
+  request_queue_size = socket.SOMAXCONN
+
+  max_parallel = MAX_PARALLEL  # int
+  scheduler = None  # CommandScheduler
+  upload_cache = None  # UploadCache
+  result_cache = None  # ResultCache
+  inventory = None  # DeviceInventory
+  adb_port = None  # int, if adb commands use the adb server's host protocol
+  shell_pool = None  # ShellSessionPool
+  metrics = None  # ServerMetrics
+  recorder = None  # TrafficRecorder
 
 
 class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   """Handles all client requests."""
 
+  # Support keep-alive connections.  Our responses are all chunked or have a
+  # Content-Length, and send_error closes the connection.
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    # See the client's _LabHTTPConnection.
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  def handle(self):
+    """Handles requests until the connection is closed or idle."""
+    self.close_connection = 1
+    self.handle_one_request()
+    while not self.close_connection:
+      rlist, _, _ = select.select([self.connection], [], [],
+                                  KEEP_ALIVE_TIMEOUT)
+      if not rlist:
+        break
+      try:
+        self.handle_one_request()
+      except socket.error:
+        break  # E.g. the client exited with this idle connection in its pool
+
   def do_GET(self):  # pylint: disable=g-bad-name
     """Handles a GET request."""
-    if self.path == '/healthz':
-      response_data = 'ok\n'
-      self.send_response(httplib.OK)
-      self.send_header('Content-Type', 'text/plain; charset=utf=8')
-      self.send_header('Content-Length', str(len(response_data)))
-      self.end_headers()
-      self.wfile.write(response_data)
-    else:
+    page = self._GetPage(self.path, self.server)
+    if page is None:
       return self.send_error(httplib.METHOD_NOT_ALLOWED)
+    content_type, response_data = page
+    self.send_response(httplib.OK)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(response_data)))
+    for key, value in self._GetFeatureHeaders(self.server):
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(response_data)
+
+  @staticmethod
+  def _GetPage(path, server):
+    """Returns a GET request's response.
+
+    Args:
+      path: string request path, e.g. '/healthz'
+      server: ThreadedHTTPServer or EventLoopHTTPServer
+    Returns:
+      (content type, data) string tuple, or None if there's no such page.
+    """
+    if path == '/healthz':
+      return ('text/plain; charset=utf=8', 'ok\n')
+    if path == '/inventory' and server.inventory:
+      return ('application/json',
+              json.dumps(server.inventory.ToJson(), sort_keys=True) + '\n')
+    if path == '/metrics' and server.metrics:
+      return ('text/plain; version=0.0.4', server.metrics.Format())
+    return None
+
+  @staticmethod
+  def _GetFeatureHeaders(server):
+    """Returns (key, value) response headers that advertise our features.
+
+    Args:
+      server: ThreadedHTTPServer or EventLoopHTTPServer
+    """
+    if server.upload_cache:
+      return [(lab_common.UPLOAD_CACHE_HEADER, '1')]
+    return []
 
   def do_POST(self):  # pylint: disable=g-bad-name
-    """Handles a POST request."""
-    params = []
+    """Handles a POST request, which may be a batch of commands."""
+    parallel = self.headers.getheader(lab_common.BATCH_HEADER)
+    device_ids = self.headers.getheader(lab_common.FANOUT_HEADER)
+    priority = self.headers.getheader(lab_common.PRIORITY_HEADER)
+    framing = self._GetFraming(
+        self.headers.getheader(lab_common.FRAMING_HEADER))
+    is_timed = bool(self.headers.getheader(lab_common.TIMING_HEADER))
+    to_stream = lab_common.FramedStream(self.wfile, framing)
+    is_batch = (parallel is not None and device_ids is None)
+    batch = ([] if is_batch else [[]])  # List of params lists
     tmp_fs = TempFileSystem()
+    cache = self.server.upload_cache
+    metrics = self.server.metrics
+    recorder = self.server.recorder
+    names = []
+    upload_time = None
+    status = httplib.OK
+    request_id = self._NewRequestId()
 
     timestamps = [('', time.time())]  # Never printed, only subtracted
+    if metrics:
+      metrics.Add('active_requests', 1)
     try:
       on_error = httplib.BAD_REQUEST
-      while self._ReadChunk(self.rfile, params, tmp_fs):
-        pass
+      if parallel is not None:
+        parallel = max(1, min(self.server.max_parallel, int(parallel)))
+      if priority is not None and priority not in lab_common.PRIORITIES:
+        raise ValueError('Unknown priority: %s' % priority)
+      if not is_batch:
+        while self._ReadChunk(self.rfile, batch[0], tmp_fs, cache):
+          pass
+      else:
+        while self._ReadBatchChunk(self.rfile, batch, tmp_fs, cache):
+          pass
+      upload_time = time.time()
+
+      if any(curr.is_cache_miss for params in batch for curr in params):
+        # The client will re-send the request with the file content.
+        on_error = httplib.EXPECTATION_FAILED
+        raise ValueError('Input file not in upload cache')
 
       on_error = httplib.FORBIDDEN
-      self._ValidateCommand(params)
+      if device_ids is not None:
+        batch = self._FanOutCommand(batch[0], device_ids.split())
+        parallel = (parallel if parallel is not None else 1)
+      devices = []
+      priorities = []
+      for params in batch:
+        reqs = self._ValidateCommand(params)
+        devices.append(self._GetDeviceId(reqs))
+        priorities.append(priority or self._GetPriority(reqs))
+        names.append(self._GetCommandName(reqs))
 
       on_error = httplib.INTERNAL_SERVER_ERROR
-      self._BeginResponse()
+      self._BeginResponse(framing)
       on_error = None  # Sent our response status code
 
       timestamps.append(('req', time.time()))
 
-      args = [str(curr.value) for curr in params]
-      if IDEVICE_PATH in os.environ:
-        args[0] = os.environ[IDEVICE_PATH] + '/' + args[0]
-
-      self._RunCommand(args, self.rfile, self.wfile)
-      timestamps.append(('cmd', time.time()))
-
-      self._WriteChunks(params, self.wfile)
+      if parallel is None:
+        params = batch[0]
+        start_time = self._RunCommandInTurn(params, devices[0], priorities[0],
+                                            names[0], to_stream)
+        timestamps.append(('wait', start_time or time.time()))
+        timestamps.append(('cmd', time.time()))
+        self._WriteOutputFiles(params, to_stream)
+      else:
+        start_time = self._RunBatch(batch, devices, priorities, names,
+                                    parallel, to_stream)
+        timestamps.append(('wait', start_time))
+        timestamps.append(('cmd', time.time()))
+      if is_timed:
+        self._SendTiming(request_id, batch, timestamps, upload_time,
+                         to_stream)
+      lab_common.SendEnd(to_stream)
     except Exception, e:  # pylint: disable=broad-except
       timestamps.append(('err', time.time()))
-      args = [str(curr.value) for curr in params]
-      self.log_message('Failed: %s\n%s', ' '.join(args), lab_common.GetStack())
+      if on_error != httplib.EXPECTATION_FAILED:  # Expected cache misses
+        self.log_message('Failed: %s\n%s', self._FormatBatch(batch),
+                         lab_common.GetStack())
       if on_error is not None:
+        status = on_error
         self.send_error(on_error, str(e))
+      else:
+        # Our chunked response is incomplete, so the client can't reuse it.
+        self.close_connection = 1
     finally:
+      for params in batch:
+        for curr in params:
+          if curr.in_fp:
+            self._CloseInputFile(curr, cache, aborted=True)
+      if recorder:
+        # Before the cleanup, so the recorder can see the files' sizes
+        recorder.Record(
+            request_id, timestamps[0][1], status, batch, device_ids, parallel,
+            priority, self._GetPhases(timestamps + [('resp', time.time())],
+                                      upload_time), to_stream.num_bytes)
       tmp_fs.Cleanup()
       timestamps.append(('resp', time.time()))
 
       timings = ' '.join(
           ['%s: %.1f' % (name, (timestamp - timestamps[i - 1][1]))
            for i, (name, timestamp) in enumerate(timestamps) if i > 0])
-      self.log_message('(%s) %s', timings, ' '.join(args))
+      self.log_message('(id: %s %s) %s', request_id, timings,
+                       self._FormatBatch(batch))
+      if metrics:
+        metrics.ObserveRequest(
+            self._GetMetricsLabel(batch, names),
+            self._GetPhases(timestamps, upload_time),
+            *self._GetFileBytes(batch))
+        metrics.Add('active_requests', -1)
+
+  @staticmethod
+  def _FormatBatch(batch):
+    """Formats a batch of commands for logging, e.g. 'adb devices ; adb ...'."""
+    return ' ; '.join(
+        ' '.join(str(curr.value) for curr in params) for params in batch)
+
+  @staticmethod
+  def _NewRequestId():
+    """Returns a random id, which our log and timing trailer share."""
+    return os.urandom(4).encode('hex')
+
+  @staticmethod
+  def _GetPhases(timestamps, upload_time):
+    """Returns a POST request's phase durations.
+
+    Args:
+      timestamps: List of (name, time) tuples, as logged
+      upload_time: float time that we read the request, or None
+    Returns:
+      List of (phase, float seconds) tuples, in REQUEST_PHASES order, of the
+      phases that the request reached.
+    """
+    times = dict(timestamps)
+    times[''] = timestamps[0][1]
+    if upload_time is not None:
+      times['upload'] = upload_time
+    return [(phase, max(0, times[end] - times[start]))
+            for phase, start, end in REQUEST_PHASES
+            if start in times and end in times]
+
+  @staticmethod
+  def _GetFileBytes(batch):
+    """Returns a POST request's (input, output) int file sizes."""
+    params = [curr for params in batch for curr in params]
+    return (sum(curr.num_bytes for curr in params
+                if curr.header and curr.header.in_),
+            sum(curr.num_bytes for curr in params if curr.out_dn))
 
   @classmethod
-  def _ReadChunk(cls, from_stream, to_params, to_fs):
+  def _SendTiming(cls, request_id, batch, timestamps, upload_time,
+                  to_stream):
+    """Sends a POST request's timing trailer, for clients that asked for it.
+
+    Args:
+      request_id: string, from _NewRequestId
+      batch: List of Params lists
+      timestamps: List of (name, time) tuples, as logged, which we've
+          sent the output of
+      upload_time: float time that we read the request, or None
+      to_stream: stream to write to
+    """
+    input_bytes, output_bytes = cls._GetFileBytes(batch)
+    timing = {
+        'id': request_id,
+        'phases': cls._GetPhases(timestamps + [('resp', time.time())],
+                                 upload_time),
+        'bytes': {'input': input_bytes, 'output': output_bytes},
+    }
+    lab_common.SendChunk(lab_common.ChunkHeader('timing'),
+                         json.dumps(timing, sort_keys=True), to_stream)
+
+  @staticmethod
+  def _GetMetricsLabel(batch, names):
+    """Returns a request's command label for /metrics.
+
+    Args:
+      batch: List of Params lists
+      names: List of command names, from _GetCommandName, one per validated
+          command
+    Returns:
+      string, e.g. 'adb shell' for "adb -s X shell ls", 'batch' for a batch
+      or fan-out, or 'invalid' if the request failed validation.
+    """
+    if not names or len(names) < len(batch):
+      return 'invalid'
+    if len(names) > 1:
+      return 'batch'
+    label = [os.path.basename(names[0][0])]
+    if label[0] == 'adb':
+      label += [arg for arg in names[0][1:] if not arg.startswith('-')][:1]
+    return ' '.join(label)
+
+  @classmethod
+  def _FanOutCommand(cls, params, device_ids):
+    """Expands a command into one command per device.
+
+    The commands share the same uploaded input files.
+
+    Args:
+      params: List of Params, e.g. for "adb install foo.apk"
+      device_ids: List of Android serials or iOS UDIDs
+    Returns:
+      List of Params lists, e.g. for "adb -s SERIAL install foo.apk"
+    Raises:
+      ValueError: if the command can't be fanned out.
+    """
+    reqs = cls._ValidateCommand(params)
+    if not device_ids:
+      raise ValueError('Fan-out lacks device ids')
+    for req in reqs:
+      if isinstance(req, (lab_common.AndroidSerialParameter,
+                          lab_common.IOSDeviceIdParameter)):
+        raise ValueError('Fan-out command already has a device id: %s' % req)
+      if isinstance(req, lab_common.OutputFileParameter):
+        raise ValueError('Fan-out command has an output file: %s' % req)
+    device_option = ('-s' if params[0].value == 'adb' else '-u')
+    batch = []
+    for device_id in device_ids:
+      # The option must precede any sub-command, so insert it after arg[0]
+      device_params = [params[0]]
+      for value in (device_option, device_id):
+        curr = Param()
+        curr.value = value
+        curr.header = lab_common.ChunkHeader()
+        device_params.append(curr)
+      batch.append(device_params + params[1:])
+    return batch
+
+  @staticmethod
+  def _GetCommandArgs(params):
+    """Returns a validated command's args, for _RunCommand.
+
+    Args:
+      params: List of Params
+    Returns:
+      List of strings
+    """
+    args = [str(curr.value) for curr in params]
+    if IDEVICE_PATH in os.environ:
+      args[0] = os.environ[IDEVICE_PATH] + '/' + args[0]
+    return args
+
+  def _RunBatch(self, batch, devices, priorities, names, parallel,
+                to_stream):
+    """Runs a batch of commands and writes their chunks to the client.
+
+    Each command's chunks are tagged with its "cmd" index, so the client can
+    demultiplex the output of parallel commands.
+
+    Args:
+      batch: List of validated params lists
+      devices: List of device ids (or None), one per command
+      priorities: List of priorities, one per command
+      names: List of command names, one per command
+      parallel: int maximum number of commands to run at once
+      to_stream: stream to write to
+    Returns:
+      The float time that the first command started, after waiting for
+      its turn.
+    Raises:
+      RuntimeError: if a command failed to write its output.
+    """
+    to_stream = LockedChunkStream(to_stream)
+    lock = threading.Lock()
+    next_indices = iter(range(len(batch)))
+    errors = []
+    start_times = []
+
+    def RunCommands():
+      while True:
+        with lock:
+          cmd_index = next(next_indices, None)
+        if cmd_index is None or errors:
+          return
+        if select.select([self.rfile], [], [], 0)[0]:
+          return  # The client has been lost, as noted in _RunCommand
+        try:
+          cmd_stream = lab_common.BatchCommandStream(to_stream, cmd_index)
+          params = batch[cmd_index]
+          start_time = self._RunCommandInTurn(
+              params, devices[cmd_index], priorities[cmd_index],
+              names[cmd_index], cmd_stream)
+          if start_time is None:
+            return
+          start_times.append(start_time)
+          self._WriteOutputFiles(params, cmd_stream)
+        except Exception:  # pylint: disable=broad-except
+          errors.append(lab_common.GetStack())
+
+    threads = [threading.Thread(target=RunCommands)
+               for _ in range(min(parallel, len(batch)) - 1)]
+    for thread in threads:
+      thread.start()
+    RunCommands()
+    for thread in threads:
+      thread.join()
+    if errors:
+      raise RuntimeError('Batch command failed:\n%s' % errors[0])
+    return (min(start_times) if start_times else time.time())
+
+  def _RunCommandInTurn(self, params, device_id, priority, name, to_stream):
+    """Runs a command once our scheduler admits it, or sends its result.
+
+    The result may instead come from our DeviceInventory or ResultCache.
+
+    Args:
+      params: List of validated Params
+      device_id: string device id, or None
+      priority: string, one of lab_common.PRIORITIES
+      name: List of strings, from _GetCommandName
+      to_stream: stream to write to
+    Returns:
+      The float time that the command started, or that its cached result
+      was sent, or None if the client has been lost.
+    """
+    inventory = self.server.inventory
+    output = (inventory.GetOutput(name) if inventory and not device_id
+              else None)
+    if output is not None:
+      ResultRecorder.Replay([('1', output), ('exit', '0')], to_stream)
+      return time.time()
+
+    args = self._GetCommandArgs(params)
+    cache = self.server.result_cache
+    ttl = (cache.GetTTL(name) if cache else None)
+    is_mutating = (cache.IsMutating(name) if cache else False)
+    key = (device_id, tuple(args))
+    recorder = None
+    if ttl is not None:
+      results = []
+      done_event = threading.Event()
+
+      def OnResult(result):
+        results.append(result)
+        done_event.set()
+
+      outcome = cache.Begin(key, ttl, OnResult)
+      self.log_message('Result cache %s (%s): %s', outcome,
+                       cache.FormatStats(), ' '.join(args))
+      if outcome == ResultCache.MISS:
+        recorder = ResultRecorder(to_stream)
+        to_stream = recorder
+      else:
+        while not done_event.wait(1):
+          if select.select([self.rfile], [], [], 0)[0]:
+            return None  # As noted in _RunCommand
+        if results[0] is not None:
+          ResultRecorder.Replay(results[0], to_stream)
+          return time.time()
+        # The run that we waited for failed, so we run our own.
+
+    result = None
+    try:
+      ticket = self._WaitForTurn(device_id, priority)
+      if not ticket:
+        return None
+      start_time = time.time()
+      try:
+        if is_mutating:
+          cache.Invalidate(device_id)
+        self._RunCommand(args, self.rfile, to_stream, self.server)
+        result = (recorder.result if recorder else None)
+      finally:
+        self.server.scheduler.Release(ticket)
+        if is_mutating:
+          cache.Invalidate(device_id)
+      return start_time
+    finally:
+      if recorder:
+        cache.End(key, result)
+
+  def _WaitForTurn(self, device_id, priority):
+    """Waits until our scheduler admits a command.
+
+    Args:
+      device_id: string device id, or None
+      priority: string, one of lab_common.PRIORITIES
+    Returns:
+      The admitted Ticket, which the caller must Release, or None if the
+      client has been lost.
+    """
+    scheduler = self.server.scheduler
+    ticket = scheduler.Submit(device_id, self.client_address[0],
+                              priority=priority)
+    while not ticket.admitted_event.wait(1):
+      if select.select([self.rfile], [], [], 0)[0]:
+        scheduler.Release(ticket)  # As noted in _RunCommand
+        return None
+    return ticket
+
+  @classmethod
+  def _ReadChunk(cls, from_stream, to_params, to_fs, to_cache=None):
     """Reads the next chunk and updates the to_params list.
 
     Args:
       from_stream: stream to read from
       to_params: List of Params
       to_fs: TempFileSystem
+      to_cache: optional UploadCache, for digest-only input files
     Returns:
       False if there are no more chunks, else True.
     Raises:
@@ -142,7 +793,63 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     header = lab_common.ChunkHeader()
     header_line = from_stream.readline()
     header.Parse(header_line)
+    return cls._ReadChunkBody(
+        header, header_line, from_stream, to_params, to_fs, to_cache)
+
+  @classmethod
+  def _ReadBatchChunk(cls, from_stream, to_batch, to_fs, to_cache=None):
+    """Reads the next batch chunk and updates the to_batch list.
+
+    Args:
+      from_stream: stream to read from
+      to_batch: List of Params lists, one per command
+      to_fs: TempFileSystem
+      to_cache: optional UploadCache, for digest-only input files
+    Returns:
+      False if there are no more chunks, else True.
+    Raises:
+      ValueError: when given an invalid chunk.
+    """
+    header = lab_common.ChunkHeader()
+    header_line = from_stream.readline()
+    header.Parse(header_line)
+
+    if header.len_ > 0:
+      # Commands must be sent in order, like their arguments.
+      cmd_index = (int(header.cmd_)
+                   if header.cmd_ and header.cmd_.isdigit() else None)
+      if cmd_index == len(to_batch):
+        if to_batch and to_batch[-1] and to_batch[-1][-1].in_fp:
+          # Close the prev command's last input file
+          cls._CloseInputFile(to_batch[-1][-1], to_cache)
+        to_batch.append([])
+      elif cmd_index is None or cmd_index != len(to_batch) - 1:
+        raise ValueError('Expecting cmd %s or %s, not: %s' % (
+            len(to_batch) - 1, len(to_batch), header_line))
+      header.cmd_ = None  # Compare args as if they weren't batched
+    elif not to_batch:
+      raise ValueError('Empty batch')
+
+    return cls._ReadChunkBody(
+        header, header_line, from_stream, to_batch[-1], to_fs, to_cache)
+
+  @classmethod
+  def _ReadChunkBody(cls, header, header_line, from_stream, to_params, to_fs,
+                     to_cache):
+    """Reads the rest of a chunk and updates the to_params list.
 
+    Args:
+      header: parsed ChunkHeader
+      header_line: string header line, for error messages
+      from_stream: stream to read from
+      to_params: List of Params
+      to_fs: TempFileSystem
+      to_cache: optional UploadCache, for digest-only input files
+    Returns:
+      False if there are no more chunks, else True.
+    Raises:
+      ValueError: when given an invalid chunk.
+    """
     # Get the curr arg, which might be a continuation of the prev arg
     curr = None
     prev = (to_params[-1] if to_params else None)
@@ -166,8 +873,7 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     if curr != prev and prev and prev.in_fp:
       # Close the prev arg's input file
-      prev.in_fp.close()
-      prev.in_fp = None
+      cls._CloseInputFile(prev, to_cache)
 
     if curr == prev:
       prev.header.len_ = header.len_
@@ -177,7 +883,9 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         raise ValueError('Duplicate header: %s' % header_line)
 
     if header.len_ <= 0:
-      # End of chunks
+      # End of chunks, followed by an empty trailer
+      if from_stream.readline() != '\r\n':
+        raise ValueError('Request does not end with crlf')
       return False
 
     if not header.in_ and not header.out_:
@@ -198,10 +906,21 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if in_fn != parent_fn and not in_fn.startswith(parent_fn + '/'):
           raise ValueError('Invalid arg[%s] input path "%s"' % (
               curr.index, header.in_))
-        if not header.is_absent_:
+        if header.is_cached_:
+          # Only a digest, so the cache provides the file
+          if header.is_tar_ or not header.digest_:
+            raise ValueError('Invalid header: %s' % header_line)
+          curr.is_cache_miss = not (
+              to_cache and to_cache.Lookup(header.digest_, in_fn))
+        elif not header.is_absent_:
           curr.in_fp = (
               lab_common.Untar(parent_fn) if header.is_tar_ else
               open(in_fn, 'wb'))
+          if header.digest_ and to_cache:
+            # Verify the digest as we read, so we can add the file to our
+            # cache
+            to_cache.BeginUpload(header.digest_)
+            curr.in_digest = hashlib.sha1()
         curr.value = in_fn
       if header.is_absent_ or header.is_empty_:
         lab_common.ReadExactly(from_stream, header.len_)
@@ -210,7 +929,10 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         while bytes_read < header.len_:
           data = from_stream.read(min(MAX_READ, header.len_ - bytes_read))
           bytes_read += len(data)
+          curr.num_bytes += len(data)
           curr.in_fp.write(data)
+          if curr.in_digest:
+            curr.in_digest.update(data)
     else:
       # Output file placeholder
       lab_common.ReadExactly(from_stream, header.len_)
@@ -219,6 +941,10 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       if out_fn != curr.out_dn and not out_fn.startswith(curr.out_dn + '/'):
         raise ValueError('Invalid arg[%s] output path "%s"' % (
             curr.index, header.out_))
+      if (header.compression_ is not None and
+          header.compression_ not in lab_common.COMPRESSIONS):
+        raise ValueError('Unknown arg[%s] compression: %s' % (
+            curr.index, header.compression_))
       curr.value = out_fn
 
     # Read end-of-chunk
@@ -228,12 +954,85 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     # Keep reading chunks
     return True
 
+  @staticmethod
+  def _CloseInputFile(curr, to_cache, aborted=False):
+    """Closes an input file and, if it has a verified digest, caches it.
+
+    Args:
+      curr: Param with non-None in_fp
+      to_cache: optional UploadCache
+      aborted: bool, True if the file is incomplete
+    """
+    curr.in_fp.close()
+    curr.in_fp = None
+    if curr.in_digest:
+      # Ignore bogus client digests, otherwise we'd poison our cache.
+      verified = (not aborted and
+                  curr.in_digest.hexdigest() == curr.header.digest_)
+      to_cache.EndUpload(curr.header.digest_,
+                         curr.value if verified else None)
+      curr.in_digest = None
+
+  @staticmethod
+  def _GetDeviceId(reqs):
+    """Returns a parsed command's Android serial or iOS UDID, if any.
+
+    Args:
+      reqs: List of Parameters, from _ValidateCommand
+    Returns:
+      string device id, or None
+    """
+    for req in reqs:
+      if isinstance(req, (lab_common.AndroidSerialParameter,
+                          lab_common.IOSDeviceIdParameter)):
+        return str(req.value)
+    return None
+
+  @staticmethod
+  def _GetCommandName(reqs):
+    """Returns a parsed command's args without its device id.
+
+    Args:
+      reqs: List of Parameters, from _ValidateCommand
+    Returns:
+      List of strings, e.g. ['adb', 'shell', 'getprop'] for
+      "adb -s X shell getprop"
+    """
+    name = []
+    for req in reqs:
+      if isinstance(req, (lab_common.AndroidSerialParameter,
+                          lab_common.IOSDeviceIdParameter)):
+        name.pop()  # Ignore the device id and its "-s" or "-u" option
+      else:
+        name.append(str(req.value))
+    return name
+
+  @classmethod
+  def _GetPriority(cls, reqs):
+    """Returns a parsed command's priority.
+
+    Args:
+      reqs: List of Parameters, from _ValidateCommand
+    Returns:
+      string, one of lab_common.PRIORITIES
+    """
+    if any(isinstance(req, (lab_common.InputFileParameter,
+                            lab_common.OutputFileParameter)) for req in reqs):
+      return 'bulk'
+    name = cls._GetCommandName(reqs)
+    for command in HIGH_PRIORITY_COMMANDS:
+      if name[:len(command)] == command:
+        return 'high'
+    return 'normal'
+
   @staticmethod
   def _ValidateCommand(params):
     """Verifies the client's command is valid and allowed.
 
     Args:
       params: List of client-provided Params
+    Returns:
+      List of parsed Parameters, one per Param
     Raises:
       ValueError: if the command is illegal.
     """
@@ -261,16 +1060,57 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       if out_required != out_provided:
         raise ValueError('arg[%s]=%s %s output file', index, required,
                          'provides' if out_provided else 'lacks')
+    return reqs
 
-  def _BeginResponse(self):
-    """Begin the server response."""
-    # This puts the output data into a MIME format
+  def _BeginResponse(self, framing):
+    """Begin the server response.
+
+    Args:
+      framing: TextFraming or BinaryFraming, from _GetFraming
+    """
     self.send_response(httplib.OK)
-    self.send_header('Content-Type', 'text/plain; charset=utf=8')
-    self.send_header('Transfer-Encoding', 'chunked')
-    self.send_header('Content-Encoding', 'UTF-8')
+    for key, value in (self._GetResponseHeaders(framing) +
+                       self._GetFeatureHeaders(self.server)):
+      self.send_header(key, value)
     self.end_headers()
 
+  @staticmethod
+  def _GetFraming(accepted):
+    """Returns the framing for our response.
+
+    Args:
+      accepted: string FRAMING_HEADER value, e.g. '2', or None
+    Returns:
+      TextFraming or BinaryFraming.
+    """
+    if (accepted and lab_common.BINARY_FRAMING.VERSION in
+        [version.strip() for version in accepted.split(',')]):
+      return lab_common.BINARY_FRAMING
+    return lab_common.TEXT_FRAMING
+
+  @staticmethod
+  def _GetResponseHeaders(framing):
+    """Returns our response's (key, value) headers.
+
+    Args:
+      framing: TextFraming or BinaryFraming
+    """
+    if framing is lab_common.BINARY_FRAMING:
+      # Our frames mark the end of the response, so we don't need a
+      # Content-Length to keep the connection alive.
+      return [('Content-Type', 'application/octet-stream'),
+              (lab_common.FRAMING_HEADER, framing.VERSION)]
+    # This puts the output data into a MIME format
+    return [('Content-Type', 'text/plain; charset=utf=8'),
+            ('Transfer-Encoding', 'chunked'),
+            ('Content-Encoding', 'UTF-8')]
+
+  def send_error(self, code, message=None):  # pylint: disable=g-bad-name
+    """Counts the error, then sends it."""
+    if self.server.metrics:
+      self.server.metrics.Add('errors_total', code=code)
+    BaseHTTPServer.BaseHTTPRequestHandler.send_error(self, code, message)
+
   def log_request(self, code='-', size='-'):  # pylint: disable=g-bad-name
     """Suppresses worthless logging."""
     if (re.match(r'^POST / HTTP/1.[01]$', self.requestline) and
@@ -281,73 +1121,101 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   def log_message(self, fmt, *args):  # pylint: disable=g-bad-name
     """Logs to stderr."""
-    # Sample log output: I0313 14:23:49.512168 hostname adb logcat
-    now = datetime.datetime.now()
-    timestamp = now.strftime('I%m%d %T') + ('.%06d' % now.microsecond)
     # Just keep up to the first two elements of the domain name.
     hostname = '.'.join(self.address_string().split('.', 2)[:2])
-    print >>sys.stderr, '%s %s - %s' % (timestamp, hostname, fmt % args)
+    LogMessage(hostname, fmt, *args)
+
+  @staticmethod
+  def _PopenCommand(args, server=None):
+    """Starts a command with stdout and stderr pipes.
+
+    Args:
+      args: List of strings
+      server: optional server, whose shell_pool and adb_port let us run
+          supported adb commands without starting an adb process
+    Returns:
+      subprocess.Popen, or a ThreadedProcess
+    """
+    if server and server.shell_pool:
+      proc = ShellSessionProcess.Create(args, server.shell_pool)
+      if proc:
+        return proc
+    if server and server.adb_port:
+      proc = AdbHostProcess.Create(args, server.adb_port)
+      if proc:
+        return proc
+    # bufsize=0 sets stdout/stderr to be unbuffered.  Even with this
+    #   option,the command must periodically flush its output, otherwise we
+    #   it'll be buffered at the OS layer.
+    # close_fds=True ensures that, if we indirectly start the adb server, it
+    #   won't inherit our server port and cause "Address already in use"
+    #   errors.
+    return subprocess.Popen(
+        args, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        close_fds=True, shell=False)
 
   @staticmethod
-  def _RunCommand(args, from_stream, to_stream):
+  def _RunCommand(args, from_stream, to_stream, server=None):
     """Runs a command and returns its status in the response body.
 
     Args:
       args: List of strings
       from_stream: stream to read from
       to_stream: stream to write to
+      server: optional server, as in _PopenCommand
     """
-    stdout = lab_common.ChunkedOutputStream(lab_common.ChunkHeader(
+    stdout = lab_common.CoalescingOutputStream(lab_common.ChunkHeader(
         '1'), to_stream)
-    stderr = lab_common.ChunkedOutputStream(lab_common.ChunkHeader(
+    stderr = lab_common.CoalescingOutputStream(lab_common.ChunkHeader(
         '2'), to_stream)
     exit_stream = lab_common.ChunkedOutputStream(lab_common.ChunkHeader(
         'exit'), to_stream)
 
     try:
-      # bufsize=0 sets stdout/stderr to be unbuffered.  Even with this
-      #   option,the command must periodically flush its output, otherwise we
-      #   it'll be buffered at the OS layer.
-      # close_fds=True ensures that, if we indirectly start the adb server, it
-      #   won't inherit our server port and cause "Address already in use"
-      #   errors.
-      proc = subprocess.Popen(
-          args, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-          close_fds=True, shell=False)
+      proc = LabDeviceProxyRequestHandler._PopenCommand(args, server)
     except Exception, e:  # pylint: disable=broad-except
       stderr.write('%s\n' % e)
+      stderr.flush()
       exit_stream.write(str(getattr(e, 'returncode', getattr(e, 'errno', 1))))
       return
 
-    while True:
-      # Through observation, it was discovered that from_stream becomes readable
-      # immediately after a client ctrl-c, so if/when it becomes readable
-      # the client has been lost and the server should break out of the select.
-      reads = [proc.stdout, proc.stderr, from_stream]  # streams to select from
-      rlist, _, _ = select.select(reads,
-                                  [],  # writes
-                                  [],  # exceptions
-                                  2)  # timeout
-      read_out = ''
-      read_err = ''
-      if from_stream in rlist:
-        proc.kill()
-        break
-      if proc.stdout in rlist:
-        read_out = os.read(proc.stdout.fileno(), MAX_READ)
-        if read_out:
+    metrics = (server.metrics if server else None)
+    if metrics:
+      metrics.Add('child_processes', 1)
+    try:
+      while True:
+        # Through observation, it was discovered that from_stream becomes readable
+        # immediately after a client ctrl-c, so if/when it becomes readable
+        # the client has been lost and the server should break out of the select.
+        reads = [proc.stdout, proc.stderr, from_stream]  # streams to select from
+        # Wake up when our batched output is due.
+        timeouts = [t for t in (stdout.GetTimeout(), stderr.GetTimeout())
+                    if t is not None]
+        rlist, _, _ = select.select(reads,
+                                    [],  # writes
+                                    [],  # exceptions
+                                    min(timeouts + [2]))  # timeout
+        read_out = ''
+        read_err = ''
+        if from_stream in rlist:
+          proc.kill()
+          break
+        if proc.stdout in rlist:
+          read_out = os.read(proc.stdout.fileno(), MAX_READ)
           stdout.write(read_out)
-          stdout.flush()
-      if proc.stderr in rlist:
-        read_err = os.read(proc.stderr.fileno(), MAX_READ)
-        if read_err:
+        if proc.stderr in rlist:
+          read_err = os.read(proc.stderr.fileno(), MAX_READ)
           stderr.write(read_err)
+        stdout.SendDue()
+        stderr.SendDue()
+        if proc.poll() is not None and not read_out and not read_err:
+          stdout.flush()
           stderr.flush()
-      if proc.poll() is not None and not read_out and not read_err:
-        exit_stream.write(str(proc.returncode))
-        break
-
-    stdout.close()
+          exit_stream.write(str(proc.returncode))
+          break
+    finally:
+      if metrics:
+        metrics.Add('child_processes', -1)
 
   @classmethod
   def _WriteOutputFile(cls, curr, to_stream):
@@ -370,8 +1238,10 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       fn = (os.path.join(out_dn, out_fns[0]) if len(out_fns) == 1 else None)
       if fn and os.path.isfile(fn):
         with open(fn, 'rb') as fp:
+          curr.num_bytes = os.fstat(fp.fileno()).st_size
+          num_sent = cls._SendFile(header, fp, to_stream)
           data = fp.read(MAX_READ)
-          if not data:
+          if not data and not num_sent:
             lab_common.SendChunk(header, None, to_stream)
           else:
             while data:
@@ -379,10 +1249,36 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
               data = fp.read(MAX_READ)
         return
     header.is_tar_ = True
-    lab_common.SendTar(out_dn, '/', header, to_stream)
+    curr.num_bytes = sum(os.lstat(os.path.join(dn, fn)).st_size
+                         for dn, _, fns in os.walk(out_dn) for fn in fns)
+    lab_common.SendTar(out_dn, '/', header, to_stream,
+                       curr.header.compression_)
+
+  @staticmethod
+  def _SendFile(header, fp, to_stream):
+    """Sends a large file via sendfile, if possible.
+
+    Args:
+      header: ChunkHeader
+      fp: file object, at its start
+      to_stream: stream to write to
+    Returns:
+      The int number of bytes sent, which may be 0.  The caller must send the
+      rest of the file, from fp's current position.
+    """
+    num_bytes = os.fstat(fp.fileno()).st_size
+    if num_bytes < MIN_SENDFILE_SIZE:
+      return 0
+    num_sent = 0
+    while num_sent < num_bytes:
+      chunk_size = min(MAX_SENDFILE_CHUNK, num_bytes - num_sent)
+      if not lab_common.SendFileChunk(header, fp, chunk_size, to_stream):
+        break
+      num_sent += chunk_size
+    return num_sent
 
   @classmethod
-  def _WriteChunks(cls, params, to_stream):
+  def _WriteOutputFiles(cls, params, to_stream):
     """Writes the output file chunks to the client.
 
     Args:
@@ -392,17 +1288,3129 @@ class LabDeviceProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     for curr in params:
       if curr.out_dn:
         cls._WriteOutputFile(curr, to_stream)
-    to_stream.write('0\r\n\r\n')
 
 
-class Param(object):
-  """A server-side arg."""
+class LockedChunkStream(object):
+  """A stream wrapper that lets multiple threads send whole chunks."""
 
-  index = None   # int
-  value = None   # string
-  header = None  # ChunkHeader
-  in_fp = None   # File object
-  out_dn = None  # string path
+  def __init__(self, to_stream):
+    self._to_stream = to_stream
+    self._lock = threading.Lock()
+
+  def SendChunk(self, header, data, framing=None):
+    with self._lock:
+      lab_common.SendChunk(header, data, self._to_stream, framing)
+
+  def SendFileChunk(self, header, fp, num_bytes, framing=None):
+    with self._lock:
+      return lab_common.SendFileChunk(header, fp, num_bytes, self._to_stream,
+                                      framing)
+
+  def SendEnd(self, framing=None):
+    with self._lock:
+      lab_common.SendEnd(self._to_stream, framing)
+
+  def flush(self):  # pylint: disable=invalid-name
+    with self._lock:
+      self._to_stream.flush()
+
+
+class ResultRecorder(object):
+  """A stream wrapper that records a command's chunks for our ResultCache."""
+
+  def __init__(self, to_stream):
+    self._to_stream = to_stream
+    self.result = []  # List of (chunk id, data) tuples
+
+  def SendChunk(self, header, data, framing=None):
+    self.result.append((header.id_, data))
+    lab_common.SendChunk(header, data, self._to_stream, framing)
+
+  def flush(self):  # pylint: disable=invalid-name
+    self._to_stream.flush()
+
+  @staticmethod
+  def Replay(result, to_stream):
+    """Sends a recorded result's chunks.
+
+    Args:
+      result: List of (chunk id, data) tuples
+      to_stream: stream to write to
+    """
+    for id_, data in result:
+      lab_common.SendChunk(lab_common.ChunkHeader(id_), data, to_stream)
+    to_stream.flush()
+
+
+class EventLoopHTTPServer(object):
+  """Serves all connections and commands from a single event loop.
+
+  The ThreadedHTTPServer ties up a thread per connection for the life of its
+  command, e.g. an "adb logcat".  This server instead multiplexes every
+  client socket and command pipe with a Poller, so an idle log tail costs
+  only its buffers.  Requests are read, validated and answered with the same
+  chunk protocol and LabDeviceProxyRequestHandler methods as the threaded
+  server.
+  """
+
+  max_parallel = MAX_PARALLEL  # int
+  scheduler = None  # CommandScheduler
+  upload_cache = None  # UploadCache
+  result_cache = None  # ResultCache
+  inventory = None  # DeviceInventory
+  adb_port = None  # int, if adb commands use the adb server's host protocol
+  shell_pool = None  # ShellSessionPool
+  metrics = None  # ServerMetrics
+  recorder = None  # TrafficRecorder
+
+  def __init__(self, server_address):
+    """Binds the server socket.
+
+    Args:
+      server_address: (host, port) tuple
+    """
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.bind(server_address)
+    self.socket.listen(socket.SOMAXCONN)
+    self.socket.setblocking(0)
+    self.server_address = self.socket.getsockname()
+    self._poller = Poller()
+    self._handlers = {}  # fd -> function(readable, writable)
+    self._connections = set()  # EventLoopConnections
+    self._wakeup_fds = []  # Pipe for SIGCHLD wakeups
+    self._calls = collections.deque()  # CallSoon functions
+    self._timers = []  # CallLater heap of (time, func, args)
+    self._thread_calls = collections.deque()  # CallFromThread functions
+    self._thread_call_fds = os.pipe()  # Wakes us for CallFromThread
+    for fd in self._thread_call_fds:
+      fcntl.fcntl(fd, fcntl.F_SETFL,
+                  fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self._is_shut_down = False
+    self.Watch(self.socket.fileno(), self._Accept, True, False)
+    self.Watch(self._thread_call_fds[0], self._OnThreadCall, True, False)
+
+  def serve_forever(self, poll_interval=0.5):  # pylint: disable=g-bad-name
+    """Runs the event loop until shutdown.
+
+    Args:
+      poll_interval: float seconds between checks for idle connections and,
+          in case we can't watch for SIGCHLD, exited commands
+    """
+    self._WatchChildSignals()
+    check_time = time.time() + poll_interval
+    while not self._is_shut_down:
+      timeout = poll_interval
+      if self._calls:
+        timeout = 0
+      elif self._timers:
+        timeout = max(0, min(timeout, self._timers[0][0] - time.time()))
+      events = self._poller.Poll(timeout)
+      for fd, readable, writable in events:
+        handler = self._handlers.get(fd)
+        if handler:
+          handler(readable, writable)
+      now = time.time()
+      while self._timers and self._timers[0][0] <= now:
+        _, func, args = heapq.heappop(self._timers)
+        self._calls.append((func, args))
+      for _ in range(len(self._calls)):
+        func, args = self._calls.popleft()
+        func(*args)
+      if time.time() >= check_time:
+        check_time = time.time() + poll_interval
+        for conn in list(self._connections):
+          conn.CheckTimers()
+
+  def shutdown(self):  # pylint: disable=g-bad-name
+    """Stops the event loop, closes all connections and kills all commands."""
+    self._is_shut_down = True
+    for conn in list(self._connections):
+      conn.Close()
+    self.Unwatch(self.socket.fileno())
+    self.socket.close()
+    for fd in self._wakeup_fds:
+      self.Unwatch(fd)
+      os.close(fd)
+    self._wakeup_fds = []
+    self.Unwatch(self._thread_call_fds[0])
+    for fd in self._thread_call_fds:
+      os.close(fd)
+
+  def CallSoon(self, func, *args):
+    """Calls a function from our event loop, after the current handler.
+
+    Args:
+      func: function
+      *args: function args
+    """
+    self._calls.append((func, args))
+
+  def CallFromThread(self, func, *args):
+    """Calls a function from our event loop, from any thread.
+
+    Args:
+      func: function
+      *args: function args
+    """
+    if self._is_shut_down:
+      return
+    self._thread_calls.append((func, args))
+    try:
+      os.write(self._thread_call_fds[1], 'x')
+    except OSError, e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise  # Else the pipe is full, so we'll wake up anyway
+
+  def CallLater(self, delay, func, *args):
+    """Calls a function from our event loop, after the given delay.
+
+    Args:
+      delay: float seconds
+      func: function
+      *args: function args
+    """
+    heapq.heappush(self._timers, (time.time() + delay, func, args))
+
+  def Watch(self, fd, handler, readable, writable):
+    """Sets a file descriptor's handler and events of interest.
+
+    Args:
+      fd: int file descriptor
+      handler: function(readable, writable)
+      readable: bool, True to call the handler when fd is readable
+      writable: bool, True to call the handler when fd is writable
+    """
+    self._handlers[fd] = handler
+    self._poller.Register(fd, readable, writable)
+
+  def Unwatch(self, fd):
+    """Forgets a file descriptor, which must be done before it's closed.
+
+    Args:
+      fd: int file descriptor
+    """
+    self._handlers.pop(fd, None)
+    self._poller.Unregister(fd)
+
+  def RemoveConnection(self, conn):
+    self._connections.discard(conn)
+
+  def _Accept(self, unused_readable, unused_writable):
+    """Accepts all pending connections."""
+    while True:
+      try:
+        sock, client_address = self.socket.accept()
+      except socket.error, e:
+        if e.errno == errno.ECONNABORTED:
+          continue
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          LogMessage('-', 'Accept failed: %s', e)
+        return
+      self._connections.add(EventLoopConnection(self, sock, client_address))
+
+  def _WatchChildSignals(self):
+    """Wakes our event loop when a command exits."""
+    read_fd, write_fd = os.pipe()
+    for fd in (read_fd, write_fd):
+      fcntl.fcntl(fd, fcntl.F_SETFL,
+                  fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    try:
+      signal.set_wakeup_fd(write_fd)
+    except ValueError:
+      # We're not in the main thread, so we'll poll every poll_interval.
+      os.close(read_fd)
+      os.close(write_fd)
+      return
+    self._wakeup_fds = [read_fd, write_fd]
+    signal.signal(signal.SIGCHLD, lambda *unused_args: None)
+    # Restart system calls that our handler interrupts, other than Poll's.
+    signal.siginterrupt(signal.SIGCHLD, False)
+    self.Watch(read_fd, self._OnChildSignal, True, False)
+
+  def _OnThreadCall(self, unused_readable, unused_writable):
+    """Calls the CallFromThread functions."""
+    try:
+      while os.read(self._thread_call_fds[0], MAX_READ):
+        pass
+    except OSError, e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        raise
+    while self._thread_calls:
+      func, args = self._thread_calls.popleft()
+      func(*args)
+
+  def _OnChildSignal(self, unused_readable, unused_writable):
+    """Finishes the commands that have exited."""
+    try:
+      while os.read(self._wakeup_fds[0], MAX_READ):
+        pass
+    except OSError, e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        raise
+    for conn in list(self._connections):
+      conn.CheckCommands()
+
+
+class EventLoopConnection(object):
+  """A client connection, driven by an EventLoopHTTPServer.
+
+  A connection reads a request's headers and chunks as they arrive, runs its
+  commands, queues their chunks in an OutputBuffer, and waits for that
+  buffer to drain before it reads the next request.
+
+  Once a request sends an input file, that chunk and the rest of the
+  request's chunks are handed to an input thread, which writes, untars and
+  caches the files, so a large upload or slow disk doesn't block our event
+  loop.  We stop reading the request while HIGH_WATER bytes are unwritten.
+  Likewise, each command's output files are sent by an output thread, see
+  EventLoopCommand.Finish.
+  """
+
+  READING_HEADERS = 'headers'
+  READING_BODY = 'body'
+  RUNNING = 'running'
+  SENDING = 'sending'
+  CLOSED = 'closed'
+
+  MAX_HEADER_BYTES = 65536
+  RECV_SIZE = 65536
+  HIGH_WATER = 1 << 20  # Stop reading command output while more is unsent
+
+  def __init__(self, server, sock, client_address):
+    """Starts reading requests from the given socket.
+
+    Args:
+      server: EventLoopHTTPServer
+      sock: connected socket.socket
+      client_address: (host, port) tuple
+    """
+    self._server = server
+    self._sock = sock
+    self._fd = sock.fileno()
+    # Log the client's address, since a hostname lookup would block our loop.
+    self._address = client_address[0]
+    self._state = self.READING_HEADERS
+    self._idle_time = time.time()
+    self._in_data = ''
+    self._out = OutputBuffer()
+    self._requestline = ''
+    self._headers = None  # mimetools.Message
+    self._close_connection = True
+
+    # The current POST request
+    self._batch = []  # List of Params lists
+    self._devices = []  # Device ids (or None), one per command
+    self._priorities = []  # Priorities, one per command
+    self._names = []  # Command names, one per command
+    self._priority = None  # string, from our priority header
+    self._to_stream = None  # FramedStream, for our response
+    self._parallel = None  # int, if it's a batch or fan-out
+    self._device_ids = None  # string, if it's a fan-out
+    self._is_batch = False
+    self._tmp_fs = None  # TempFileSystem
+    self._timestamps = []
+    self._upload_time = None  # When we read the last chunk
+    self._request_id = None  # string, from _NewRequestId
+    self._is_timed = False  # If we send a timing trailer
+    self._on_error = None  # HTTP status code
+    self._status = httplib.OK  # HTTP status code, for our TrafficRecorder
+    self._next_index = 0  # Index of the next command to start
+    self._running = []  # EventLoopCommands
+    self._has_inputs = False  # If we've handed chunks to our input thread
+    self._is_body_read = False  # If we've read the request's last chunk
+
+    # Our input thread's state, guarded by our input lock
+    self._input_lock = threading.Lock()
+    self._inputs = collections.deque()  # Chunks, see _QueueInput
+    self._input_bytes = 0  # Bytes in our queued chunks
+    self._input_thread = None  # threading.Thread, while it has chunks
+    self._input_cleanup = None  # Function for the thread to call on exit
+
+    sock.setblocking(0)
+    # See the client's _LabHTTPConnection.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._Watch()
+
+  def Close(self):
+    """Closes the connection and kills its commands."""
+    if self._state == self.CLOSED:
+      return
+    self._state = self.CLOSED
+    self._EndRequest()
+    self._out.close()
+    self._server.Unwatch(self._fd)
+    self._sock.close()
+    self._server.RemoveConnection(self)
+
+  def CheckTimers(self):
+    """Closes the connection if it's idle, and checks for exited commands."""
+    if (self._state == self.READING_HEADERS and not self._in_data and
+        time.time() - self._idle_time > KEEP_ALIVE_TIMEOUT):
+      self.Close()
+    else:
+      self.CheckCommands()
+
+  def CheckCommands(self):
+    """Finishes the commands that have exited."""
+    self._Handle(self._CheckCommands)
+
+  def LogMessage(self, fmt, *args):
+    LogMessage(self._address, fmt, *args)
+
+  def _Handle(self, func, *args):
+    """Calls an event handler, then sends output and updates our events.
+
+    Args:
+      func: function
+      *args: function args
+    """
+    if self._state == self.CLOSED:
+      return  # E.g. an event for a pipe that we closed in this loop iteration
+    try:
+      try:
+        func(*args)
+      except Exception, e:  # pylint: disable=broad-except
+        if self._state not in (self.READING_BODY, self.RUNNING):
+          raise
+        self._FailRequest(e)
+      self._Send()
+    except Exception:  # pylint: disable=broad-except
+      self.LogMessage('Failed: %s\n%s', self._requestline,
+                      lab_common.GetStack())
+      self.Close()
+    if self._state != self.CLOSED:
+      self._Watch()
+
+  def _Watch(self):
+    """Updates our socket's and commands' events of interest."""
+    self._server.Watch(
+        self._fd, functools.partial(self._Handle, self._OnSocketEvent),
+        (self._state in (self.READING_HEADERS, self.READING_BODY,
+                         self.RUNNING) and
+         self._input_bytes <= self.HIGH_WATER),
+        len(self._out) > 0)
+    is_paused = (len(self._out) > self.HIGH_WATER)
+    for cmd in self._running:
+      if not is_paused:
+        cmd.OnOutputSent()
+      for pipe in cmd.pipes:
+        self._server.Watch(
+            pipe.fileno(),
+            functools.partial(self._Handle, self._OnPipeEvent, cmd, pipe),
+            not is_paused, False)
+
+  def _OnSocketEvent(self, readable, unused_writable):
+    """Reads the client's request, or notices that the client is gone."""
+    if not readable:
+      return
+    try:
+      data = self._sock.recv(self.RECV_SIZE)
+    except socket.error, e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        return
+      data = ''
+    if not data or self._state == self.RUNNING:
+      # As noted in _RunCommand, our socket becomes readable when the client
+      # has been lost.
+      self.Close()
+      return
+    self._in_data += data
+    self._idle_time = time.time()
+    self._ReadRequest()
+
+  def _OnPipeEvent(self, cmd, pipe, unused_readable, unused_writable):
+    """Sends a command's output, and notices when its pipes are closed."""
+    if cmd.ReadPipe(pipe) == '' and not cmd.pipes:
+      self._CheckCommands()
+    else:
+      self._ScheduleOutput(cmd)
+
+  def _ScheduleOutput(self, cmd):
+    """Sends a command's batched output when it's due."""
+    timeout = cmd.GetTimeout()
+    if timeout is not None and not cmd.is_output_scheduled:
+      cmd.is_output_scheduled = True
+      self._server.CallLater(
+          timeout, functools.partial(self._Handle, self._SendOutput, cmd))
+
+  def _SendOutput(self, cmd):
+    cmd.is_output_scheduled = False
+    cmd.SendDue()
+    self._ScheduleOutput(cmd)
+
+  def _Send(self):
+    """Sends as much output as the socket will take."""
+    while True:
+      while len(self._out):
+        try:
+          self._out.SendTo(self._sock)
+        except EnvironmentError, e:
+          if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return
+          self.Close()  # E.g. the client exited
+          return
+      if self._state != self.SENDING:
+        return
+      if self._close_connection:
+        self.Close()
+        return
+      # Keep-alive, so read the next request.
+      self._state = self.READING_HEADERS
+      self._idle_time = time.time()
+      self._ReadRequest()
+
+  def _ReadRequest(self):
+    """Reads as much of the buffered request as possible."""
+    while True:
+      if self._state == self.READING_HEADERS:
+        if not self._ReadHeaders():
+          return
+      elif self._state == self.READING_BODY and not self._is_body_read:
+        if not self._ReadBodyChunk():
+          return
+      else:
+        return
+
+  def _ReadHeaders(self):
+    """Reads the request line and headers, and answers all but a POST.
+
+    Returns:
+      True if the headers were read.
+    """
+    end = self._in_data.find('\r\n\r\n')
+    if end < 0:
+      if len(self._in_data) > self.MAX_HEADER_BYTES:
+        self._requestline = ''
+        self._SendError(httplib.REQUEST_ENTITY_TOO_LARGE)
+      return False
+    lines = self._in_data[:end + 2]
+    self._in_data = self._in_data[end + 4:]
+    self._requestline, lines = lines.split('\r\n', 1)
+    self._headers = mimetools.Message(StringIO.StringIO(lines), 0)
+
+    # As in BaseHTTPRequestHandler.parse_request
+    words = self._requestline.split()
+    version = (words[2] if len(words) == 3 else '')
+    if not re.match(r'HTTP/1\.[01]$', version):
+      self._SendError(httplib.BAD_REQUEST,
+                      'Bad request version (%r)' % version)
+      return True
+    connection = (self._headers.getheader('Connection') or '').lower()
+    self._close_connection = (
+        connection == 'close' or
+        (version == 'HTTP/1.0' and connection != 'keep-alive'))
+
+    command, path = words[:2]
+    page = (LabDeviceProxyRequestHandler._GetPage(path, self._server)
+            if command == 'GET' else None)
+    if page is not None:
+      content_type, response_data = page
+      headers = [('Content-Type', content_type),
+                 ('Content-Length', str(len(response_data)))]
+      self._SendResponse(
+          httplib.OK, headers +
+          LabDeviceProxyRequestHandler._GetFeatureHeaders(self._server))
+      self._out.write(response_data)
+      self._state = self.SENDING
+    elif command == 'GET':
+      self._SendError(httplib.METHOD_NOT_ALLOWED)
+    elif command == 'POST':
+      self._BeginPost()
+    else:
+      self._SendError(httplib.NOT_IMPLEMENTED,
+                      'Unsupported method (%r)' % command)
+    return True
+
+  def _BeginPost(self):
+    """Starts reading a POST request's chunks, as in do_POST."""
+    self._parallel = self._headers.getheader(lab_common.BATCH_HEADER)
+    self._device_ids = self._headers.getheader(lab_common.FANOUT_HEADER)
+    self._priority = self._headers.getheader(lab_common.PRIORITY_HEADER)
+    self._to_stream = lab_common.FramedStream(
+        self._out, LabDeviceProxyRequestHandler._GetFraming(
+            self._headers.getheader(lab_common.FRAMING_HEADER)))
+    self._is_batch = (self._parallel is not None and self._device_ids is None)
+    self._batch = ([] if self._is_batch else [[]])
+    self._tmp_fs = TempFileSystem()
+    self._timestamps = [('', time.time())]  # Never printed, only subtracted
+    self._request_id = LabDeviceProxyRequestHandler._NewRequestId()
+    self._is_timed = bool(self._headers.getheader(lab_common.TIMING_HEADER))
+    if self._server.metrics:
+      self._server.metrics.Add('active_requests', 1)
+    self._on_error = httplib.BAD_REQUEST
+    self._state = self.READING_BODY
+    if self._parallel is not None:
+      self._parallel = max(1, min(self._server.max_parallel,
+                                  int(self._parallel)))
+    if (self._priority is not None and
+        self._priority not in lab_common.PRIORITIES):
+      raise ValueError('Unknown priority: %s' % self._priority)
+
+  def _ReadBodyChunk(self):
+    """Reads the next chunk of a POST request, if it's fully buffered.
+
+    Returns:
+      True if a chunk was read.
+    Raises:
+      ValueError: when given an invalid chunk.
+    """
+    end = self._in_data.find('\r\n')
+    if end < 0:
+      if len(self._in_data) > self.MAX_HEADER_BYTES:
+        raise ValueError('Chunk header is too long')
+      return False
+    header = lab_common.ChunkHeader()
+    header.Parse(self._in_data[:end + 2])
+    if header.len_ > MAX_CHUNK:
+      raise ValueError('Chunk is too long: %s' % header.len_)
+    # The header line, data and crlf, or the last chunk's empty trailer.
+    chunk_len = end + 2 + header.len_ + 2
+    if len(self._in_data) < chunk_len:
+      return False
+    from_stream = StringIO.StringIO(self._in_data[:chunk_len])
+    self._in_data = self._in_data[chunk_len:]
+
+    if header.len_ == 0:
+      self._is_body_read = True
+    if self._has_inputs or (header.id_ or '')[:1] == 'i':
+      # This and later chunks may write, close or untar input files.
+      self._has_inputs = True
+      self._QueueInput(from_stream, chunk_len)
+      return self._input_bytes <= self.HIGH_WATER
+    if not self._ReadInputChunk(
+        from_stream, self._batch, self._tmp_fs, self._is_batch):
+      self._upload_time = time.time()
+      self._StartBatch()
+    return True
+
+  def _ReadInputChunk(self, from_stream, batch, tmp_fs, is_batch):
+    """Reads a request chunk into its batch, as in do_POST.
+
+    Args:
+      from_stream: stream with the chunk
+      batch: List of Params lists
+      tmp_fs: TempFileSystem
+      is_batch: bool, if the request is a batch
+    Returns:
+      False if there are no more chunks, else True.
+    Raises:
+      ValueError: when given an invalid chunk.
+    """
+    cache = self._server.upload_cache
+    if is_batch:
+      return LabDeviceProxyRequestHandler._ReadBatchChunk(
+          from_stream, batch, tmp_fs, cache)
+    return LabDeviceProxyRequestHandler._ReadChunk(
+        from_stream, batch[0], tmp_fs, cache)
+
+  def _QueueInput(self, from_stream, num_bytes):
+    """Hands a chunk to our input thread, which we start if needed.
+
+    Args:
+      from_stream: stream with the chunk
+      num_bytes: int size of the chunk
+    """
+    with self._input_lock:
+      self._inputs.append((self._request_id, from_stream, num_bytes,
+                           self._batch, self._tmp_fs, self._is_batch))
+      self._input_bytes += num_bytes
+      if not self._input_thread:
+        self._input_thread = threading.Thread(target=self._WriteInputs)
+        self._input_thread.daemon = True
+        self._input_thread.start()
+
+  def _WriteInputs(self):
+    """Reads our queued chunks, from our input thread, until there are none.
+
+    We call back our event loop after the last chunk, after an error, and
+    when our backlog falls below HIGH_WATER, so it reads more chunks.
+    """
+    while True:
+      with self._input_lock:
+        if not self._inputs:
+          self._input_thread = None
+          cleanup, self._input_cleanup = self._input_cleanup, None
+          break
+        request_id, from_stream, num_bytes, batch, tmp_fs, is_batch = (
+            self._inputs[0])
+      has_more = True
+      exc_info = None
+      try:
+        has_more = self._ReadInputChunk(from_stream, batch, tmp_fs, is_batch)
+      except Exception:  # pylint: disable=broad-except
+        exc_info = sys.exc_info()
+      with self._input_lock:
+        if self._inputs and self._inputs[0][0] == request_id:
+          self._inputs.popleft()
+          self._input_bytes -= num_bytes
+          if exc_info:
+            self._inputs.clear()
+            self._input_bytes = 0
+        is_resumed = (self._input_bytes <= self.HIGH_WATER <
+                      self._input_bytes + num_bytes)
+      if exc_info or not has_more or is_resumed:
+        self._server.CallFromThread(self._Handle, self._OnInputsRead,
+                                    request_id, has_more, exc_info)
+    if cleanup:
+      cleanup()
+
+  def _OnInputsRead(self, request_id, has_more, exc_info):
+    """Handles our input thread's progress, from our event loop.
+
+    Args:
+      request_id: string, of the request whose chunk was read
+      has_more: bool, False after the request's last chunk
+      exc_info: sys.exc_info() tuple, if the chunk was invalid
+    """
+    if request_id != self._request_id or self._state != self.READING_BODY:
+      return  # E.g. the client has been lost
+    if exc_info:
+      raise exc_info[0], exc_info[1], exc_info[2]
+    if not has_more:
+      self._upload_time = time.time()
+      self._StartBatch()
+    else:
+      self._ReadRequest()
+
+  def _StartBatch(self):
+    """Validates the fully-read request, as in do_POST, and runs it."""
+    if any(curr.is_cache_miss for params in self._batch for curr in params):
+      # The client will re-send the request with the file content.
+      self._on_error = httplib.EXPECTATION_FAILED
+      raise ValueError('Input file not in upload cache')
+
+    self._on_error = httplib.FORBIDDEN
+    if self._device_ids is not None:
+      self._batch = LabDeviceProxyRequestHandler._FanOutCommand(
+          self._batch[0], self._device_ids.split())
+      self._parallel = (self._parallel if self._parallel is not None else 1)
+    for params in self._batch:
+      reqs = LabDeviceProxyRequestHandler._ValidateCommand(params)
+      self._devices.append(LabDeviceProxyRequestHandler._GetDeviceId(reqs))
+      self._priorities.append(
+          self._priority or LabDeviceProxyRequestHandler._GetPriority(reqs))
+      self._names.append(LabDeviceProxyRequestHandler._GetCommandName(reqs))
+
+    self._on_error = httplib.INTERNAL_SERVER_ERROR
+    self._SendResponse(
+        httplib.OK, LabDeviceProxyRequestHandler._GetResponseHeaders(
+            self._to_stream.framing) +
+        LabDeviceProxyRequestHandler._GetFeatureHeaders(self._server))
+    self._on_error = None  # Sent our response status code
+
+    self._timestamps.append(('req', time.time()))
+    self._state = self.RUNNING
+    self._StartCommands()
+
+  def _StartCommands(self):
+    """Starts commands until the batch is done or at its parallel limit."""
+    while (self._next_index < len(self._batch) and
+           len(self._running) < (self._parallel or 1)):
+      to_stream = self._to_stream
+      if self._parallel is not None:
+        # Tag each chunk with its command index, as in _RunBatch
+        to_stream = lab_common.BatchCommandStream(to_stream, self._next_index)
+      index = self._next_index
+      self._next_index += 1
+      cmd = EventLoopCommand(self._server, self._batch[index], to_stream)
+      cmd.device_id = self._devices[index]
+      self._running.append(cmd)
+      if not self._LookupResult(cmd, self._names[index],
+                                self._priorities[index]):
+        self._SubmitCommand(cmd, self._priorities[index])
+
+  def _LookupResult(self, cmd, name, priority):
+    """Looks up a command's inventory or cached result, as in _RunCommandInTurn.
+
+    Args:
+      cmd: EventLoopCommand
+      name: List of strings, from _GetCommandName
+      priority: string, one of lab_common.PRIORITIES
+    Returns:
+      True if the command will replay an inventory, cached or shared result,
+      else False if it must be run.
+    """
+    inventory = self._server.inventory
+    output = (inventory.GetOutput(name) if inventory and not cmd.device_id
+              else None)
+    if output is not None:
+      self._server.CallSoon(self._Handle, self._ReplayResult, cmd, priority,
+                            [('1', output), ('exit', '0')])
+      return True
+    cache = self._server.result_cache
+    if not cache:
+      return False
+    cmd.is_mutating = cache.IsMutating(name)
+    ttl = cache.GetTTL(name)
+    if ttl is None:
+      return False
+    args = LabDeviceProxyRequestHandler._GetCommandArgs(cmd.params)
+    key = (cmd.device_id, tuple(args))
+    # A cache hit calls us back at once, but we replay it from our own
+    # handler, as in _StartCommands.
+    outcome = cache.Begin(key, ttl, functools.partial(
+        self._server.CallSoon, self._Handle, self._ReplayResult, cmd,
+        priority))
+    self.LogMessage('Result cache %s (%s): %s', outcome, cache.FormatStats(),
+                    ' '.join(args))
+    if outcome == ResultCache.MISS:
+      cmd.RecordResult(cache, key)
+      return False
+    return True
+
+  def _ReplayResult(self, cmd, priority, result):
+    """Replays a command's cached or shared result, or runs it if None."""
+    if cmd not in self._running:
+      return  # E.g. the client has been lost
+    if result is None:
+      self._SubmitCommand(cmd, priority)
+      return
+    cmd.Replay(result)
+    self._CheckCommands()
+
+  def _SubmitCommand(self, cmd, priority):
+    """Queues a command until our scheduler admits it."""
+    # The scheduler may admit the command from another connection's
+    # handler, so we start it from our own.
+    cmd.ticket = self._server.scheduler.Submit(
+        cmd.device_id, self._address,
+        functools.partial(self._server.CallSoon, self._Handle,
+                          self._StartCommand, cmd),
+        priority)
+
+  def _StartCommand(self, cmd, unused_ticket):
+    """Starts a command that our scheduler has admitted."""
+    if cmd not in self._running:
+      return  # E.g. the client has been lost
+    if 'wait' not in dict(self._timestamps):
+      self._timestamps.append(('wait', time.time()))
+    if cmd.is_mutating:
+      self._server.result_cache.Invalidate(cmd.device_id)
+    cmd.Start()
+    self._CheckCommands()
+
+  def _CheckCommands(self):
+    """Finishes exited commands, then starts more or ends the response."""
+    if self._state != self.RUNNING:
+      return
+    exited = [cmd for cmd in self._running
+              if not cmd.is_sending_files and cmd.Poll()]
+    if not exited:
+      return
+    for cmd in exited:
+      is_done = True
+      try:
+        is_done = cmd.Finish(
+            functools.partial(self._server.CallFromThread, self._Handle),
+            functools.partial(self._OnFilesSent, cmd))
+      finally:
+        if is_done:
+          self._EndCommand(cmd)
+    self._ContinueBatch()
+
+  def _OnFilesSent(self, cmd, exc_info):
+    """Ends a command whose output thread has sent its files.
+
+    Args:
+      cmd: EventLoopCommand
+      exc_info: sys.exc_info() tuple, if the files couldn't be sent
+    """
+    if cmd not in self._running:
+      return  # E.g. the client has been lost
+    self._EndCommand(cmd)
+    if exc_info:
+      raise exc_info[0], exc_info[1], exc_info[2]
+    self._ContinueBatch()
+
+  def _EndCommand(self, cmd):
+    """Releases a finished command's device."""
+    self._running.remove(cmd)
+    if cmd.ticket:
+      self._server.scheduler.Release(cmd.ticket)
+    if cmd.is_mutating:
+      self._server.result_cache.Invalidate(cmd.device_id)
+
+  def _ContinueBatch(self):
+    """Starts more commands, or ends the response once they're all done."""
+    if self._next_index < len(self._batch):
+      self._StartCommands()
+    elif not self._running:
+      self._timestamps.append(('cmd', time.time()))
+      if self._is_timed:
+        LabDeviceProxyRequestHandler._SendTiming(
+            self._request_id, self._batch, self._timestamps,
+            self._upload_time, self._to_stream)
+      lab_common.SendEnd(self._to_stream)
+      self._state = self.SENDING
+      self._EndRequest()
+
+  def _FailRequest(self, e):
+    """Handles a POST request error, as in do_POST.
+
+    Args:
+      e: Exception, which we're handling
+    """
+    self._timestamps.append(('err', time.time()))
+    if self._on_error != httplib.EXPECTATION_FAILED:  # Expected cache misses
+      self.LogMessage('Failed: %s\n%s', self._FormatBatch(),
+                      lab_common.GetStack())
+    if self._on_error is not None:
+      self._status = self._on_error
+      self._SendError(self._on_error, str(e))
+    else:
+      # Our chunked response is incomplete, so the client can't reuse it.
+      self._close_connection = True
+      self._state = self.SENDING
+    self._EndRequest()
+
+  def _EndRequest(self):
+    """Kills any running commands, then cleans up and logs a POST request."""
+    for cmd in self._running:
+      cmd.Kill()
+      if cmd.ticket:
+        self._server.scheduler.Release(cmd.ticket)
+    self._running = []
+    if not self._tmp_fs:
+      return
+    recorder = self._server.recorder
+    if recorder:
+      recorder.Record(
+          self._request_id, self._timestamps[0][1], self._status, self._batch,
+          self._device_ids, self._parallel, self._priority,
+          LabDeviceProxyRequestHandler._GetPhases(
+              self._timestamps + [('resp', time.time())], self._upload_time),
+          self._to_stream.num_bytes)
+    cleanup = functools.partial(self._CleanupInputs, self._batch,
+                                self._tmp_fs, self._server.upload_cache)
+    with self._input_lock:
+      self._inputs.clear()
+      self._input_bytes = 0
+      if self._input_thread:
+        # It may be writing an input file, so it cleans up when it's done.
+        self._input_cleanup = cleanup
+        cleanup = None
+    if cleanup:
+      cleanup()
+    self._timestamps.append(('resp', time.time()))
+
+    timings = ' '.join(
+        ['%s: %.1f' % (name, (timestamp - self._timestamps[i - 1][1]))
+         for i, (name, timestamp) in enumerate(self._timestamps) if i > 0])
+    self.LogMessage('(id: %s %s) %s', self._request_id, timings,
+                    self._FormatBatch())
+    metrics = self._server.metrics
+    if metrics:
+      metrics.ObserveRequest(
+          LabDeviceProxyRequestHandler._GetMetricsLabel(
+              self._batch, self._names),
+          LabDeviceProxyRequestHandler._GetPhases(
+              self._timestamps, self._upload_time),
+          *LabDeviceProxyRequestHandler._GetFileBytes(self._batch))
+      metrics.Add('active_requests', -1)
+
+    self._batch = []
+    self._devices = []
+    self._priorities = []
+    self._names = []
+    self._priority = None
+    self._to_stream = None
+    self._parallel = None
+    self._device_ids = None
+    self._is_batch = False
+    self._tmp_fs = None
+    self._timestamps = []
+    self._upload_time = None
+    self._request_id = None
+    self._is_timed = False
+    self._on_error = None
+    self._status = httplib.OK
+    self._next_index = 0
+    self._has_inputs = False
+    self._is_body_read = False
+
+  @staticmethod
+  def _CleanupInputs(batch, tmp_fs, cache):
+    """Closes a request's unfinished input files and removes its files.
+
+    Args:
+      batch: List of Params lists
+      tmp_fs: TempFileSystem
+      cache: UploadCache, or None
+    """
+    for params in batch:
+      for curr in params:
+        if curr.in_fp:
+          LabDeviceProxyRequestHandler._CloseInputFile(curr, cache,
+                                                       aborted=True)
+    tmp_fs.Cleanup()
+
+  def _FormatBatch(self):
+    return LabDeviceProxyRequestHandler._FormatBatch(self._batch)
+
+  def _SendResponse(self, code, headers):
+    """Queues a response's status line and headers.
+
+    Args:
+      code: int HTTP status code
+      headers: List of (key, value) string tuples
+    """
+    self._SendStatus(code, None)
+    for key, value in headers:
+      self._out.write('%s: %s\r\n' % (key, value))
+    self._out.write('\r\n')
+
+  def _SendError(self, code, message=None):
+    """Queues an error response and closes the connection, as in send_error.
+
+    Args:
+      code: int HTTP status code
+      message: optional string
+    """
+    short, explain = BaseHTTPServer.BaseHTTPRequestHandler.responses.get(
+        code, ('???', '???'))
+    message = (message or short)
+    if self._server.metrics:
+      self._server.metrics.Add('errors_total', code=code)
+    self.LogMessage('code %d, message %s', code, message)
+    self._SendStatus(code, message)
+    content = BaseHTTPServer.DEFAULT_ERROR_MESSAGE % {
+        'code': code, 'message': cgi.escape(message), 'explain': explain}
+    self._out.write('Content-Type: %s\r\n' %
+                    BaseHTTPServer.DEFAULT_ERROR_CONTENT_TYPE)
+    self._out.write('Content-Length: %d\r\n' % len(content))
+    self._out.write('Connection: close\r\n\r\n')
+    self._out.write(content)
+    self._close_connection = True
+    self._state = self.SENDING
+
+  def _SendStatus(self, code, message):
+    """Logs a request, as in log_request, and queues its status line.
+
+    Args:
+      code: int HTTP status code
+      message: optional string reason
+    """
+    if not (re.match(r'^POST / HTTP/1.[01]$', self._requestline) and
+            code == httplib.OK):
+      self.LogMessage('"%s" %s %s', self._requestline, code, '-')
+    if message is None:
+      message = BaseHTTPServer.BaseHTTPRequestHandler.responses.get(
+          code, ('',))[0]
+    message = message.replace('\r', ' ').replace('\n', ' ')
+    self._out.write('HTTP/1.1 %d %s\r\n' % (code, message))
+
+
+class EventLoopCommand(object):
+  """A command run by an EventLoopConnection, as in _RunCommand."""
+
+  def __init__(self, server, params, to_stream):
+    """Creates a command.
+
+    Args:
+      server: EventLoopHTTPServer
+      params: List of validated Params
+      to_stream: stream to write to
+    """
+    self._server = server
+    self._to_stream = None
+    self._stdout = None
+    self._stderr = None
+    self._SetStream(to_stream)
+    self._proc = None
+    self._is_proc_counted = False  # If our metrics count our running proc
+    self._returncode = None
+    self._is_replayed = False
+    self._cache = None  # ResultCache, if we're recording our result
+    self._cache_key = None
+    self._files_stream = None  # LoopChunkStream, while we send our files
+    self.params = params
+    self.pipes = []  # The proc's open stdout and stderr pipes
+    self.ticket = None  # Our CommandScheduler Ticket, once we're submitted
+    self.device_id = None  # string device id, or None
+    self.is_mutating = False  # If we invalidate our device's cached results
+    self.is_output_scheduled = False  # If SendDue is scheduled
+    self.is_sending_files = False  # If our output thread is running
+
+  def RecordResult(self, cache, key):
+    """Records our result, for a ResultCache.Begin that returned MISS.
+
+    Args:
+      cache: ResultCache
+      key: ResultCache key
+    """
+    self._cache = cache
+    self._cache_key = key
+    self._SetStream(ResultRecorder(self._to_stream))
+
+  def Replay(self, result):
+    """Sends a cached or shared result, instead of running the command.
+
+    Args:
+      result: List of (chunk id, data) tuples
+    """
+    ResultRecorder.Replay(result, self._to_stream)
+    self._returncode = int(result[-1][1])
+    self._is_replayed = True
+
+  def Start(self):
+    """Starts the command, or sends its startup error."""
+    args = LabDeviceProxyRequestHandler._GetCommandArgs(self.params)
+    try:
+      self._proc = LabDeviceProxyRequestHandler._PopenCommand(
+          args, self._server)
+    except Exception, e:  # pylint: disable=broad-except
+      self._stderr.write('%s\n' % e)
+      self._returncode = getattr(e, 'returncode', getattr(e, 'errno', 1))
+      return
+    if self._server.metrics:
+      self._server.metrics.Add('child_processes', 1)
+      self._is_proc_counted = True
+    self.pipes = [self._proc.stdout, self._proc.stderr]
+    for pipe in self.pipes:
+      fcntl.fcntl(pipe, fcntl.F_SETFL,
+                  fcntl.fcntl(pipe, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+  def ReadPipe(self, pipe):
+    """Reads and sends a pipe's available output.
+
+    Args:
+      pipe: file object, one of our pipes
+    Returns:
+      The string data read, '' at the end of the pipe (which closes it), or
+      None if no data is available.
+    """
+    try:
+      data = os.read(pipe.fileno(), MAX_READ)
+    except OSError, e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        return None
+      raise
+    if not data:
+      self._ClosePipe(pipe)
+    elif pipe is self._proc.stdout:
+      self._stdout.write(data)
+    else:
+      self._stderr.write(data)
+    return data
+
+  def GetTimeout(self):
+    """Returns the float seconds until SendDue, or None if there's no output."""
+    timeouts = [t for t in (self._stdout.GetTimeout(),
+                            self._stderr.GetTimeout()) if t is not None]
+    return (min(timeouts) if timeouts else None)
+
+  def SendDue(self):
+    """Sends the batched output that's due."""
+    self._stdout.SendDue()
+    self._stderr.SendDue()
+
+  def Poll(self):
+    """Returns True if the command has exited."""
+    if self._returncode is None and self._proc:
+      self._returncode = self._proc.poll()
+      if self._returncode is not None:
+        self._UncountProc()
+    return self._returncode is not None
+
+  def Finish(self, call_fn, done_fn):
+    """Sends an exited command's remaining output, exit code and files.
+
+    Tarring a directory, or reading a large file, would block our event loop,
+    so our output files are sent by an output thread, via a LoopChunkStream.
+
+    Args:
+      call_fn: function(func, *args), that calls func from our event loop,
+          from any thread
+      done_fn: function(exc_info), which we call from our event loop once our
+          files are sent, if we return False
+    Returns:
+      True if we're done, else False if our output thread is running.
+    """
+    if self._is_replayed:
+      return True
+    for pipe in list(self.pipes):
+      # Any output that's still unread, but not from any children that
+      # inherited our pipe, e.g. an adb server.
+      while self.ReadPipe(pipe):
+        pass
+      if pipe in self.pipes:
+        self._ClosePipe(pipe)
+    self._stdout.flush()
+    self._stderr.flush()
+    exit_stream = lab_common.ChunkedOutputStream(lab_common.ChunkHeader(
+        'exit'), self._to_stream)
+    exit_stream.write(str(self._returncode))
+    if not any(curr.out_dn for curr in self.params):
+      self._EndResult(self._to_stream.result if self._cache else None)
+      return True
+    self._files_stream = LoopChunkStream(
+        self._to_stream, call_fn, EventLoopConnection.HIGH_WATER)
+    self.is_sending_files = True
+    thread = threading.Thread(target=self._SendFiles,
+                              args=(self._files_stream, call_fn, done_fn))
+    thread.daemon = True
+    thread.start()
+    return False
+
+  def OnOutputSent(self):
+    """Lets our output thread send more, once our connection has caught up."""
+    if self._files_stream:
+      self._files_stream.OnDrained()
+
+  def Kill(self):
+    """Kills the command, if it's still running."""
+    if self._files_stream:
+      self._files_stream.Close()
+      self._files_stream = None
+    for pipe in list(self.pipes):
+      self._ClosePipe(pipe)
+    if self._proc and self._proc.poll() is None:
+      try:
+        self._proc.kill()
+      except OSError:
+        pass  # It just exited
+    self._UncountProc()
+    self._EndResult(None)
+
+  def _SendFiles(self, files_stream, call_fn, done_fn):
+    """Sends our output files, from our output thread."""
+    exc_info = None
+    try:
+      LabDeviceProxyRequestHandler._WriteOutputFiles(self.params, files_stream)
+    except Exception:  # pylint: disable=broad-except
+      exc_info = sys.exc_info()
+    call_fn(self._OnFilesSent, files_stream, done_fn, exc_info)
+
+  def _OnFilesSent(self, files_stream, done_fn, exc_info):
+    """Ends our result, from our event loop, once our files are sent."""
+    if files_stream is not self._files_stream:
+      return  # We've been killed
+    self._files_stream = None
+    if not exc_info:
+      self._EndResult(self._to_stream.result if self._cache else None)
+    done_fn(exc_info)
+
+  def _UncountProc(self):
+    if self._is_proc_counted:
+      self._server.metrics.Add('child_processes', -1)
+      self._is_proc_counted = False
+
+  def _SetStream(self, to_stream):
+    self._to_stream = to_stream
+    self._stdout = lab_common.CoalescingOutputStream(lab_common.ChunkHeader(
+        '1'), to_stream)
+    self._stderr = lab_common.CoalescingOutputStream(lab_common.ChunkHeader(
+        '2'), to_stream)
+
+  def _EndResult(self, result):
+    if self._cache:
+      cache, self._cache = self._cache, None
+      cache.End(self._cache_key, result)
+
+  def _ClosePipe(self, pipe):
+    self._server.Unwatch(pipe.fileno())
+    pipe.close()
+    self.pipes.remove(pipe)
+
+
+class LoopChunkStream(object):
+  """A stream wrapper that lets a worker thread send chunks via an event loop.
+
+  The thread's chunks are queued, then sent to to_stream from the loop.  The
+  thread waits while more than max_bytes are queued, or sent but not yet
+  drained, i.e. until the loop calls OnDrained.
+  """
+
+  def __init__(self, to_stream, call_fn, max_bytes):
+    """Creates a stream.
+
+    Args:
+      to_stream: stream to write to, from the event loop
+      call_fn: function(func, *args), that calls func from the event loop,
+          from any thread
+      max_bytes: int
+    """
+    self._to_stream = to_stream
+    self._call_fn = call_fn
+    self._max_bytes = max_bytes
+    self._cond = threading.Condition()
+    # [func, args, num_bytes, threading.Event or None, result], in order
+    self._calls = collections.deque()
+    self._num_bytes = 0  # Queued or undrained bytes
+    self._sent_bytes = 0  # Of those, the bytes sent to to_stream
+    self._is_closed = False
+
+  def SendChunk(self, header, data, framing=None):
+    self._Call(len(data or ''), lab_common.SendChunk,
+               (header, data, self._to_stream, framing))
+
+  def SendFileChunk(self, header, fp, num_bytes, framing=None):
+    # The loop reads and moves fp's position, so we wait for it.
+    return self._Call(num_bytes, lab_common.SendFileChunk,
+                      (header, fp, num_bytes, self._to_stream, framing),
+                      is_sync=True)
+
+  def flush(self):  # pylint: disable=invalid-name
+    self._Call(0, self._to_stream.flush, ())
+
+  def OnDrained(self):
+    """Lets the thread queue more, from the loop, once our chunks are sent."""
+    with self._cond:
+      if self._sent_bytes:
+        self._num_bytes -= self._sent_bytes
+        self._sent_bytes = 0
+        self._cond.notify_all()
+
+  def Close(self):
+    """Drops our queued chunks, so the thread's calls raise IOError."""
+    with self._cond:
+      self._is_closed = True
+      for call in self._calls:
+        if call[3]:
+          call[3].set()
+      self._calls.clear()
+      self._cond.notify_all()
+
+  def _Call(self, num_bytes, func, args, is_sync=False):
+    """Queues a call for the loop, from the thread.
+
+    Args:
+      num_bytes: int bytes that the call sends
+      func: function
+      args: tuple of func args
+      is_sync: bool, True to wait for the call
+    Returns:
+      The call's result, if is_sync, else None.
+    Raises:
+      IOError: if we've been closed.
+    """
+    call = [func, args, num_bytes, (threading.Event() if is_sync else None),
+            None]
+    with self._cond:
+      while self._num_bytes > self._max_bytes and not self._is_closed:
+        self._cond.wait()
+      if self._is_closed:
+        raise IOError('Stream closed')
+      is_first = not self._calls
+      self._calls.append(call)
+      self._num_bytes += num_bytes
+    if is_first:
+      self._call_fn(self._SendCalls)
+    if not is_sync:
+      return None
+    call[3].wait()
+    if self._is_closed:
+      raise IOError('Stream closed')
+    return call[4]
+
+  def _SendCalls(self):
+    """Makes the queued calls, from the loop."""
+    while True:
+      with self._cond:
+        if not self._calls:
+          return
+        call = self._calls.popleft()
+      func, args, num_bytes, done, _ = call
+      result = None
+      try:
+        result = func(*args)
+      finally:
+        with self._cond:
+          if done and not result:
+            self._num_bytes -= num_bytes  # E.g. we couldn't sendfile
+          else:
+            self._sent_bytes += num_bytes
+        call[4] = result
+        if done:
+          done.set()
+
+
+class OutputBuffer(object):
+  """A FIFO byte buffer that spills to a temporary file when it's large.
+
+  This lets an EventLoopConnection queue a large output file, or a command's
+  output, faster than its client can read it, without blocking.  Output file
+  chunks are queued as file segments, which we sendfile if possible.
+  """
+
+  MAX_MEMORY_BYTES = 4 << 20
+  SEND_SIZE = 65536  # Coalesce small writes up to this size
+
+  def __init__(self):
+    # In-memory strings and [fp, offset, num_bytes] file segments, sent first
+    self._chunks = collections.deque()
+    self._memory_bytes = 0
+    self._segment_bytes = 0
+    self._fp = None  # Spill file, holds the data that follows our chunks
+    self._read_pos = 0
+    self._write_pos = 0
+
+  def __len__(self):
+    return (self._memory_bytes + self._segment_bytes +
+            self._write_pos - self._read_pos)
+
+  def write(self, data):  # pylint: disable=g-bad-name
+    if not data:
+      return
+    if (not self._fp and
+        self._memory_bytes + len(data) <= self.MAX_MEMORY_BYTES):
+      self._chunks.append(data)
+      self._memory_bytes += len(data)
+      return
+    if not self._fp:
+      self._fp = tempfile.TemporaryFile(prefix='proxy_out', dir='/tmp')
+    self._fp.seek(self._write_pos)
+    self._fp.write(data)
+    self._write_pos += len(data)
+
+  def SendFileChunk(self, header, fp, num_bytes, framing=None):
+    """Queues a chunk whose data we'll sendfile from the given file.
+
+    Args:
+      header: ChunkHeader
+      fp: file object, positioned at the data to send
+      num_bytes: int data length
+      framing: optional TextFraming or BinaryFraming
+    Returns:
+      True if the chunk was queued, or False if the caller must write it.
+    """
+    if self._fp or lab_common.GetSendfile() is None:
+      return False  # We've spilled, so we can't send it in order
+    framing = (framing or lab_common.TEXT_FRAMING)
+    header.len_ = num_bytes
+    self.write(framing.FormatHeader(header))
+    # Our own file descriptor outlives the caller's fp and the file's
+    # TempFileSystem.
+    self._chunks.append(
+        [os.fdopen(os.dup(fp.fileno()), 'rb'), fp.tell(), num_bytes])
+    self._segment_bytes += num_bytes
+    fp.seek(num_bytes, os.SEEK_CUR)
+    self.write(framing.TRAILER)
+    return True
+
+  def flush(self):  # pylint: disable=invalid-name
+    pass
+
+  def close(self):  # pylint: disable=invalid-name
+    for chunk in self._chunks:
+      if isinstance(chunk, list):
+        chunk[0].close()
+    self._chunks.clear()
+    self._memory_bytes = 0
+    self._segment_bytes = 0
+    if self._fp:
+      self._fp.close()
+      self._fp = None
+    self._read_pos = self._write_pos = 0
+
+  def SendTo(self, sock):
+    """Sends our next data to a non-blocking socket.
+
+    Args:
+      sock: socket.socket
+    Returns:
+      The int number of bytes sent.
+    Raises:
+      EnvironmentError: e.g. EAGAIN if the socket is full.
+    """
+    chunk = self._Peek()
+    if isinstance(chunk, list):
+      fp, offset, num_bytes = chunk
+      num_sent = lab_common.GetSendfile()(sock.fileno(), fp.fileno(), offset,
+                                          num_bytes)
+      if not num_sent:
+        raise IOError('Unexpected end of file')
+      self._segment_bytes -= num_sent
+      if num_sent < num_bytes:
+        chunk[1:] = [offset + num_sent, num_bytes - num_sent]
+      else:
+        self._chunks.popleft()
+        fp.close()
+      return num_sent
+    num_sent = sock.send(chunk)
+    self._chunks.popleft()
+    if num_sent < len(chunk):
+      self._chunks.appendleft(chunk[num_sent:])
+    self._memory_bytes -= num_sent
+    return num_sent
+
+  def _Peek(self):
+    """Returns the next string or file segment to send."""
+    if not self._chunks and self._fp:
+      self._fp.seek(self._read_pos)
+      data = self._fp.read(self.SEND_SIZE)
+      self._read_pos += len(data)
+      if self._read_pos >= self._write_pos:
+        self._fp.close()
+        self._fp = None
+        self._read_pos = self._write_pos = 0
+      self._chunks.append(data)
+      self._memory_bytes += len(data)
+    chunk = self._chunks[0]
+    if (isinstance(chunk, str) and len(chunk) < self.SEND_SIZE and
+        len(self._chunks) > 1 and isinstance(self._chunks[1], str)):
+      pieces = []
+      num_bytes = 0
+      while (self._chunks and isinstance(self._chunks[0], str) and
+             num_bytes < self.SEND_SIZE):
+        pieces.append(self._chunks.popleft())
+        num_bytes += len(pieces[-1])
+      chunk = ''.join(pieces)
+      self._chunks.appendleft(chunk)
+    return chunk
+
+
+class Poller(object):
+  """Polls file descriptors with epoll, or with select if it's unavailable."""
+
+  def __init__(self):
+    self._epoll = (select.epoll() if hasattr(select, 'epoll') else None)
+    self._events = {}  # fd -> (readable, writable)
+
+  def Register(self, fd, readable, writable):
+    """Sets a file descriptor's events of interest.
+
+    Args:
+      fd: int file descriptor
+      readable: bool
+      writable: bool
+    """
+    if not readable and not writable:
+      self.Unregister(fd)
+      return
+    old_events = self._events.get(fd)
+    if old_events == (readable, writable):
+      return
+    self._events[fd] = (readable, writable)
+    if self._epoll:
+      mask = ((select.EPOLLIN if readable else 0) |
+              (select.EPOLLOUT if writable else 0))
+      if old_events is None:
+        self._epoll.register(fd, mask)
+      else:
+        self._epoll.modify(fd, mask)
+
+  def Unregister(self, fd):
+    if self._events.pop(fd, None) is not None and self._epoll:
+      self._epoll.unregister(fd)
+
+  def Poll(self, timeout):
+    """Waits for events.
+
+    Args:
+      timeout: float seconds
+    Returns:
+      List of (fd, readable, writable) tuples.  Errors and hang-ups are
+      reported as both readable and writable, so the next read or write
+      will raise or return EOF.
+    """
+    try:
+      if self._epoll:
+        ret = []
+        for fd, mask in self._epoll.poll(timeout):
+          is_error = bool(mask & (select.EPOLLERR | select.EPOLLHUP))
+          ret.append((fd, is_error or bool(mask & select.EPOLLIN),
+                      is_error or bool(mask & select.EPOLLOUT)))
+        return ret
+      reads = [fd for fd, (readable, _) in self._events.iteritems()
+               if readable]
+      writes = [fd for fd, (_, writable) in self._events.iteritems()
+                if writable]
+      rlist, wlist, _ = select.select(reads, writes, [], timeout)
+      return [(fd, fd in rlist, fd in wlist) for fd in set(rlist + wlist)]
+    except (IOError, select.error), e:
+      if e.args[0] == errno.EINTR:
+        return []  # E.g. a SIGCHLD
+      raise
+
+
+class CommandScheduler(object):
+  """Limits the number of commands that run at once, per device and per host.
+
+  Each command is keyed by its device id, e.g. an "adb -s SERIAL" serial.
+  Commands without a device id are only limited by the per-host cap.
+
+  Waiting commands are admitted in priority order (see
+  lab_common.PRIORITIES), and high-priority commands may use reserved slots
+  beyond our limits, so a quick "adb devices" isn't stuck behind bulk
+  transfers.  Within a priority, commands are admitted in arrival order
+  ("fifo"), or round-robin by client ("fair") so a client that queues many
+  commands can't starve the other clients.  Either way, a command whose
+  device is at its limit doesn't hold up the commands for other devices.
+  """
+
+  POLICIES = ('fifo', 'fair')
+
+  def __init__(self, max_per_device=0, max_per_host=0, policy='fifo',
+               reserved_slots=0):
+    """Creates a scheduler.
+
+    Args:
+      max_per_device: int maximum number of commands per device, 0 for no
+          limit
+      max_per_host: int maximum number of commands, 0 for no limit
+      policy: string, one of POLICIES
+      reserved_slots: int number of slots, beyond each of the above limits,
+          that only "high" priority commands may use
+    """
+    if policy not in self.POLICIES:
+      raise ValueError('Unknown policy: %s' % policy)
+    self._max_per_device = max_per_device
+    self._max_per_host = max_per_host
+    self._policy = policy
+    self._reserved_slots = reserved_slots
+    self._lock = threading.Lock()
+    self._num_running = 0
+    self._device_counts = collections.defaultdict(int)  # device_id -> int
+    # For each priority, queues of waiting Tickets, keyed by client for
+    # "fair" queueing, in the order that we'll next consider them.
+    self._queues = dict((priority, collections.OrderedDict())
+                        for priority in lab_common.PRIORITIES)
+
+  def Submit(self, device_id, client, callback=None, priority='normal'):
+    """Queues a command.
+
+    Args:
+      device_id: string Android serial or iOS UDID, or None
+      client: string client address, for "fair" queueing
+      callback: optional function(Ticket), called when the command is
+          admitted.  It's called by Submit or by whichever thread's Release
+          admits the command, so it must not block.
+      priority: string, one of lab_common.PRIORITIES
+    Returns:
+      Ticket, which must be passed to Release when the command is done.
+    """
+    ticket = Ticket(device_id, client, callback, priority)
+    with self._lock:
+      self._queues[priority].setdefault(
+          self._GetQueueKey(ticket), collections.deque()).append(ticket)
+      admitted = self._Admit()
+    self._Notify(admitted)
+    return ticket
+
+  def Release(self, ticket):
+    """Frees an admitted command's slot, or cancels a waiting command.
+
+    Args:
+      ticket: Ticket
+    """
+    with self._lock:
+      if ticket.is_released:
+        return
+      ticket.is_released = True
+      if ticket.is_admitted:
+        self._num_running -= 1
+        self._device_counts[ticket.device_id] -= 1
+        if not self._device_counts[ticket.device_id]:
+          del self._device_counts[ticket.device_id]
+      else:
+        queues = self._queues[ticket.priority]
+        key = self._GetQueueKey(ticket)
+        queues[key].remove(ticket)
+        if not queues[key]:
+          del queues[key]
+      admitted = self._Admit()
+    self._Notify(admitted)
+
+  def _GetQueueKey(self, ticket):
+    return (ticket.client if self._policy == 'fair' else None)
+
+  def _Admit(self):
+    """Admits as many waiting commands as our limits allow.
+
+    The caller must hold our lock.
+
+    Returns:
+      List of admitted Tickets.
+    """
+    admitted = []
+    while True:
+      ticket = self._PopNext()
+      if not ticket:
+        break
+      ticket.admit_time = time.time()
+      self._num_running += 1
+      self._device_counts[ticket.device_id] += 1
+      admitted.append(ticket)
+    return admitted
+
+  def _PopNext(self):
+    """Removes and returns the next admissible Ticket, if any."""
+    for priority in lab_common.PRIORITIES:
+      reserved_slots = (self._reserved_slots if priority == 'high' else 0)
+      if (self._max_per_host and
+          self._num_running >= self._max_per_host + reserved_slots):
+        continue
+      max_per_device = (self._max_per_device + reserved_slots
+                        if self._max_per_device else 0)
+      queues = self._queues[priority]
+      for key, queue in queues.iteritems():
+        for ticket in queue:
+          if (ticket.device_id is None or not max_per_device or
+              self._device_counts[ticket.device_id] < max_per_device):
+            queue.remove(ticket)
+            # Move this queue to the end, so "fair" clients take turns.
+            del queues[key]
+            if queue:
+              queues[key] = queue
+            return ticket
+    return None
+
+  @staticmethod
+  def _Notify(admitted):
+    for ticket in admitted:
+      ticket.admitted_event.set()
+      if ticket.callback:
+        ticket.callback(ticket)
+
+
+class Ticket(object):
+  """A command's place in a CommandScheduler."""
+
+  def __init__(self, device_id, client, callback, priority):
+    self.device_id = device_id  # string, or None
+    self.client = client  # string
+    self.callback = callback  # function(Ticket), or None
+    self.priority = priority  # string
+    self.admit_time = None  # float, once admitted
+    self.admitted_event = threading.Event()
+    self.is_released = False
+
+  @property
+  def is_admitted(self):
+    return self.admit_time is not None
+
+
+class Param(object):
+  """A server-side arg."""
+
+  index = None   # int
+  value = None   # string
+  header = None  # ChunkHeader
+  in_fp = None   # File object
+  in_digest = None  # hashlib object, for an input file we'll cache
+  is_cache_miss = False  # bool, the UploadCache lacks our input file
+  out_dn = None  # string path
+  num_bytes = 0  # int size of the input file we read or output file we sent
+
+
+class UploadCache(object):
+  """An on-disk LRU cache of uploaded input files, keyed by SHA-1 digest.
+
+  The cache index is saved in the cache directory, so the cache survives a
+  server restart.
+
+  Concurrent uploads of the same digest are merged: a Lookup that misses
+  reserves the digest for the caller's re-upload, and concurrent Lookups of
+  a reserved digest wait for that upload instead of also missing.
+
+  Files are linked or copied outside our lock, so slow copies don't block
+  other uploads and hits.  A Lookup pins its entry while it links it, so it
+  isn't evicted.
+  """
+
+  INDEX_FN = 'index.json'
+  RESEND_TIMEOUT = 10   # Seconds to wait for a client's post-miss re-send
+  UPLOAD_TIMEOUT = 120  # Seconds to wait for an upload in progress
+
+  def __init__(self, cache_dn, max_bytes):
+    """Creates the cache and loads its index.
+
+    Args:
+      cache_dn: string directory name, created if missing
+      max_bytes: int cache size limit
+    """
+    self._cache_dn = cache_dn
+    self._max_bytes = max_bytes
+    self._cv = threading.Condition()
+    self._entries = collections.OrderedDict()  # digest -> size, LRU first
+    self._total_bytes = 0
+    self._uploads = {}  # digest -> deadline time of the expected upload
+    self._pins = collections.defaultdict(int)  # digest -> number of Lookups
+    self._adding = set()  # digests that EndUpload is adding
+    self._Load()
+
+  def Lookup(self, digest, to_fn, wait=True):
+    """Copies a cached file to the given filename, if it's in the cache.
+
+    Args:
+      digest: string SHA-1 hex digest
+      to_fn: string filename to create
+      wait: bool, False to miss instead of waiting for an upload in progress
+    Returns:
+      True if the file was in the cache, else False.  On a miss the caller
+      is expected to re-upload the file.
+    """
+    with self._cv:
+      while digest not in self._entries:
+        timeout = self._uploads.get(digest, 0) - time.time()
+        if timeout <= 0:
+          self._uploads[digest] = time.time() + self.RESEND_TIMEOUT
+          return False
+        if not wait:
+          return False
+        self._cv.wait(timeout)
+      # Mark as most-recently-used, and pin it so it isn't evicted while we
+      # link it.  We don't save our index for this reordering.
+      self._entries[digest] = self._entries.pop(digest)
+      self._pins[digest] += 1
+    try:
+      self._LinkOrCopy(self._GetPath(digest), to_fn)
+    finally:
+      with self._cv:
+        self._pins[digest] -= 1
+        if not self._pins[digest]:
+          del self._pins[digest]
+          if self._total_bytes > self._max_bytes:
+            self._Evict()
+            self._Save()
+    return True
+
+  def BeginUpload(self, digest):
+    """Notes that an upload of the given digest has started.
+
+    Args:
+      digest: string SHA-1 hex digest
+    """
+    with self._cv:
+      self._uploads[digest] = time.time() + self.UPLOAD_TIMEOUT
+
+  def EndUpload(self, digest, from_fn):
+    """Adds a verified upload to the cache and wakes any waiting Lookups.
+
+    Args:
+      digest: string SHA-1 hex digest
+      from_fn: string filename with the given digest, or None if the upload
+          failed
+    """
+    size = (os.path.getsize(from_fn) if from_fn else None)
+    with self._cv:
+      if (size is None or size > self._max_bytes or
+          digest in self._entries or digest in self._adding):
+        self._uploads.pop(digest, None)
+        self._cv.notify_all()
+        return
+      self._adding.add(digest)
+    is_added = False
+    try:
+      tmp_fn = self._GetPath(digest) + '.tmp'
+      self._LinkOrCopy(from_fn, tmp_fn)
+      # Commands must not modify the files we link from our cache.
+      os.chmod(tmp_fn, 0444)
+      os.rename(tmp_fn, self._GetPath(digest))
+      is_added = True
+    finally:
+      with self._cv:
+        self._adding.discard(digest)
+        self._uploads.pop(digest, None)
+        if is_added:
+          self._entries[digest] = size
+          self._total_bytes += size
+          self._Evict()
+          self._Save()
+        self._cv.notify_all()
+
+  def _GetPath(self, digest):
+    if not re.match(r'[0-9a-f]{40}$', digest):
+      raise ValueError('Invalid digest: %s' % digest)
+    return os.path.join(self._cache_dn, digest)
+
+  @staticmethod
+  def _LinkOrCopy(from_fn, to_fn):
+    if os.path.exists(to_fn):
+      os.remove(to_fn)
+    try:
+      os.link(from_fn, to_fn)
+    except OSError:
+      shutil.copyfile(from_fn, to_fn)
+
+  def _Evict(self):
+    """Removes least-recently-used files until we're within our size limit.
+
+    Pinned files are kept, even if that leaves us over our limit until
+    they're unpinned.
+    """
+    for digest, size in self._entries.items():
+      if self._total_bytes <= self._max_bytes:
+        break
+      if digest in self._pins:
+        continue
+      del self._entries[digest]
+      self._total_bytes -= size
+      try:
+        os.remove(self._GetPath(digest))
+      except OSError:
+        pass
+
+  def _Load(self):
+    """Loads our index, ignoring any entries without matching files."""
+    if not os.path.isdir(self._cache_dn):
+      os.makedirs(self._cache_dn)
+    try:
+      with open(os.path.join(self._cache_dn, self.INDEX_FN), 'r') as fp:
+        index = json.load(fp)
+    except (IOError, ValueError):
+      index = []
+    for digest, size in index:
+      fn = self._GetPath(str(digest))
+      if os.path.isfile(fn) and os.path.getsize(fn) == size:
+        self._entries[str(digest)] = size
+        self._total_bytes += size
+    # Remove our files that we're not tracking, e.g. from an interrupted
+    # EndUpload.  The directory may be shared, so we leave other files alone.
+    for fn in os.listdir(self._cache_dn):
+      if (re.match(r'[0-9a-f]{40}(\.tmp)?$', fn) and fn not in self._entries
+          and os.path.isfile(os.path.join(self._cache_dn, fn))):
+        os.remove(os.path.join(self._cache_dn, fn))
+    self._Evict()
+    self._Save()
+
+  def _Save(self):
+    """Atomically saves our index."""
+    index_fn = os.path.join(self._cache_dn, self.INDEX_FN)
+    with open(index_fn + '.tmp', 'w') as fp:
+      json.dump(self._entries.items(), fp)
+    os.rename(index_fn + '.tmp', index_fn)
+
+
+class ResultCache(object):
+  """An in-memory cache of the results of idempotent, read-only commands.
+
+  A result is the list of (chunk id, data) tuples that a command sent, e.g.
+  [('1', 'List of devices attached\n'), ('exit', '0')], which is cached for
+  the command's time-to-live if the command exited 0.
+
+  Concurrent runs of the same command are merged: a Begin that misses
+  reserves the command for the caller's run, and concurrent Begins share
+  that run's result instead of also missing.  A command that modifies a
+  device, e.g. "adb install", invalidates that device's results and the
+  results of commands without a device id, e.g. "adb devices".
+  """
+
+  HIT = 'hit'
+  MISS = 'miss'
+  SHARED = 'shared'
+
+  def __init__(self, cached_commands=None, mutating_commands=None):
+    """Creates an empty cache.
+
+    Args:
+      cached_commands: optional list of (command name, float ttl) tuples,
+          defaults to CACHED_COMMANDS
+      mutating_commands: optional list of command names, defaults to
+          MUTATING_COMMANDS
+    """
+    self._cached_commands = (cached_commands if cached_commands is not None
+                             else CACHED_COMMANDS)
+    self._mutating_commands = (mutating_commands
+                               if mutating_commands is not None
+                               else MUTATING_COMMANDS)
+    self._lock = threading.Lock()
+    self._entries = {}  # key -> (expiry time, result)
+    self._runs = {}  # key -> (generation, ttl, callbacks) of a running command
+    self._generation = 0  # Incremented when we drop all results
+    self._device_generations = collections.defaultdict(int)
+    self.num_hits = 0
+    self.num_misses = 0
+    self.num_shared = 0
+
+  def GetTTL(self, name):
+    """Returns a command's float time-to-live, or None if it's not cached.
+
+    Args:
+      name: List of strings, the command's args without its device id
+    """
+    for command, ttl in self._cached_commands:
+      if name[:len(command)] == command:
+        return ttl
+    return None
+
+  def IsMutating(self, name):
+    """Returns True if the named command invalidates its device's results.
+
+    Args:
+      name: List of strings, the command's args without its device id
+    """
+    return any(name[:len(command)] == command
+               for command in self._mutating_commands)
+
+  def Begin(self, key, ttl, callback):
+    """Looks up a command's result, or reserves the command for our caller.
+
+    Args:
+      key: (device id, args tuple) of the command
+      ttl: float seconds, from GetTTL
+      callback: function(result), which is passed the cached or shared
+          result.  If it's passed None, the shared run failed, so the
+          caller must run the command itself.
+    Returns:
+      MISS if the caller must run the command and then call End, else HIT if
+      the callback has been called, or SHARED if the callback will be called
+      when a concurrent run of the command Ends.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry and entry[0] <= time.time():
+        del self._entries[key]
+        entry = None
+      if not entry:
+        run = self._runs.get(key)
+        if run:
+          self.num_shared += 1
+          run[2].append(callback)
+          return self.SHARED
+        self.num_misses += 1
+        self._runs[key] = (self._GetGeneration(key[0]), ttl, [])
+        return self.MISS
+      self.num_hits += 1
+    callback(entry[1])
+    return self.HIT
+
+  def End(self, key, result):
+    """Caches a command's result and passes it to any waiting callbacks.
+
+    Args:
+      key: as in Begin, which returned MISS
+      result: List of (chunk id, data) tuples, or None if the run failed
+    """
+    if result and result[-1][0] != 'exit':
+      result = None  # E.g. the client was lost
+    with self._lock:
+      generation, ttl, callbacks = self._runs.pop(key)
+      now = time.time()
+      for k in [k for k, entry in self._entries.iteritems()
+                if entry[0] <= now]:
+        del self._entries[k]
+      if (result and result[-1] == ('exit', '0') and
+          generation == self._GetGeneration(key[0])):
+        self._entries[key] = (now + ttl, result)
+    for callback in callbacks:
+      callback(result)
+
+  def Invalidate(self, device_id):
+    """Drops a device's results, and those of commands without a device id.
+
+    Args:
+      device_id: string device id, or None to drop all results
+    """
+    with self._lock:
+      if device_id is None:
+        self._generation += 1
+        self._entries.clear()
+      else:
+        self._device_generations[None] += 1
+        self._device_generations[device_id] += 1
+        for key in [key for key in self._entries
+                    if key[0] in (None, device_id)]:
+          del self._entries[key]
+
+  def FormatStats(self):
+    """Returns our counters, e.g. '3 hits, 1 shared, 2 misses'."""
+    return '%d hits, %d shared, %d misses' % (
+        self.num_hits, self.num_shared, self.num_misses)
+
+  def _GetGeneration(self, device_id):
+    # A running command's result is stale if it's invalidated before it
+    # Ends.
+    return (self._generation, self._device_generations[None],
+            self._device_generations[device_id])
+
+
+class ServerMetrics(object):
+  """Request latencies, counters and gauges, served as /metrics.
+
+  The page uses the Prometheus text format.  Each thread updates one of our
+  stripes, each with its own lock, so concurrent requests rarely contend;
+  Format sums the stripes.
+  """
+
+  NUM_STRIPES = 16
+  PREFIX = 'lab_device_proxy_'
+  METRICS = (  # (name, type, help)
+      ('request_phase_seconds', 'histogram',
+       'Time that requests spent in each phase.'),
+      ('input_file_bytes_total', 'counter', 'Bytes of uploaded input files.'),
+      ('output_file_bytes_total', 'counter', 'Bytes of sent output files.'),
+      ('active_requests', 'gauge', 'Requests in progress.'),
+      ('child_processes', 'gauge', 'Commands that are running.'),
+      ('errors_total', 'counter', 'Error responses, by HTTP status code.'))
+
+  def __init__(self):
+    self._stripes = [(threading.Lock(), collections.defaultdict(int))
+                     for _ in range(self.NUM_STRIPES)]
+    self._next_stripe = itertools.count()
+    self._local = threading.local()
+
+  def Add(self, name, value=1, **labels):
+    """Adds to a counter or gauge.
+
+    Args:
+      name: string metric name, e.g. 'active_requests'
+      value: int, which is negative to decrement a gauge
+      **labels: string label values, e.g. code=404
+    """
+    key = (name, tuple(sorted(labels.items())))
+    lock, values = self._GetStripe()
+    with lock:
+      values[key] += value
+
+  def Observe(self, name, seconds, **labels):
+    """Adds a sample to a histogram.
+
+    Args:
+      name: string metric name, e.g. 'request_phase_seconds'
+      seconds: float sample
+      **labels: string label values
+    """
+    labels = tuple(sorted(labels.items()))
+    lock, values = self._GetStripe()
+    with lock:
+      values[(name, labels, bisect.bisect_left(METRICS_BUCKETS, seconds))] += 1
+      values[(name, labels, 'sum')] += seconds
+
+  def ObserveRequest(self, label, phases, input_bytes, output_bytes):
+    """Records a finished POST request's phases and file sizes.
+
+    Args:
+      label: string command label, from _GetMetricsLabel
+      phases: List of (phase, float seconds) tuples, from _GetPhases
+      input_bytes: int size of the uploaded input files
+      output_bytes: int size of the sent output files
+    """
+    for phase, seconds in phases:
+      self.Observe('request_phase_seconds', seconds, command=label,
+                   phase=phase)
+    if input_bytes:
+      self.Add('input_file_bytes_total', input_bytes, command=label)
+    if output_bytes:
+      self.Add('output_file_bytes_total', output_bytes, command=label)
+
+  def Format(self):
+    """Returns the /metrics page."""
+    totals = collections.defaultdict(int)
+    for lock, values in self._stripes:
+      with lock:
+        items = values.items()
+      for key, value in items:
+        totals[key] += value
+    lines = []
+    for name, metric_type, description in self.METRICS:
+      full_name = self.PREFIX + name
+      lines.append('# HELP %s %s' % (full_name, description))
+      lines.append('# TYPE %s %s' % (full_name, metric_type))
+      keys = sorted(key for key in totals if key[0] == name)
+      if metric_type == 'histogram':
+        for labels in sorted(set(key[1] for key in keys)):
+          count = 0
+          for index, bound in enumerate(METRICS_BUCKETS + (None,)):
+            count += totals.get((name, labels, index), 0)
+            le = ('+Inf' if bound is None else repr(float(bound)))
+            lines.append('%s_bucket%s %d' % (
+                full_name, self._FormatLabels(labels + (('le', le),)), count))
+          lines.append('%s_sum%s %.6f' % (
+              full_name, self._FormatLabels(labels),
+              totals[(name, labels, 'sum')]))
+          lines.append('%s_count%s %d' % (
+              full_name, self._FormatLabels(labels), count))
+      elif not keys and metric_type == 'gauge':
+        lines.append('%s 0' % full_name)
+      else:
+        for _, labels in keys:
+          lines.append('%s%s %d' % (full_name, self._FormatLabels(labels),
+                                    totals[(name, labels)]))
+    return '\n'.join(lines) + '\n'
+
+  def _GetStripe(self):
+    """Returns this thread's (lock, values) stripe."""
+    index = getattr(self._local, 'index', None)
+    if index is None:
+      index = next(self._next_stripe) % self.NUM_STRIPES
+      self._local.index = index
+    return self._stripes[index]
+
+  @staticmethod
+  def _FormatLabels(labels):
+    """Formats (name, value) label tuples, e.g. as '{code="404"}'."""
+    if not labels:
+      return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')) for name, value in labels)
+
+
+class TrafficRecorder(object):
+  """Appends a JSON line per POST request to a log, for replay as load.
+
+  Each line records a request's commands, with each input and output file
+  replaced by its name, size and file count (and an input file's digest, if
+  the client sent one), and the request's status, phase times and file and
+  output sizes.  The log has no file contents or command output, so
+  lab_device_proxy_replay.py replays it with synthetic files and fake
+  commands.
+  """
+
+  def __init__(self, fn):
+    """Opens the log.
+
+    Args:
+      fn: string log filename, which we append to
+    """
+    self._fp = open(fn, 'a')
+    self._lock = threading.Lock()
+
+  def Record(self, request_id, start_time, status, batch, device_ids,
+             parallel, priority, phases, chunk_bytes):
+    """Records a finished POST request, before its files are cleaned up.
+
+    Args:
+      request_id: string, from _NewRequestId
+      start_time: float time that the request arrived
+      status: int HTTP status code
+      batch: List of Params lists, which may be a fan-out's expanded batch
+      device_ids: string fan-out header, or None
+      parallel: int batch or fan-out parallelism, or None
+      priority: string priority header, or None
+      phases: List of (phase, float seconds) tuples, from _GetPhases
+      chunk_bytes: dict of chunk ids to the int size of the response's
+          chunk data, from FramedStream
+    """
+    if device_ids is not None:
+      device_ids = device_ids.split()
+      if len(batch) == len(device_ids) and all(
+          len(params) > 2 and params[2].value == device_id
+          for params, device_id in zip(batch, device_ids)):
+        # Undo _FanOutCommand, to record the command that the client sent
+        batch = [batch[0][:1] + batch[0][3:]]
+    input_bytes, output_bytes = LabDeviceProxyRequestHandler._GetFileBytes(
+        batch)
+    entry = {
+        'id': request_id,
+        'time': round(start_time, 3),
+        'status': status,
+        'commands': [[self._GetArg(curr) for curr in params]
+                     for params in batch],
+        'phases': dict((phase, round(seconds, 6))
+                       for phase, seconds in phases),
+        'bytes': {'input': input_bytes, 'output': output_bytes,
+                  'stdout': chunk_bytes.get('1', 0),
+                  'stderr': chunk_bytes.get('2', 0)},
+    }
+    for key, value in (('devices', device_ids), ('parallel', parallel),
+                       ('priority', priority)):
+      if value is not None:
+        entry[key] = value
+    line = json.dumps(entry, sort_keys=True, separators=(',', ':')) + '\n'
+    with self._lock:
+      self._fp.write(line)
+      self._fp.flush()
+
+  @classmethod
+  def _GetArg(cls, curr):
+    """Returns a Param's recorded value.
+
+    Args:
+      curr: Param
+    Returns:
+      The string arg, or for an input or output file a dict, e.g.
+      {'in': 'Test.apk', 'size': 15728640, 'files': 1, 'digest': '...'}.
+    """
+    header = curr.header
+    if not header or not (header.in_ or header.out_):
+      return curr.value
+    if header.in_:
+      ret = {'in': header.in_}
+      size, num_files, is_dir = cls._GetShape(curr.value)
+      if header.digest_:
+        ret['digest'] = header.digest_
+    else:
+      ret = {'out': header.out_}
+      size, num_files, is_dir = 0, 0, False
+      fns = (os.listdir(curr.out_dn) if curr.out_dn and
+             os.path.isdir(curr.out_dn) else [])
+      if len(fns) == 1 and os.path.isfile(os.path.join(curr.out_dn, fns[0])):
+        size, num_files, is_dir = cls._GetShape(
+            os.path.join(curr.out_dn, fns[0]))
+      elif fns:
+        size, num_files, is_dir = cls._GetShape(curr.out_dn)
+    ret['size'] = size
+    ret['files'] = num_files
+    if is_dir:
+      ret['dir'] = True
+    return ret
+
+  @staticmethod
+  def _GetShape(path):
+    """Returns a path's (int size, int number of files, bool is_dir)."""
+    if path and os.path.isfile(path):
+      return os.path.getsize(path), 1, False
+    if not path or not os.path.isdir(path):
+      return 0, 0, False
+    sizes = [os.lstat(os.path.join(dn, fn)).st_size
+             for dn, _, fns in os.walk(path) for fn in fns]
+    return sum(sizes), len(sizes), True
+
+
+class DeviceInventory(object):
+  """A live, in-memory list of the host's Android and iOS devices.
+
+  One thread follows "adb track-devices", which sends the Android device list
+  whenever it changes, and another polls "idevice_id -l".  Either list is
+  unknown, e.g. if adb isn't installed, until its command succeeds.
+  """
+
+  ADB_HEADER = 'List of devices attached\n'
+
+  def __init__(self, interval=INVENTORY_INTERVAL):
+    """Creates an empty inventory.
+
+    Args:
+      interval: float seconds between iOS device polls, and between retries
+          of a failed "adb track-devices"
+    """
+    self._interval = interval
+    self._lock = threading.Lock()
+    self._android = None  # List of (serial, state) tuples, if known
+    self._ios = None  # List of UDIDs, if known
+    self._ios_time = 0  # When we last polled self._ios
+    self._proc = None  # Our "adb track-devices" subprocess.Popen
+    self._stop_event = threading.Event()
+    self._threads = []
+
+  def Start(self):
+    """Starts tracking devices in the background."""
+    for target in (self._TrackAndroidDevices, self._PollIOSDevices):
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def Stop(self):
+    """Stops tracking devices."""
+    self._stop_event.set()
+    with self._lock:
+      KillProcess(self._proc)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+  def GetOutput(self, name):
+    """Returns a device-listing command's output, if we know it.
+
+    Args:
+      name: List of strings, from _GetCommandName
+    Returns:
+      The string stdout of "adb devices" or "idevice_id -l", or None if the
+      command isn't one of these or our list is unknown.
+    """
+    with self._lock:
+      if name == ['adb', 'devices'] and self._android is not None:
+        return self.ADB_HEADER + ''.join(
+            '%s\t%s\n' % device for device in self._android) + '\n'
+      if (name in (['idevice_id', '-l'], ['idevice_id', '--list']) and
+          self._ios is not None and
+          time.time() - self._ios_time < 2 * self._interval):
+        return ''.join('%s\n' % udid for udid in self._ios)
+    return None
+
+  def ToJson(self):
+    """Returns our device lists, with None for an unknown list."""
+    with self._lock:
+      return {
+          'android': (None if self._android is None else
+                      [{'serial': serial, 'state': state}
+                       for serial, state in self._android]),
+          'ios': (None if self._ios is None else
+                  [{'udid': udid} for udid in self._ios]),
+      }
+
+  def _TrackAndroidDevices(self):
+    """Follows "adb track-devices" until we're stopped."""
+    last_error = None
+    while not self._stop_event.is_set():
+      proc = None
+      try:
+        proc = self._Popen(['adb', 'track-devices'])
+        with self._lock:
+          self._proc = proc
+        if self._stop_event.is_set():
+          break
+        while True:
+          # Each list is sent as a 4-digit hex length and "SERIAL\tSTATE\n"
+          # lines.
+          length = proc.stdout.read(4)
+          if not length:
+            break
+          payload = lab_common.ReadExactly(proc.stdout, int(length, 16))
+          devices = [tuple(line.split('\t', 1))
+                     for line in payload.splitlines() if line]
+          if any(len(device) != 2 for device in devices):
+            raise ValueError('Invalid device list: %r' % payload)
+          with self._lock:
+            self._android = devices
+          last_error = None
+      except (EnvironmentError, ValueError), e:
+        # Log each new error once, rather than every retry.
+        if not self._stop_event.is_set() and str(e) != last_error:
+          LogMessage('-', 'adb track-devices failed: %s', e)
+        last_error = str(e)
+      finally:
+        with self._lock:
+          self._android = None
+          self._proc = None
+          KillProcess(proc)
+      self._stop_event.wait(self._interval)
+
+  def _PollIOSDevices(self):
+    """Polls "idevice_id -l" until we're stopped."""
+    while not self._stop_event.is_set():
+      ios = None
+      try:
+        proc = self._Popen(['idevice_id', '-l'])
+        out = proc.communicate()[0]
+        if not proc.returncode:
+          ios = out.split()
+      except EnvironmentError:
+        pass  # E.g. idevice_id isn't installed
+      with self._lock:
+        self._ios = ios
+        self._ios_time = time.time()
+      self._stop_event.wait(self._interval)
+
+  @staticmethod
+  def _Popen(args):
+    if IDEVICE_PATH in os.environ:
+      # As in _GetCommandArgs
+      args = [os.environ[IDEVICE_PATH] + '/' + args[0]] + args[1:]
+    with open(os.devnull, 'w') as devnull:
+      return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=devnull,
+                              close_fds=True)
+
+
+class AdbHostError(RuntimeError):
+  """The adb server or device failed a request."""
+  pass
+
+
+class AdbHostConnection(object):
+  """A connection to the local adb server, via its host protocol.
+
+  Each request is a 4-digit hex length and a service name, e.g.
+  "000chost:devices", to which the server replies "OKAY", or "FAIL" and a
+  hex length-prefixed message.  A "host:transport:SERIAL" request switches
+  the connection to that device, so the next request, e.g. "shell,v2:ls"
+  or "sync:", is served by the device for the rest of the connection.
+  """
+
+  def __init__(self, port, serial=None):
+    """Connects to the adb server.
+
+    Args:
+      port: int adb server port
+      serial: optional string, to switch to that device's transport, or
+          'any' for the only device
+    """
+    self._sock = socket.create_connection(('127.0.0.1', port))
+    self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._from_stream = self._sock.makefile('rb')
+    if serial == 'any':
+      self.Request('host:transport-any')
+    elif serial:
+      self.Request('host:transport:%s' % serial)
+
+  def Request(self, service):
+    """Sends a request and checks its status.
+
+    Args:
+      service: string, e.g. 'host:devices'
+    Raises:
+      AdbHostError: if the server replies "FAIL".
+    """
+    self.Send('%04x%s' % (len(service), service))
+    status = self.Read(4)
+    if status == 'FAIL':
+      raise AdbHostError(self.ReadString())
+    if status != 'OKAY':
+      raise AdbHostError('Unexpected adb server status: %r' % status)
+
+  def ReadString(self):
+    """Reads a hex length-prefixed string."""
+    return self.Read(int(self.Read(4), 16))
+
+  def Read(self, num_bytes):
+    return lab_common.ReadExactly(self._from_stream, num_bytes)
+
+  def Send(self, data):
+    self._sock.sendall(data)
+
+  def close(self):  # pylint: disable=invalid-name
+    """Closes the connection, which may be in use by another thread."""
+    try:
+      self._sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass  # E.g. it's already closed
+    self._from_stream.close()
+    self._sock.close()
+
+
+class ThreadedProcess(object):
+  """A command that runs in one of our threads, but acts like a Popen.
+
+  It acts like the subprocess.Popen that _PopenCommand would otherwise
+  return, so it streams into the same chunk writers: a thread writes the
+  command's output to our stdout and stderr pipes, then sets our returncode
+  before it closes them.  A command that we can't run in-process may instead
+  start the real command, via _RunProcess.
+  """
+
+  def __init__(self, func, *args):
+    """Starts a command.
+
+    Args:
+      func: method that runs the command and returns its exit code
+      *args: func args
+    """
+    self._is_killed = False
+    self._proc = None  # Our subprocess.Popen, if we run the command as is
+    self.returncode = None
+    self.pid = None
+    read_out, self._out_fd = os.pipe()
+    read_err, self._err_fd = os.pipe()
+    self.stdout = os.fdopen(read_out, 'rb', 0)
+    self.stderr = os.fdopen(read_err, 'rb', 0)
+    self._thread = threading.Thread(target=self._Run, args=(func,) + args)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def poll(self):  # pylint: disable=invalid-name
+    return self.returncode
+
+  def wait(self):  # pylint: disable=invalid-name
+    self._thread.join()
+    return self.returncode
+
+  def kill(self):  # pylint: disable=invalid-name
+    self._is_killed = True
+    self._Close()
+    KillProcess(self._proc)
+
+  def _Close(self):
+    """Releases whatever the command is blocked on, e.g. its socket."""
+    pass
+
+  def _RunProcess(self, args):
+    """Runs the command as a process, and copies its output to our pipes."""
+    if self._is_killed:
+      raise AdbHostError('Killed')
+    self._proc = subprocess.Popen(
+        args, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        close_fds=True)
+    fds = {self._proc.stdout: self._out_fd, self._proc.stderr: self._err_fd}
+    while fds:
+      rlist, _, _ = select.select(list(fds), [], [])
+      for pipe in rlist:
+        data = os.read(pipe.fileno(), MAX_READ)
+        if data:
+          self._Write(fds[pipe], data)
+        else:
+          del fds[pipe]
+    return self._proc.wait()
+
+  def _Run(self, func, *args):
+    """Runs the command, then closes our pipes."""
+    returncode = 1
+    try:
+      returncode = func(self, *args)
+    except Exception, e:  # pylint: disable=broad-except
+      if self._is_killed:
+        returncode = -signal.SIGKILL
+      else:
+        try:
+          self._Write(self._err_fd, 'adb: error: %s\n' % e)
+        except EnvironmentError:
+          pass  # E.g. our pipe was closed
+    finally:
+      self._Close()
+      self.returncode = returncode
+      os.close(self._out_fd)
+      os.close(self._err_fd)
+
+  @staticmethod
+  def _Write(fd, data):
+    while data:
+      data = data[os.write(fd, data):]
+
+
+class AdbHostProcess(ThreadedProcess):
+  """An adb command that runs in-process, via the adb server's host protocol.
+
+  The output matches the adb binary's, apart from "push" and "pull" progress
+  messages.  Create returns None for the commands that we don't support, e.g.
+  "adb logcat".  If the adb server isn't running, or the device lacks the
+  shell protocol's exit codes, our thread runs the adb binary instead.  We
+  don't ask the adb server anything in Create, since an EventLoopHTTPServer
+  calls it from its event loop.
+  """
+
+  SYNC_DATA_SIZE = 64 * 1024  # The sync protocol's maximum DATA length
+  INSTALL_DIR = '/data/local/tmp'  # As in "adb install"
+  FEATURES_TTL = 60  # Seconds that we cache a device's features
+
+  # Shell protocol packet ids
+  SHELL_STDOUT = 1
+  SHELL_STDERR = 2
+  SHELL_EXIT = 3
+  SHELL_CLOSE_STDIN = 4
+
+  _features = {}  # (port, serial) -> (expiry time, features list)
+  _features_lock = threading.Lock()
+
+  def __init__(self, port, serial, func, *args):
+    """Starts a command.
+
+    Args:
+      port: int adb server port
+      serial: string device serial, or 'any'
+      func: method that runs the command and returns its exit code
+      *args: func args
+    """
+    self._port = port
+    self._serial = serial
+    self._conn = None  # The AdbHostConnection in use
+    super(AdbHostProcess, self).__init__(func, *args)
+
+  @classmethod
+  def Create(cls, args, port):
+    """Starts an adb command, if we support it.
+
+    Args:
+      args: List of validated command args, e.g. ['adb', '-s', 'X', 'shell',
+          'ls']
+      port: int adb server port
+    Returns:
+      AdbHostProcess, or None if the caller must run the command itself.
+    """
+    if os.path.basename(args[0]) != 'adb':
+      return None
+    serial = 'any'
+    command_args = args[1:]
+    if command_args[:1] == ['-s']:
+      serial = command_args[1]
+      command_args = command_args[2:]
+    if command_args == ['devices']:
+      return cls(port, None, cls._Devices, args)
+    if command_args[0] not in ('shell', 'push', 'pull', 'install'):
+      return None
+    return cls(port, serial, cls._RunDeviceCommand, args)
+
+  def _RunDeviceCommand(self, args):
+    """Runs a device command, or the adb binary if we can't.
+
+    Args:
+      args: List of validated command args, as in Create
+    Returns:
+      The int exit code.
+    """
+    command_args = args[1:]
+    if command_args[:1] == ['-s']:
+      command_args = command_args[2:]
+    command, command_args = command_args[0], command_args[1:]
+    try:
+      features = self._GetFeatures(self._port, self._serial)
+    except (EnvironmentError, AdbHostError):
+      # E.g. no such device, which the adb binary will report
+      return self._RunProcess(args)
+    if command == 'push':
+      return self._Push(command_args[0], command_args[1])
+    if command == 'pull':
+      return self._Pull(command_args[0], command_args[1])
+    if 'shell_v2' not in features:
+      return self._RunProcess(args)
+    if command == 'shell':
+      return self._Shell(' '.join(command_args))
+    return self._Install(command_args[:-1], command_args[-1])
+
+  def _Close(self):
+    conn = self._conn
+    if conn:
+      conn.close()
+
+  @classmethod
+  def _GetFeatures(cls, port, serial):
+    """Returns a device's features, e.g. ['shell_v2', 'cmd']."""
+    key = (port, serial)
+    with cls._features_lock:
+      entry = cls._features.get(key)
+    if entry and entry[0] > time.time():
+      return entry[1]
+    conn = AdbHostConnection(port)
+    try:
+      conn.Request('host:features' if serial == 'any' else
+                   'host-serial:%s:features' % serial)
+      features = conn.ReadString().split(',')
+    finally:
+      conn.close()
+    with cls._features_lock:
+      cls._features[key] = (time.time() + cls.FEATURES_TTL, features)
+    return features
+
+  def _Connect(self, serial=None):
+    if self._is_killed:
+      raise AdbHostError('Killed')
+    if self._conn:
+      self._conn.close()
+    self._conn = AdbHostConnection(self._port, serial)
+    return self._conn
+
+  def _Devices(self, args):
+    try:
+      conn = self._Connect()
+    except EnvironmentError:
+      # The adb binary will start the adb server.
+      return self._RunProcess(args)
+    conn.Request('host:devices')
+    self._Write(self._out_fd, 'List of devices attached\n%s\n' %
+                conn.ReadString())
+    return 0
+
+  def _Shell(self, command, out_fn=None, err_fn=None):
+    """Runs a shell command via the shell protocol.
+
+    Args:
+      command: string shell command
+      out_fn: optional function(data), to capture stdout instead of writing it
+      err_fn: optional function(data), likewise for stderr
+    Returns:
+      The int exit code.
+    """
+    conn = self._Connect(self._serial)
+    conn.Request('shell,v2:%s' % command)
+    conn.Send(struct.pack('<BI', self.SHELL_CLOSE_STDIN, 0))
+    while True:
+      packet_id, length = struct.unpack('<BI', conn.Read(5))
+      data = conn.Read(length)
+      if packet_id == self.SHELL_STDOUT:
+        if out_fn:
+          out_fn(data)
+        else:
+          self._Write(self._out_fd, data)
+      elif packet_id == self.SHELL_STDERR:
+        if err_fn:
+          err_fn(data)
+        else:
+          self._Write(self._err_fd, data)
+      elif packet_id == self.SHELL_EXIT:
+        return ord(data[0])
+
+  def _Push(self, local, remote):
+    """Pushes a file or directory via the sync protocol."""
+    start_time = time.time()
+    conn = self._Connect(self._serial)
+    conn.Request('sync:')
+    if stat.S_ISDIR(self._SyncStat(remote)[0]):
+      remote = '%s/%s' % (remote.rstrip('/'), os.path.basename(local))
+    num_files = 0
+    num_bytes = 0
+    if os.path.isdir(local):
+      for dn, _, fns in os.walk(local):
+        for fn in sorted(fns):
+          local_fn = os.path.join(dn, fn)
+          num_bytes += self._SyncSend(
+              local_fn, remote + '/' + os.path.relpath(local_fn, local))
+          num_files += 1
+    else:
+      num_bytes += self._SyncSend(local, remote)
+      num_files += 1
+    self._SyncQuit()
+    self._Write(self._out_fd, '%s: %d file%s pushed. (%d bytes in %.3fs)\n' % (
+        local, num_files, '' if num_files == 1 else 's', num_bytes,
+        time.time() - start_time))
+    return 0
+
+  def _Pull(self, remote, local):
+    """Pulls a file or directory via the sync protocol."""
+    start_time = time.time()
+    conn = self._Connect(self._serial)
+    conn.Request('sync:')
+    mode = self._SyncStat(remote)[0]
+    if not mode:
+      raise AdbHostError("failed to stat remote object '%s': "
+                         'No such file or directory' % remote)
+    num_files = 0
+    num_bytes = 0
+    # (remote, local) paths, of which we LIST directories and RECV files
+    pending = [(remote, local, mode)]
+    while pending:
+      remote_fn, local_fn, mode = pending.pop()
+      if stat.S_ISDIR(mode):
+        os.mkdir(local_fn)
+        for name, mode in self._SyncList(remote_fn):
+          if name not in ('.', '..'):
+            pending.append(('%s/%s' % (remote_fn.rstrip('/'), name),
+                            os.path.join(local_fn, name), mode))
+      elif stat.S_ISREG(mode):
+        num_bytes += self._SyncRecv(remote_fn, local_fn)
+        num_files += 1
+    self._SyncQuit()
+    self._Write(self._out_fd, '%s: %d file%s pulled. (%d bytes in %.3fs)\n' % (
+        remote, num_files, '' if num_files == 1 else 's', num_bytes,
+        time.time() - start_time))
+    return 0
+
+  def _Install(self, options, local):
+    """Installs an app, as "adb install" does: push it, then "pm install"."""
+    remote = '%s/%s' % (self.INSTALL_DIR, os.path.basename(local))
+    conn = self._Connect(self._serial)
+    conn.Request('sync:')
+    self._SyncSend(local, remote)
+    self._SyncQuit()
+    out = []
+
+    def Capture(data):
+      out.append(data)
+      self._Write(self._out_fd, data)
+
+    try:
+      self._Shell(' '.join(['pm', 'install'] + options +
+                           [ShellQuote(remote)]), Capture)
+    finally:
+      if not self._is_killed:
+        self._Shell('rm -f %s' % ShellQuote(remote), lambda data: None,
+                    lambda data: None)
+    # Like the adb binary, we check pm's output rather than its exit code.
+    return (0 if 'Success' in ''.join(out) else 1)
+
+  def _SyncRequest(self, request_id, data=''):
+    self._conn.Send(struct.pack('<4sI', request_id, len(data)) + data)
+
+  def _SyncReadHeader(self):
+    """Reads a sync response's id and length, and raises any failure."""
+    response_id, length = struct.unpack('<4sI', self._conn.Read(8))
+    if response_id == 'FAIL':
+      raise AdbHostError(self._conn.Read(length))
+    return response_id, length
+
+  def _SyncStat(self, remote):
+    """Returns a remote path's (mode, size, mtime), with mode 0 if missing."""
+    self._SyncRequest('STAT', remote)
+    response_id, mode, size, mtime = struct.unpack(
+        '<4sIII', self._conn.Read(16))
+    if response_id != 'STAT':
+      raise AdbHostError('Unexpected sync response: %r' % response_id)
+    return mode, size, mtime
+
+  def _SyncList(self, remote):
+    """Returns a remote directory's (name, mode) entries."""
+    self._SyncRequest('LIST', remote)
+    entries = []
+    while True:
+      response_id, mode, _, _, length = struct.unpack(
+          '<4sIIII', self._conn.Read(20))
+      if response_id == 'DONE':
+        return entries
+      if response_id != 'DENT':
+        raise AdbHostError('Unexpected sync response: %r' % response_id)
+      entries.append((self._conn.Read(length), mode))
+
+  def _SyncSend(self, local, remote):
+    """Sends a file, and returns its int size."""
+    st = os.stat(local)
+    self._SyncRequest('SEND', '%s,%d' % (remote, stat.S_IMODE(st.st_mode)))
+    num_bytes = 0
+    with open(local, 'rb') as fp:
+      while True:
+        data = fp.read(self.SYNC_DATA_SIZE)
+        if not data:
+          break
+        self._SyncRequest('DATA', data)
+        num_bytes += len(data)
+    self._conn.Send(struct.pack('<4sI', 'DONE', int(st.st_mtime)))
+    self._SyncReadHeader()  # OKAY
+    return num_bytes
+
+  def _SyncRecv(self, remote, local):
+    """Receives a file, and returns its int size."""
+    self._SyncRequest('RECV', remote)
+    num_bytes = 0
+    with open(local, 'wb') as fp:
+      while True:
+        response_id, length = self._SyncReadHeader()
+        if response_id == 'DONE':
+          return num_bytes
+        if response_id != 'DATA':
+          raise AdbHostError('Unexpected sync response: %r' % response_id)
+        fp.write(self._conn.Read(length))
+        num_bytes += length
+
+  def _SyncQuit(self):
+    self._SyncRequest('QUIT')
+
+
+class ShellSession(object):
+  """A long-lived "adb -s SERIAL shell", which runs one command at a time.
+
+  The device-side shell reads our commands from its stdin.  We wrap each
+  command so that it runs in a subshell, with its stdin from /dev/null, then
+  prints a random marker to stderr and the marker and exit code to stdout.
+  The output before the markers is the command's own.
+
+  A background job could keep writing after its command's markers, into a
+  later command's output, so we don't run commands that contain an "&".
+  """
+
+  def __init__(self, serial):
+    self.serial = serial
+    self.last_used = time.time()
+    self._proc = None  # Our "adb shell" subprocess.Popen, once opened
+
+  def Open(self, adb):
+    """Starts the shell, and verifies that its stderr is kept separate.
+
+    Args:
+      adb: string path of the adb binary
+    Raises:
+      AdbHostError: if the shell doesn't work as we expect, e.g. an old
+          device's shell, which merges stderr into stdout.
+      EnvironmentError: e.g. if adb isn't installed.
+    """
+    self._proc = subprocess.Popen(
+        [adb, '-s', self.serial, 'shell'], bufsize=0, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    if self.Run(':', lambda data: None, lambda data: None) != 0:
+      raise AdbHostError('Shell session failed')
+
+  def IsOpen(self):
+    return bool(self._proc) and self._proc.poll() is None
+
+  def IsIdle(self):
+    """Returns True if open, with no stray output since its last command."""
+    if not self.IsOpen():
+      return False
+    rlist, _, _ = select.select([self._proc.stdout, self._proc.stderr], [], [],
+                                0)
+    return not rlist
+
+  def Run(self, command, out_fn, err_fn):
+    """Runs a shell command.
+
+    Args:
+      command: string shell command
+      out_fn: function(data), called with the command's stdout
+      err_fn: function(data), likewise for stderr
+    Returns:
+      The int exit code.
+    Raises:
+      AdbHostError: if the session exits or misbehaves.
+    """
+    marker = 'LDP%s' % os.urandom(16).encode('hex')
+    self._proc.stdin.write(
+        "(eval %s) </dev/null; __ldp=$?; printf '%%s\\n' %s >&2; "
+        "printf '%%s:%%d\\n' %s $__ldp\n" % (
+            ShellQuote(command), marker, marker))
+    output_fns = {self._proc.stdout: out_fn, self._proc.stderr: err_fn}
+    pending = {self._proc.stdout: '', self._proc.stderr: ''}
+    ends = {}  # pipe -> text after its marker, e.g. ':0' for stdout
+    while len(ends) < 2:
+      rlist, _, _ = select.select(
+          [pipe for pipe in pending if pipe not in ends], [], [])
+      for pipe in rlist:
+        data = os.read(pipe.fileno(), MAX_READ)
+        if not data:
+          raise AdbHostError('Shell session closed')
+        data = pending[pipe] + data
+        index = data.find(marker)
+        if index < 0:
+          # Hold back a tail that may be the start of our marker.
+          index = max(0, len(data) - len(marker) + 1)
+        if index:
+          output_fns[pipe](data[:index])
+        pending[pipe] = data[index:]
+        if pending[pipe].startswith(marker) and '\n' in pending[pipe]:
+          ends[pipe] = pending[pipe][len(marker):].split('\n', 1)[0]
+    if not ends[self._proc.stdout].startswith(':'):
+      raise AdbHostError('Shell session merges stderr into stdout')
+    self.last_used = time.time()
+    return int(ends[self._proc.stdout][1:])
+
+  def Close(self):
+    """Kills the shell, which may be in use by another thread."""
+    KillProcess(self._proc)
+
+
+class ShellSessionPool(object):
+  """Each device's warm ShellSessions, for --shell_sessions.
+
+  A device has at most max_per_device sessions, open or opening.  We reuse
+  the most recently used idle session, so that the extras age out after
+  timeout idle seconds.
+  """
+
+  UNSUPPORTED_TTL = 60  # Seconds that we don't retry a failed device
+
+  def __init__(self, max_per_device, timeout=SHELL_SESSION_TIMEOUT):
+    self._max_per_device = max_per_device
+    self._timeout = timeout
+    self._lock = threading.Lock()
+    self._idle = collections.defaultdict(list)  # serial -> ShellSessions
+    self._counts = collections.defaultdict(int)  # serial -> num sessions
+    self._unsupported = {}  # serial -> retry time
+    self._stop_event = threading.Event()
+    self._thread = None
+
+  def Start(self):
+    """Starts evicting idle sessions in the background."""
+    self._thread = threading.Thread(target=self._EvictIdleSessions)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def Stop(self):
+    """Stops evicting, and closes the idle sessions."""
+    self._stop_event.set()
+    if self._thread:
+      self._thread.join()
+    self._Evict(0)
+
+  def Acquire(self, serial):
+    """Takes an idle session, or reserves one for the caller to open.
+
+    Args:
+      serial: string device serial
+    Returns:
+      ShellSession, which is unopened if new, or None if the device has no
+      free session.
+    """
+    with self._lock:
+      if self._unsupported.get(serial, 0) > time.time():
+        return None
+      idle = self._idle[serial]
+      while idle:
+        session = idle.pop()
+        if session.IsIdle():
+          return session
+        session.Close()
+        self._counts[serial] -= 1
+      if self._counts[serial] >= self._max_per_device:
+        return None
+      self._counts[serial] += 1
+      return ShellSession(serial)
+
+  def Release(self, session):
+    """Returns a session, which has finished its command, to the pool."""
+    with self._lock:
+      self._idle[session.serial].append(session)
+
+  def Discard(self, session, is_unsupported=False):
+    """Closes a session, e.g. after its command was killed.
+
+    Args:
+      session: ShellSession, from Acquire
+      is_unsupported: bool, if the session couldn't be opened, in which case
+          we start a process per command for a while
+    """
+    session.Close()
+    with self._lock:
+      self._counts[session.serial] -= 1
+      if is_unsupported:
+        self._unsupported[session.serial] = (
+            time.time() + self.UNSUPPORTED_TTL)
+
+  def _EvictIdleSessions(self):
+    while not self._stop_event.wait(self._timeout / 2.0):
+      self._Evict(self._timeout)
+
+  def _Evict(self, timeout):
+    """Closes the sessions that have been idle for timeout seconds."""
+    evicted = []
+    min_time = time.time() - timeout
+    with self._lock:
+      for serial, idle in self._idle.items():
+        expired = [session for session in idle
+                   if session.last_used <= min_time]
+        idle[:] = [session for session in idle
+                   if session.last_used > min_time]
+        self._counts[serial] -= len(expired)
+        evicted += expired
+    for session in evicted:
+      session.Close()
+
+
+class ShellSessionProcess(ThreadedProcess):
+  """An "adb -s SERIAL shell CMD" that runs in a pooled ShellSession.
+
+  If the session can't be opened, e.g. the device is offline, we instead
+  run the command as is, so the output and exit code are the adb binary's.
+  """
+
+  def __init__(self, pool, session, func, *args):
+    """Starts a command.
+
+    Args:
+      pool: ShellSessionPool
+      session: ShellSession, from the pool's Acquire
+      func: method that runs the command and returns its exit code
+      *args: func args
+    """
+    self._pool = pool
+    # Our session, until we hand it back to the pool, guarded by our lock
+    self._session = session
+    self._session_lock = threading.Lock()
+    super(ShellSessionProcess, self).__init__(func, *args)
+
+  @classmethod
+  def Create(cls, args, pool):
+    """Starts an adb shell command, if the device has a free session.
+
+    Args:
+      args: List of validated command args, e.g. ['adb', '-s', 'X', 'shell',
+          'ls']
+      pool: ShellSessionPool
+    Returns:
+      ShellSessionProcess, or None if the caller must run the command itself.
+    """
+    if (os.path.basename(args[0]) != 'adb' or args[1:2] != ['-s'] or
+        args[3:4] != ['shell'] or len(args) < 5 or args[4].startswith('-')):
+      return None  # E.g. an interactive "adb shell"
+    if any('&' in arg for arg in args[4:]):
+      return None  # May start a background job, see ShellSession
+    session = pool.Acquire(args[2])
+    return cls(pool, session, cls._RunInSession, args) if session else None
+
+  def _Close(self):
+    if self._is_killed:
+      with self._session_lock:
+        # Not once it's back in the pool, where another command may have it.
+        if self._session:
+          self._session.Close()
+
+  def _RunInSession(self, args):
+    """Runs the command in our session, which we then release or discard."""
+    session = self._session
+    if not session.IsOpen():
+      try:
+        session.Open(args[0])
+      except (EnvironmentError, AdbHostError), e:
+        LogMessage('-', 'Shell session on %s failed: %s', session.serial, e)
+        self._DisownSession()
+        self._pool.Discard(session, is_unsupported=True)
+        return self._RunProcess(args)
+    try:
+      if self._is_killed:
+        raise AdbHostError('Killed')
+      returncode = session.Run(
+          ' '.join(args[4:]), functools.partial(self._Write, self._out_fd),
+          functools.partial(self._Write, self._err_fd))
+    except:
+      self._DisownSession()
+      self._pool.Discard(session)
+      raise
+    self._DisownSession()
+    self._pool.Release(session)
+    return returncode
+
+  def _DisownSession(self):
+    """Stops our _Close from closing our session, e.g. once it's pooled."""
+    with self._session_lock:
+      self._session = None
 
 
 class TempFileSystem(object):
@@ -38,16 +38,28 @@ stubs and wouldn't test the end-to-end system.
 """
 
 
+import cStringIO as StringIO
 import functools
+import hashlib
 import httplib
+import json
 import os
 import shutil
+import socket
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import unittest
 
+# pylint: disable=g-import-not-at-top
+try:
+  from lab_device_proxy import lab_device_proxy_client as lab_common
+except ImportError:
+  import lab_device_proxy_client as lab_common
+
 
 _IS_CLIENT = not (
     __name__ == '__main__' and len(sys.argv) >= 3 and sys.argv[1] == '--mock')
@@ -71,15 +83,21 @@ def main():
     #    '--mock', 'LabDeviceProxyTest.testStdout', 'adb', 'devices']
     test_name = sys.argv[2]
     sys.argv = sys.argv[3:]
-    cls = LabDeviceProxyTest
-    assert test_name.startswith('%s.test' % cls.__name__), test_name
+    cls = globals().get(test_name.split('.', 1)[0])
+    assert (isinstance(cls, type) and
+            issubclass(cls, LabDeviceProxyTestCase) and
+            test_name.startswith('%s.test' % cls.__name__)), test_name
     test_name = test_name[test_name.rfind('.') + 1:]
     test_method = getattr(cls(method_name=test_name), test_name)
     test_method()
 
 
-class LabDeviceProxyTest(unittest.TestCase):
-  """Lab Device Proxy Unit tests."""
+class LabDeviceProxyTestCase(unittest.TestCase):
+  """A test case with a mock proxy server, shared by our test classes.
+
+  Each subclass starts its own server, on its _server_port with its
+  _server_args, for its test methods.
+  """
 
   def __init__(self, method_name=None):
     """Creates a client or mocked-server command.
@@ -90,142 +108,27 @@ class LabDeviceProxyTest(unittest.TestCase):
     """
     assert method_name
     self._test_name = method_name
-    super(LabDeviceProxyTest, self).__init__(method_name)
-
-  def testStdout(self):
-    """Verifies that server stdout is passed back to the client."""
-    if _IS_CLIENT:
-      # Create a mock './adb' script and invoke it via the proxy client.
-      out = self._ProxyCheckOutput(['adb', 'devices'])
-      self.assertEqual(out, '*mock*List of devices.\n\n')
-    else:
-      # This runs in a child process of the proxy server, NOT in the unittest
-      # or proxy client process!
-      self.assertEqual(sys.argv, ['adb', 'devices'])
-      print '*mock*List of devices.\n'
-
-  def testExitCode(self):
-    """Verifies that the server's exit code is returned to the client."""
-    if _IS_CLIENT:
-      returncode = self._ProxyCall(['adb', 'uninstall', 'no_such_pkg'])
-      self.assertEqual(returncode, 2, 'exit code')
-    else:
-      self.assertEqual(sys.argv, ['adb', 'uninstall', 'no_such_pkg'])
-      sys.exit(2)
-
-  # testStderr:
-  #   client: popen, assert got stderr
-  #   server: print to stderr
-
-  # testMixedOutput:
-  #   client: popen, assert got interleaved stdout,stderr,stdout
-  #   server: print stdout,stderr,stdout
-
-  # testChunked:
-  #   client: popen, assert got stdout, waited 1s, got more stdout
-  #   server: print, sleep 1, print
-
-  def testPushFile(self):
-    """Verifies that the client can push a file to the server."""
-    if _IS_CLIENT:
-      from_file = os.path.join(self._client_temp, 'from_file')
-      with open(from_file, 'w') as f:
-        f.write('push_me')
-      out = self._ProxyCheckOutput(['adb', 'push', from_file, 'to_dev'])
-      self.assertEqual(out, 'ok\n')
-    else:
-      if len(sys.argv) > 2:
-        from_file, sys.argv[2] = sys.argv[2], 'FILE'
-      self.assertEqual(sys.argv, ['adb', 'push', 'FILE', 'to_dev'])
-      self.assertTrue(os.path.exists(from_file), 'missing %s' % from_file)
-      with open(from_file, 'r') as f:
-        self.assertEqual(f.read(), 'push_me', '%s content' % from_file)
-      print 'ok'
-
-  # testPushDir:
-  #   client: mkdir w/ subfiles, check_output
-  #   server: assert got dir w/ subfiles
-
-  # testPushNone:
-  #   client: check_output(adb push 'fake_filename' x)
-  #   server: assert !exists(arg[2])
-
-  def testPullFileToNewFile(self):
-    """Verifies that the server can return a file to the client."""
-    if _IS_CLIENT:
-      to_file = os.path.join(self._client_temp, 'to_file')
-      out = self._ProxyCheckOutput(['adb', 'pull', 'from_dev', to_file])
-      self.assertEqual(out, 'ok\n')
-      with open(to_file, 'r') as f:
-        self.assertEqual(f.read(), 'pull_me', '%s content' % to_file)
-    else:
-      if len(sys.argv) > 3:
-        to_file, sys.argv[3] = sys.argv[3], 'FILE'
-      self.assertEqual(sys.argv, ['adb', 'pull', 'from_dev', 'FILE'])
-      with open(to_file, 'w') as f:
-        f.write('pull_me')
-      print 'ok'
-
-  # testPullFileToExistingFile:
-  #   client: write X to file F, cmd, assert F contains Y
-  #   server: write Y to file arg[2]
-
-  # testPullFileToEmptyDir:
-  #   client: mkdir D, cmd, assert D/F contains Y
-  #   server: write F to arg[2]
-
-  # testPullFileToExistingDir:
-  #   client: mkdir D, write X to F, cmd, assert D/F contains Y
-  #   server: write Y to arg[2]
-
-  # testPullFileToNone:
-  #   client: cmd(foo/bar/qux), assert error 'no such file or directory'
-  #   server: write Y to arg[2]
-
-  # testPullDirToFile:
-  #   client: write X to F, cmd, assert error 'is a directory: (not copied)'
-  #   server: mkdir arg[2], write Z to arg[2]/foo
-
-  # testPullDirToDir:
-  #   client: mkdir D, cmd, assert D/bar/foo contains Z
-  #   server: mkdir arg[2]/bar, write Z to arg[2]/foo
-
-  # testPullDirToNone:
-  #   client: cmd(foo/bar/qux), assert error 'no such file or directory'
-  #   server: mkdir arg[2]/bar, write Z to arg[2]/foo
-
-  # testPullNone:
-  #   client: cmd(F), assert !exists(F)
-  #   server: no-op
-
-  # testClientParse:
-  #   client: popen(adb blah), assert errcode
-  #   server: no-op
-
-  # testServerParse:
-  #   client: open url, write bogus http args, assert got http 405
-  #   server: no-op
-
-  # testClientRecv:
-  #   client: bind 9999 w/ bad-chunk server, cmd, assert error
-  #   server: no-op
+    super(LabDeviceProxyTestCase, self).__init__(method_name)
 
   #
   # All the following methods only run on the client side.
   #
 
+  _server_port = 9094  # Server port
+  _server_args = []    # Extra server args
   _server_url = None   # Server URL
   _server_proc = None  # Server process
   _python_path = None  # Python binary path
 
   _client_temp = None  # Client temporary dir
   _server_temp = None  # Server temporary dir
+  _cache_temp = None   # Server upload cache dir
 
   @classmethod
   @ClientOnly
   def setUpClass(cls):
     """Creates the mock proxy server."""
-    server_port = 9094
+    server_port = cls._server_port
     cls._server_url = 'http://localhost:%s' % server_port
 
     server_path = os.path.join(
@@ -248,13 +151,16 @@ class LabDeviceProxyTest(unittest.TestCase):
             python_version, cls._python_path, os.environ.get('PATH', '')))
 
     cls._server_temp = tempfile.mkdtemp(prefix='test_server', dir='/tmp')
+    cls._cache_temp = tempfile.mkdtemp(prefix='test_cache', dir='/tmp')
 
     # Start server
     server_env = {'PATH': ':'.join([cls._server_temp, cls._python_path])}
     if 'PYTHONPATH' in os.environ:
       server_env['PYTHONPATH'] = os.environ['PYTHONPATH']
     cls._server_proc = subprocess.Popen(
-        [server_path, '--port=%s' % server_port],
+        [server_path, '--port=%s' % server_port,
+         '--cache_dir=%s' % cls._cache_temp, '--max_per_device=1'] +
+        cls._server_args,
         close_fds=True,
         cwd=cls._server_temp,
         # stderr=open(os.devnull, 'w'),  # hide log_message output
@@ -309,8 +215,14 @@ class LabDeviceProxyTest(unittest.TestCase):
     return output
 
   @ClientOnly
-  def _ProxyPopen(self, args, **kwargs):
-    """Returns the proxied equivalent of subprocess.Popen."""
+  def _ProxyPopen(self, args, client_args=(), **kwargs):
+    """Returns the proxied equivalent of subprocess.Popen.
+
+    Args:
+      args: List of command and arguments, e.g. ['adb', 'devices'].
+      client_args: optional list of client arguments, e.g. ['--timing'].
+      **kwargs: subprocess.Popen arguments.
+    """
     args = args[:]
     kwargs = kwargs.copy()
 
@@ -319,6 +231,20 @@ class LabDeviceProxyTest(unittest.TestCase):
         os.path.dirname(test_path), 'lab_device_proxy_client.py')
     assert os.path.exists(client_path), 'Missing %s' % client_path
 
+    self._WriteMockCommand(args[0])
+
+    # Set proxy_client args
+    args = ([client_path, '--url', self._server_url] + list(client_args) +
+            args)
+    kwargs.setdefault('env', {'PATH': self._python_path})
+    kwargs.setdefault('cwd', self._server_temp)
+    kwargs.setdefault('close_fds', True)
+
+    return subprocess.Popen(args, **kwargs)
+
+  @ClientOnly
+  def _WriteMockCommand(self, cmd):
+    """Writes a mock command that runs our test method on the server side."""
     # Write a script in the server's temp directory whose name matches the
     # name of the specified command, e.g.
     #   /tmp/test_server/adb
@@ -329,7 +255,8 @@ class LabDeviceProxyTest(unittest.TestCase):
     #   adb push foo
     # the server will run our script instead of the real 'adb', and our script
     # will run our test's test_method with !_IS_CLIENT.
-    cmd = os.path.basename(args[0])
+    test_path = os.path.abspath(__file__)
+    cmd = os.path.basename(cmd)
     server_file = os.path.join(self._server_temp, cmd)
     with open(server_file, 'w') as f:
       # We need this shebang line, otherwise the call will hang
@@ -337,14 +264,6 @@ class LabDeviceProxyTest(unittest.TestCase):
           test_path, self.__class__.__name__, self._test_name, cmd))
     os.chmod(server_file, 0755)
 
-    # Set proxy_client args
-    args = ([client_path, '--url', self._server_url] + args)
-    kwargs.setdefault('env', {'PATH': self._python_path})
-    kwargs.setdefault('cwd', self._server_temp)
-    kwargs.setdefault('close_fds', True)
-
-    return subprocess.Popen(args, **kwargs)
-
   @ClientOnly
   def tearDown(self):
     """Cleans up after a test."""
@@ -369,10 +288,925 @@ class LabDeviceProxyTest(unittest.TestCase):
       shutil.rmtree(cls._server_temp)
       cls._server_temp = None
 
+    if cls._cache_temp:
+      shutil.rmtree(cls._cache_temp)
+      cls._cache_temp = None
+
     if cls._client_temp:
       shutil.rmtree(cls._client_temp)
       cls._client_temp = None
 
 
+class LabDeviceProxyTest(LabDeviceProxyTestCase):
+  """Lab Device Proxy Unit tests."""
+
+  def testStdout(self):
+    """Verifies that server stdout is passed back to the client."""
+    if _IS_CLIENT:
+      # Create a mock './adb' script and invoke it via the proxy client.
+      out = self._ProxyCheckOutput(['adb', 'devices'])
+      self.assertEqual(out, '*mock*List of devices.\n\n')
+    else:
+      # This runs in a child process of the proxy server, NOT in the unittest
+      # or proxy client process!
+      self.assertEqual(sys.argv, ['adb', 'devices'])
+      print '*mock*List of devices.\n'
+
+  def testExitCode(self):
+    """Verifies that the server's exit code is returned to the client."""
+    if _IS_CLIENT:
+      returncode = self._ProxyCall(['adb', 'uninstall', 'no_such_pkg'])
+      self.assertEqual(returncode, 2, 'exit code')
+    else:
+      self.assertEqual(sys.argv, ['adb', 'uninstall', 'no_such_pkg'])
+      sys.exit(2)
+
+  # testStderr:
+  #   client: popen, assert got stderr
+  #   server: print to stderr
+
+  # testMixedOutput:
+  #   client: popen, assert got interleaved stdout,stderr,stdout
+  #   server: print stdout,stderr,stdout
+
+  # testChunked:
+  #   client: popen, assert got stdout, waited 1s, got more stdout
+  #   server: print, sleep 1, print
+
+  def testPushFile(self):
+    """Verifies that the client can push a file to the server."""
+    if _IS_CLIENT:
+      from_file = os.path.join(self._client_temp, 'from_file')
+      with open(from_file, 'w') as f:
+        f.write('push_me')
+      out = self._ProxyCheckOutput(['adb', 'push', from_file, 'to_dev'])
+      self.assertEqual(out, 'ok\n')
+    else:
+      if len(sys.argv) > 2:
+        from_file, sys.argv[2] = sys.argv[2], 'FILE'
+      self.assertEqual(sys.argv, ['adb', 'push', 'FILE', 'to_dev'])
+      self.assertTrue(os.path.exists(from_file), 'missing %s' % from_file)
+      with open(from_file, 'r') as f:
+        self.assertEqual(f.read(), 'push_me', '%s content' % from_file)
+      print 'ok'
+
+  def testPushCachedFile(self):
+    """Verifies that a large pushed file is cached by the server."""
+    content = 'cache_me' * 10000
+    if _IS_CLIENT:
+      from_file = os.path.join(self._client_temp, 'from_file')
+      with open(from_file, 'w') as f:
+        f.write(content)
+      digest = hashlib.sha1(content).hexdigest()
+      cached_file = os.path.join(self._cache_temp, digest)
+      if os.path.exists(cached_file):
+        os.remove(cached_file)
+      # The first push misses and re-sends the file, the second push hits.
+      for _ in range(2):
+        out = self._ProxyCheckOutput(['adb', 'push', from_file, 'to_dev'])
+        self.assertEqual(out, 'ok\n')
+        self.assertTrue(os.path.exists(cached_file), 'missing %s' % digest)
+
+      # Clients only send digests once the server says it has a cache
+      pool = lab_common.ConnectionPool()
+      client = lab_common.LabDeviceProxyClient(
+          self._server_url, StringIO.StringIO(), StringIO.StringIO(),
+          connection_pool=pool)
+      self.assertEqual(client.Call(*lab_common.PARSER.parse_args(
+          ['adb', 'push', from_file, 'to_dev'])), 0)
+      self.assertTrue(pool.HasUploadCache('localhost:%d' % self._server_port))
+    else:
+      if len(sys.argv) > 2:
+        from_file, sys.argv[2] = sys.argv[2], 'FILE'
+      self.assertEqual(sys.argv, ['adb', 'push', 'FILE', 'to_dev'])
+      with open(from_file, 'r') as f:
+        self.assertEqual(f.read(), content, '%s content' % from_file)
+      print 'ok'
+
+  def testBatch(self):
+    """Verifies that a batch of commands returns per-command results."""
+    if _IS_CLIENT:
+      self._WriteMockCommand('adb')
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+      results = client.CallBatch(
+          [lab_common.PARSER.parse_args(['adb', 'shell', 'exit', str(i)])
+           for i in range(4)], parallel=2)
+      self.assertEqual([(r.exit_code, r.stdout) for r in results],
+                       [(i, 'out%d\n' % i) for i in range(4)])
+    else:
+      self.assertEqual(sys.argv[:3], ['adb', 'shell', 'exit'])
+      print 'out%s' % sys.argv[3]
+      sys.exit(int(sys.argv[3]))
+
+  def testTextFraming(self):
+    """Verifies the text chunk framing, for clients that lack binary frames."""
+    if _IS_CLIENT:
+      self._WriteMockCommand('adb')
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+      lab_common.USE_BINARY_FRAMING = False
+      try:
+        results = client.CallBatch(
+            [lab_common.PARSER.parse_args(['adb', 'shell', 'exit', str(i)])
+             for i in range(2)], parallel=2)
+      finally:
+        lab_common.USE_BINARY_FRAMING = True
+      self.assertEqual([(r.exit_code, r.stdout, r.stderr) for r in results],
+                       [(i, 'out%d\n' % i, '') for i in range(2)])
+    else:
+      self.assertEqual(sys.argv[:3], ['adb', 'shell', 'exit'])
+      print 'out%s' % sys.argv[3]
+      sys.exit(int(sys.argv[3]))
+
+  def testFanout(self):
+    """Verifies that a fan-out command runs on every device."""
+    if _IS_CLIENT:
+      self._WriteMockCommand('adb')
+      from_file = os.path.join(self._client_temp, 'app.apk')
+      with open(from_file, 'w') as f:
+        f.write('install_me')
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+      serials = ['serial%d' % i for i in range(3)]
+      results = client.CallFanout(
+          serials, lab_common.PARSER.parse_args(['adb', 'install', from_file]),
+          parallel=2)
+      self.assertEqual([(r.exit_code, r.stdout) for r in results],
+                       [(0, '%s install_me\n' % serial) for serial in serials])
+    else:
+      if len(sys.argv) > 4:
+        from_file, sys.argv[4] = sys.argv[4], 'FILE'
+      self.assertEqual(sys.argv[:2] + sys.argv[3:], ['adb', '-s', 'install',
+                                                     'FILE'])
+      with open(from_file, 'r') as f:
+        print sys.argv[2], f.read()
+
+  def testResultCache(self):
+    """Verifies that read-only commands share their cached results."""
+    if _IS_CLIENT:
+      self._WriteMockCommand('ideviceinfo')
+      self._WriteMockCommand('ideviceinstaller')
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+      udid = '0123456789abcdef0123456789abcdef01234567'
+      info_args = ['ideviceinfo', '-u', udid, '-k', 'ProductVersion']
+
+      def CallInfo(count):
+        results = client.CallBatch(
+            [lab_common.PARSER.parse_args(info_args)] * count,
+            parallel=count)
+        self.assertEqual([r.exit_code for r in results], [0] * count)
+        return [r.stdout for r in results]
+
+      # Concurrent commands share one run, and later commands its result.
+      outputs = CallInfo(3) + CallInfo(1)
+      self.assertEqual(len(set(outputs)), 1, outputs)
+      # Installing an app invalidates the device's results.
+      results = client.CallBatch([lab_common.PARSER.parse_args(
+          ['ideviceinstaller', '-u', udid, '-U', 'foo'])])
+      self.assertEqual(results[0].exit_code, 0)
+      self.assertNotEqual(CallInfo(1), outputs[:1])
+    else:
+      if sys.argv[0] == 'ideviceinfo':
+        time.sleep(0.3)
+        print repr(time.time())
+
+  def testResultCacheConnect(self):
+    """Verifies that "adb connect" drops a cached "adb devices"."""
+    if _IS_CLIENT:
+      self._WriteMockCommand('adb')
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+
+      def Call(args):
+        results = client.CallBatch([lab_common.PARSER.parse_args(args)])
+        self.assertEqual(results[0].exit_code, 0)
+        return results[0].stdout
+
+      devices = Call(['adb', 'devices'])
+      self.assertEqual(Call(['adb', 'devices']), devices)
+      Call(['adb', 'connect', 'localhost:5555'])
+      self.assertNotEqual(Call(['adb', 'devices']), devices)
+      # Don't leave a cached result for others
+      Call(['adb', 'connect', 'localhost:5555'])
+    else:
+      if sys.argv[1:] == ['devices']:
+        print repr(time.time())
+
+  def testDeviceLimit(self):
+    """Verifies that commands for the same device are run one at a time."""
+    if _IS_CLIENT:
+      self._WriteMockCommand('adb')
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+      args = ['adb', '-s', 'serial0', 'wait-for-device']
+      results = client.CallBatch(
+          [lab_common.PARSER.parse_args(args) for _ in range(2)], parallel=2)
+      self.assertEqual([r.exit_code for r in results], [0, 0])
+      intervals = sorted([float(t) for t in r.stdout.split()]
+                         for r in results)
+      self.assertLessEqual(intervals[0][1], intervals[1][0])
+    else:
+      self.assertEqual(sys.argv, ['adb', '-s', 'serial0',
+                                  'wait-for-device'])
+      start_time = time.time()
+      time.sleep(0.2)
+      print start_time, time.time()
+
+  def testHighPriority(self):
+    """Verifies that a high priority command can use a reserved slot."""
+    if _IS_CLIENT:
+      self._WriteMockCommand('adb')
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+      results = client.CallBatch(
+          [lab_common.PARSER.parse_args(args) for args in (
+              ['adb', '-s', 'serial0', 'wait-for-device'],
+              ['adb', '-s', 'serial0', 'shell', 'getprop'])], parallel=2)
+      self.assertEqual([r.exit_code for r in results], [0, 0])
+      intervals = [[float(t) for t in r.stdout.split()] for r in results]
+      # Unlike testDeviceLimit, the commands ran at the same time.
+      self.assertLess(intervals[1][0], intervals[0][1])
+      self.assertLess(intervals[0][0], intervals[1][1])
+    else:
+      self.assertEqual(sys.argv[:3], ['adb', '-s', 'serial0'])
+      start_time = time.time()
+      time.sleep(0.5)
+      print start_time, time.time()
+
+  def testPushDir(self):
+    """Verifies that the client can push a directory to the server."""
+    # Larger than the UntarPipe, so the pipe fills and wraps around.
+    content = ''.join(chr(i % 251) for i in range(6 << 20))
+    if _IS_CLIENT:
+      from_dir = os.path.join(self._client_temp, 'from_dir')
+      os.makedirs(os.path.join(from_dir, 'sub'))
+      with open(os.path.join(from_dir, 'sub', 'big'), 'wb') as f:
+        f.write(content)
+      with open(os.path.join(from_dir, 'small'), 'w') as f:
+        f.write('push_me')
+      out = self._ProxyCheckOutput(['adb', 'push', from_dir, 'to_dev'])
+      self.assertEqual(out, 'ok\n')
+      shutil.rmtree(from_dir)
+    else:
+      self.assertEqual(sys.argv[3], 'to_dev')
+      from_dir = sys.argv[2]
+      self.assertEqual(os.path.basename(from_dir), 'from_dir')
+      with open(os.path.join(from_dir, 'sub', 'big'), 'rb') as f:
+        self.assertTrue(f.read() == content, 'big content')
+      with open(os.path.join(from_dir, 'small'), 'r') as f:
+        self.assertEqual(f.read(), 'push_me', 'small content')
+      print 'ok'
+
+  # testPushNone:
+  #   client: check_output(adb push 'fake_filename' x)
+  #   server: assert !exists(arg[2])
+
+  def testPullFileToNewFile(self):
+    """Verifies that the server can return a file to the client."""
+    if _IS_CLIENT:
+      to_file = os.path.join(self._client_temp, 'to_file')
+      out = self._ProxyCheckOutput(['adb', 'pull', 'from_dev', to_file])
+      self.assertEqual(out, 'ok\n')
+      with open(to_file, 'r') as f:
+        self.assertEqual(f.read(), 'pull_me', '%s content' % to_file)
+    else:
+      if len(sys.argv) > 3:
+        to_file, sys.argv[3] = sys.argv[3], 'FILE'
+      self.assertEqual(sys.argv, ['adb', 'pull', 'from_dev', 'FILE'])
+      with open(to_file, 'w') as f:
+        f.write('pull_me')
+      print 'ok'
+
+  def testPullLargeFile(self):
+    """Verifies that the server can sendfile a large file to the client."""
+    content = ''.join(chr(i % 251) for i in range(1 << 20))
+    if _IS_CLIENT:
+      to_file = os.path.join(self._client_temp, 'to_file')
+      out = self._ProxyCheckOutput(['adb', 'pull', 'from_dev', to_file])
+      self.assertEqual(out, 'ok\n')
+      with open(to_file, 'rb') as f:
+        self.assertTrue(f.read() == content, '%s content' % to_file)
+    else:
+      with open(sys.argv[3], 'wb') as f:
+        f.write(content)
+      print 'ok'
+
+  def testBatchPull(self):
+    """Verifies that a batch's commands can send large files at once."""
+    content = ''.join(chr(i) for i in range(251)) * 10000
+    if _IS_CLIENT:
+      self._WriteMockCommand('adb')
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+      to_files = [os.path.join(self._client_temp, 'to_file%d' % i)
+                  for i in range(3)]
+      results = client.CallBatch(
+          [lab_common.PARSER.parse_args(['adb', 'pull', 'from_dev', to_file])
+           for to_file in to_files], parallel=2)
+      self.assertEqual([(r.exit_code, r.stdout) for r in results],
+                       [(0, 'ok\n')] * 3)
+      for to_file in to_files:
+        with open(to_file, 'rb') as f:
+          self.assertTrue(f.read() == content, '%s content' % to_file)
+    else:
+      with open(sys.argv[3], 'wb') as f:
+        f.write(content)
+      print 'ok'
+
+  def testPullDirCompression(self):
+    """Verifies that a pulled directory's tar supports every compression."""
+    text = 'compressible text\n' * 100000
+    noise = ''.join(chr((i * 7919 + (i >> 8)) % 256) for i in range(1 << 20))
+    if _IS_CLIENT:
+      for compression in lab_common.COMPRESSIONS:
+        to_dir = os.path.join(self._client_temp, compression)
+        os.mkdir(to_dir)
+        env = {'PATH': self._python_path,
+               'LAB_DEVICE_PROXY_COMPRESSION': compression}
+        out = self._ProxyCheckOutput(['adb', 'pull', 'from_dev', to_dir],
+                                     env=env)
+        self.assertEqual(out, 'ok\n')
+        for name, content in (('text', text), ('noise', noise)):
+          with open(os.path.join(to_dir, 'sub', name), 'rb') as f:
+            self.assertTrue(f.read() == content, '%s %s content' % (
+                compression, name))
+        shutil.rmtree(to_dir)
+    else:
+      os.mkdir(os.path.join(sys.argv[3], 'sub'))
+      for name, content in (('text', text), ('noise', noise)):
+        with open(os.path.join(sys.argv[3], 'sub', name), 'wb') as f:
+          f.write(content)
+      print 'ok'
+
+  def testTiming(self):
+    """Verifies that the server's timing trailer is merged and reported."""
+    if _IS_CLIENT:
+      from_file = os.path.join(self._client_temp, 'from_file')
+      with open(from_file, 'w') as f:
+        f.write('push_me')
+      client = lab_common.LabDeviceProxyClient(
+          self._server_url, StringIO.StringIO(), StringIO.StringIO())
+      self._WriteMockCommand('adb')
+      self.assertEqual(client.Call(*lab_common.PARSER.parse_args(
+          ['adb', 'push', from_file, 'to_dev'])), 0)
+      timing = client.last_timing
+      self.assertRegexpMatches(timing.request_id, '^[0-9a-f]{8}$')
+      self.assertEqual([phase for phase, _ in timing.client_phases],
+                       ['connect', 'send', 'first byte', 'read'])
+      self.assertEqual([phase for phase, _ in timing.server_phases],
+                       ['upload', 'validate', 'queue', 'command', 'download'])
+      self.assertEqual(timing.bytes, {'input': 7, 'output': 0})
+
+      proc = self._ProxyPopen(
+          ['adb', 'push', from_file, 'to_dev'], stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE, env={'PATH': self._python_path,
+                                       'LAB_DEVICE_PROXY_TIMING': '1'})
+      out, err = proc.communicate()
+      self.assertEqual(out, 'ok\n')
+      self.assertRegexpMatches(
+          err, r'^Request [0-9a-f]{8} took .*\n  client: connect .*\n'
+          r'  server: upload .*\n  bytes: input 7, output 0\n$')
+    else:
+      print 'ok'
+
+  def testMetrics(self):
+    """Verifies that /metrics reports request phases, file sizes and errors."""
+    if _IS_CLIENT:
+
+      def GetMetrics(path='/metrics'):
+        conn = httplib.HTTPConnection('localhost', self._server_port,
+                                      timeout=5)
+        conn.request('GET', path)
+        res = conn.getresponse()
+        if res.status != httplib.OK:
+          return res.status
+        return dict(line.rsplit(' ', 1) for line in res.read().splitlines()
+                    if not line.startswith('#'))
+
+      before = GetMetrics()
+      from_file = os.path.join(self._client_temp, 'from_file')
+      with open(from_file, 'w') as f:
+        f.write('push_me')
+      self._ProxyCheckCall(['adb', 'push', from_file, 'to_dev'])
+      self.assertEqual(GetMetrics('/no_such_page'), httplib.METHOD_NOT_ALLOWED)
+      after = GetMetrics()
+      for key, delta in (
+          ('lab_device_proxy_request_phase_seconds_count'
+           '{command="adb push",phase="command"}', 1),
+          ('lab_device_proxy_request_phase_seconds_bucket'
+           '{command="adb push",phase="upload",le="+Inf"}', 1),
+          ('lab_device_proxy_input_file_bytes_total{command="adb push"}', 7),
+          ('lab_device_proxy_errors_total{code="405"}', 1)):
+        self.assertEqual(
+            float(after[key]) - float(before.get(key, 0)), delta, key)
+      self.assertEqual(after['lab_device_proxy_active_requests'], '0')
+      self.assertEqual(after['lab_device_proxy_child_processes'], '0')
+    else:
+      print 'ok'
+
+  def testSession(self):
+    """Verifies the session's run, async, push, pull and stream methods."""
+    if _IS_CLIENT:
+      from_file = os.path.join(self._client_temp, 'from_file')
+      with open(from_file, 'w') as f:
+        f.write('push_me')
+      to_file = os.path.join(self._client_temp, 'to_file')
+      self._WriteMockCommand('adb')
+      session = lab_common.LabDeviceProxySession(self._server_url,
+                                                 max_parallel=4)
+      result = session.Run(['adb', 'shell', 'echo'])
+      self.assertEqual((result.exit_code, result.stdout), (0, 'ok\n'))
+      self.assertEqual(result.timing.bytes, {'input': 0, 'output': 0})
+      result = session.Run(['adb', 'shell', 'echo'], max_output_bytes=1)
+      self.assertEqual((result.stdout, result.stdout_size), ('o', 3))
+
+      calls = [session.RunAsync(['adb', '-s', 'serial%d' % i, 'shell', 'echo'])
+               for i in range(8)]
+      self.assertEqual([call.Wait().stdout for call in calls], ['ok\n'] * 8)
+      self.assertTrue(all(call.IsDone() for call in calls))
+      # Wait raises the command's error
+      self.assertRaises(socket.error, lab_common.LabDeviceProxySession(
+          'http://localhost:1').RunAsync(['adb', 'devices']).Wait)
+
+      self.assertEqual(session.Push(from_file, 'to_dev').stdout,
+                       'pushed 7\n')
+      self.assertEqual(session.Pull('from_dev', to_file).exit_code, 0)
+      with open(to_file) as f:
+        self.assertEqual(f.read(), 'pulled')
+
+      chunks = []
+      self.assertEqual(session.Stream(['adb', 'shell', 'echo'],
+                                      chunks.append), 0)
+      self.assertEqual(''.join(chunks), 'ok\n')
+    else:
+      if sys.argv[1] == 'pull':
+        with open(sys.argv[3], 'w') as f:
+          f.write('pulled')
+      elif sys.argv[1] == 'push':
+        with open(sys.argv[2]) as f:
+          print 'pushed %d' % len(f.read())
+      else:
+        print 'ok'
+
+  def testEachDevice(self):
+    """Verifies that commands run on each device, with per-device results."""
+    if _IS_CLIENT:
+      self._WriteMockCommand('adb')
+      session = lab_common.LabDeviceProxySession(self._server_url,
+                                                 max_parallel=2)
+      results = dict(session.RunOnEachDevice(
+          ['adb', 'shell', 'echo'], ['serial0', 'serial1', 'bad']))
+      self.assertEqual(
+          dict((device_id, (result.exit_code, result.stdout, result.stderr))
+               for device_id, result in results.iteritems()),
+          {'serial0': (0, 'ok serial0\n', ''),
+           'serial1': (0, 'ok serial1\n', ''),
+           'bad': (3, '', 'no device\n')})
+      self.assertRaises(ValueError, session.RunOnEachDevice,
+                        ['adb', '-s', 'serial0', 'shell', 'echo'], ['serial1'])
+
+      proc = self._ProxyPopen(
+          ['adb', 'shell', 'echo'], ['--each-device', 'serial0,bad'],
+          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      out, err = proc.communicate()
+      self.assertEqual((out, err, proc.returncode), (
+          'serial0: ok serial0\n', 'bad: no device\nbad: exit code 3\n', 1))
+    else:
+      if sys.argv[2] == 'bad':
+        sys.stderr.write('no device\n')
+        sys.exit(3)
+      print 'ok %s' % sys.argv[2]
+
+  def testAgent(self):
+    """Verifies that shims call a running agent, else run commands directly."""
+    if _IS_CLIENT:
+      socket_fn = os.path.join(self._client_temp, 'agent.sock')
+      agent = lab_common.LabDeviceProxyAgent(socket_fn)
+      agent.Start()
+      thread = threading.Thread(target=agent.Serve)
+      thread.start()
+      with open(os.path.join(self._client_temp, 'from_file'), 'w') as f:
+        f.write('push_me')
+      env = {'PATH': self._python_path, 'LAB_DEVICE_PROXY_AGENT': socket_fn}
+
+      def Call(args):
+        proc = self._ProxyPopen(args, stdout=subprocess.PIPE, env=env,
+                                cwd=self._client_temp)
+        return proc.communicate()[0], proc.returncode
+
+      try:
+        # Relative paths are relative to the shim's cwd
+        self.assertEqual(Call(['adb', 'push', 'from_file', 'to_dev']),
+                         ('pushed 7\n', 0))
+        self.assertEqual(Call(['adb', 'pull', 'from_dev', 'to_file']),
+                         ('', 0))
+        with open(os.path.join(self._client_temp, 'to_file')) as f:
+          self.assertEqual(f.read(), 'pulled')
+        self.assertEqual(agent.num_calls, 2)
+      finally:
+        agent.Stop()
+        thread.join()
+      self.assertFalse(os.path.exists(socket_fn))
+      self.assertEqual(Call(['adb', 'push', 'from_file', 'to_dev']),
+                       ('pushed 7\n', 0))
+      self.assertEqual(agent.num_calls, 2)
+    else:
+      if sys.argv[1] == 'pull':
+        with open(sys.argv[3], 'w') as f:
+          f.write('pulled')
+      else:
+        with open(sys.argv[2]) as f:
+          print 'pushed %d' % len(f.read())
+
+  # testPullFileToExistingFile:
+  #   client: write X to file F, cmd, assert F contains Y
+  #   server: write Y to file arg[2]
+
+  # testPullFileToEmptyDir:
+  #   client: mkdir D, cmd, assert D/F contains Y
+  #   server: write F to arg[2]
+
+  # testPullFileToExistingDir:
+  #   client: mkdir D, write X to F, cmd, assert D/F contains Y
+  #   server: write Y to arg[2]
+
+  # testPullFileToNone:
+  #   client: cmd(foo/bar/qux), assert error 'no such file or directory'
+  #   server: write Y to arg[2]
+
+  # testPullDirToFile:
+  #   client: write X to F, cmd, assert error 'is a directory: (not copied)'
+  #   server: mkdir arg[2], write Z to arg[2]/foo
+
+  # testPullDirToDir:
+  #   client: mkdir D, cmd, assert D/bar/foo contains Z
+  #   server: mkdir arg[2]/bar, write Z to arg[2]/foo
+
+  # testPullDirToNone:
+  #   client: cmd(foo/bar/qux), assert error 'no such file or directory'
+  #   server: mkdir arg[2]/bar, write Z to arg[2]/foo
+
+  # testPullNone:
+  #   client: cmd(F), assert !exists(F)
+  #   server: no-op
+
+  # testClientParse:
+  #   client: popen(adb blah), assert errcode
+  #   server: no-op
+
+  # testServerParse:
+  #   client: open url, write bogus http args, assert got http 405
+  #   server: no-op
+
+  # testClientRecv:
+  #   client: bind 9999 w/ bad-chunk server, cmd, assert error
+  #   server: no-op
+
+
+class LabDeviceProxyEventLoopTest(LabDeviceProxyTest):
+  """Runs the above tests against the event loop server engine."""
+
+  _server_port = 9096
+  _server_args = ['--engine=eventloop']
+
+
+class LabDeviceProxyInventoryTest(LabDeviceProxyTestCase):
+  """Runs testInventory against a server with a device inventory."""
+
+  _server_port = 9098
+  _server_args = ['--device_inventory', '--inventory_interval=0.2']
+
+  def testInventory(self):
+    """Verifies that device lists are answered from the inventory."""
+    udid = '0123456789abcdef0123456789abcdef01234567'
+    if _IS_CLIENT:
+      self._WriteMockCommand('adb')
+      self._WriteMockCommand('idevice_id')
+      timeout_time = time.time() + 10
+      while True:
+        conn = httplib.HTTPConnection('localhost', self._server_port,
+                                      timeout=5)
+        conn.request('GET', '/inventory')
+        res = conn.getresponse()
+        self.assertEqual(res.status, httplib.OK)
+        inventory = json.loads(res.read())
+        if inventory['android'] and inventory['ios']:
+          break
+        self.assertLess(time.time(), timeout_time, inventory)
+        time.sleep(0.1)
+      self.assertEqual(inventory, {
+          'android': [{'serial': 'serial0', 'state': 'device'},
+                      {'serial': 'serial1', 'state': 'offline'}],
+          'ios': [{'udid': udid}]})
+      # Our mock commands would print '*mock*'.
+      self.assertEqual(
+          self._ProxyCheckOutput(['adb', 'devices']),
+          'List of devices attached\nserial0\tdevice\nserial1\toffline\n\n')
+      self.assertEqual(self._ProxyCheckOutput(['idevice_id', '-l']),
+                       udid + '\n')
+    else:
+      if sys.argv == ['adb', 'track-devices']:
+        payload = 'serial0\tdevice\nserial1\toffline\n'
+        sys.stdout.write('%04x%s' % (len(payload), payload))
+        sys.stdout.flush()
+        while os.path.exists('adb'):  # Until our tearDown
+          time.sleep(0.1)
+      elif sys.argv == ['idevice_id', '-l']:
+        print udid
+      else:
+        print '*mock*'
+
+
+class FakeAdbServer(threading.Thread):
+  """A local adb server stand-in, which speaks the adb host protocol.
+
+  It has one device, "serial0", whose shell echoes each command and whose
+  file system is our "files" dict of path -> content.
+  """
+
+  def __init__(self, port):
+    super(FakeAdbServer, self).__init__()
+    self.daemon = True
+    self.files = {}  # path -> string content
+    self.shell_commands = []
+    self._sock = socket.socket()
+    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._sock.bind(('127.0.0.1', port))
+    self._sock.listen(5)
+
+  def run(self):
+    while True:
+      try:
+        conn, _ = self._sock.accept()
+      except socket.error:
+        return  # We've been closed
+      thread = threading.Thread(target=self._Serve, args=(conn,))
+      thread.daemon = True
+      thread.start()
+
+  def close(self):  # pylint: disable=invalid-name
+    self._sock.shutdown(socket.SHUT_RDWR)  # Wakes our accept
+    self._sock.close()
+    self.join()
+
+  def _Serve(self, conn):
+    fp = conn.makefile('rb')
+    try:
+      while True:
+        length = fp.read(4)
+        if not length:
+          return
+        service = fp.read(int(length, 16))
+        if service == 'host:devices':
+          self._Reply(conn, 'OKAY', 'serial0\tdevice\n')
+        elif service in ('host:features', 'host-serial:serial0:features'):
+          self._Reply(conn, 'OKAY', 'shell_v2,cmd')
+        elif service in ('host:transport-any', 'host:transport:serial0'):
+          conn.sendall('OKAY')
+        elif service.startswith('shell,v2:'):
+          conn.sendall('OKAY')
+          self._Shell(conn, fp, service.split(':', 1)[1])
+          return
+        elif service == 'sync:':
+          conn.sendall('OKAY')
+          self._Sync(conn, fp)
+          return
+        else:
+          self._Reply(conn, 'FAIL', 'unknown service')
+          return
+    finally:
+      fp.close()
+      conn.close()
+
+  @staticmethod
+  def _Reply(conn, status, message):
+    conn.sendall('%s%04x%s' % (status, len(message), message))
+
+  def _Shell(self, conn, fp, command):
+    self.shell_commands.append(command)
+    assert fp.read(5) == struct.pack('<BI', 4, 0)  # Close stdin
+    words = command.split()
+    out = ('Success\n' if words[:2] == ['pm', 'install'] else
+           'shell %s\n' % command)
+    returncode = (int(words[1]) if words[0] == 'exit' else 0)
+    for packet_id, data in ((1, out), (2, 'err\n'), (3, chr(returncode))):
+      conn.sendall(struct.pack('<BI', packet_id, len(data)) + data)
+
+  def _Sync(self, conn, fp):
+    while True:
+      request_id, length = struct.unpack('<4sI', fp.read(8))
+      data = fp.read(length)
+      if request_id == 'QUIT':
+        return
+      elif request_id == 'STAT':
+        if data in self.files:
+          mode, size = (0100644, len(self.files[data]))
+        elif any(fn.startswith(data + '/') for fn in self.files):
+          mode, size = (040755, 0)
+        else:
+          mode, size = (0, 0)
+        conn.sendall(struct.pack('<4sIII', 'STAT', mode, size, 0))
+      elif request_id == 'LIST':
+        names = set(fn[len(data) + 1:].split('/')[0] for fn in self.files
+                    if fn.startswith(data + '/'))
+        for name in sorted(names):
+          fn = data + '/' + name
+          mode = (0100644 if fn in self.files else 040755)
+          conn.sendall(struct.pack('<4sIIII', 'DENT', mode, 0, 0, len(name)) +
+                       name)
+        conn.sendall(struct.pack('<4sIIII', 'DONE', 0, 0, 0, 0))
+      elif request_id == 'SEND':
+        path = data.rsplit(',', 1)[0]
+        pieces = []
+        while True:
+          request_id, length = struct.unpack('<4sI', fp.read(8))
+          if request_id == 'DONE':
+            break
+          pieces.append(fp.read(length))
+        self.files[path] = ''.join(pieces)
+        conn.sendall(struct.pack('<4sI', 'OKAY', 0))
+      elif request_id == 'RECV':
+        content = self.files[data]
+        conn.sendall(struct.pack('<4sI', 'DATA', len(content)) + content +
+                     struct.pack('<4sI', 'DONE', 0))
+
+
+class LabDeviceProxyNativeAdbTest(LabDeviceProxyTestCase):
+  """Runs testNativeAdb against a server that runs adb commands in-process."""
+
+  _server_port = 9100
+  _adb_port = 9102
+  _server_args = ['--native_adb', '--adb_port=%d' % _adb_port]
+  _adb_server = None
+
+  @classmethod
+  @ClientOnly
+  def setUpClass(cls):
+    cls._adb_server = FakeAdbServer(cls._adb_port)
+    cls._adb_server.start()
+    super(LabDeviceProxyNativeAdbTest, cls).setUpClass()
+
+  @classmethod
+  @ClientOnly
+  def tearDownClass(cls):
+    super(LabDeviceProxyNativeAdbTest, cls).tearDownClass()
+    cls._adb_server.close()
+
+  def testNativeAdb(self):
+    """Verifies that adb commands are run via the adb server."""
+    if _IS_CLIENT:
+      self._WriteMockCommand('adb')
+      files = self._adb_server.files
+      files['/sdcard/d/a.txt'] = 'a' * 100000
+      files['/sdcard/d/e/b.txt'] = 'b'
+      self.assertEqual(self._ProxyCheckOutput(['adb', 'devices']),
+                       'List of devices attached\nserial0\tdevice\n\n')
+
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+      results = client.CallBatch([lab_common.PARSER.parse_args(
+          ['adb', '-s', 'serial0', 'shell', 'exit', '3'])])
+      self.assertEqual(
+          [(r.exit_code, r.stdout, r.stderr) for r in results],
+          [(3, 'shell exit 3\n', 'err\n')])
+      # The adb server doesn't know this device, so the adb binary runs.
+      results = client.CallBatch([lab_common.PARSER.parse_args(
+          ['adb', '-s', 'serial9', 'shell', 'ls'])])
+      self.assertEqual(
+          [(r.exit_code, r.stdout, r.stderr) for r in results],
+          [(1, '*mock*\n', '')])
+
+      from_file = os.path.join(self._client_temp, 'app.apk')
+      with open(from_file, 'w') as f:
+        f.write('install_me')
+      self._ProxyCheckCall(['adb', 'push', from_file, '/sdcard/d'])
+      self.assertEqual(files['/sdcard/d/app.apk'], 'install_me')
+      self.assertEqual(self._ProxyCheckOutput(['adb', 'install', from_file]),
+                       'Success\n')
+      self.assertEqual(self._adb_server.shell_commands[-2:], [
+          "pm install '/data/local/tmp/app.apk'",
+          "rm -f '/data/local/tmp/app.apk'"])
+
+      to_dir = os.path.join(self._client_temp, 'd')
+      self._ProxyCheckCall(['adb', 'pull', '/sdcard/d', to_dir])
+      for fn in ('a.txt', 'e/b.txt', 'app.apk'):
+        with open(os.path.join(to_dir, fn)) as f:
+          self.assertEqual(f.read(), files['/sdcard/d/' + fn])
+      shutil.rmtree(to_dir)
+    else:
+      print '*mock*'
+      sys.exit(1)
+
+
+class LabDeviceProxyShellSessionTest(LabDeviceProxyTestCase):
+  """Runs testShellSessions against a server with pooled adb shells."""
+
+  _server_port = 9104
+  _server_args = ['--shell_sessions=1']
+
+  def testShellSessions(self):
+    """Verifies that shell commands share a session, with unchanged output."""
+    if _IS_CLIENT:
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+      self._WriteMockCommand('adb')
+      for command, expected in (
+          ('echo hi', (0, 'hi\n', '')),
+          ('echo out; echo err >&2; exit 3', (3, 'out\n', 'err\n')),
+          ('printf "%s" "it\'s"', (0, 'it\'s', '')),
+          # Doesn't read our later commands
+          ('read line; echo "[$line]"', (0, '[]\n', '')),
+          ('cd /; false', (1, '', '')),
+          ('pwd', (0, self._server_temp + '\n', '')),
+          # A background job's output isn't sent with a later command
+          ('(/bin/sleep 0.5; echo late) &', (0, 'late\n', '')),
+          ('echo next', (0, 'next\n', ''))):
+        results = client.CallBatch([lab_common.PARSER.parse_args(
+            ['adb', '-s', 'serial0', 'shell', command])])
+        self.assertEqual(
+            [(r.exit_code, r.stdout, r.stderr) for r in results], [expected])
+      with open(os.path.join(self._server_temp, 'sessions')) as f:
+        self.assertEqual(f.read(), 'serial0\n')
+      self.assertEqual(self._ProxyCheckOutput(['adb', 'shell', 'echo', 'hi']),
+                       '*mock*\n')
+    else:
+      if sys.argv == ['adb', '-s', 'serial0', 'shell']:
+        with open('sessions', 'a') as f:
+          f.write('serial0\n')
+        os.execv('/bin/sh', ['sh'])
+      elif sys.argv[:4] == ['adb', '-s', 'serial0', 'shell']:
+        os.execv('/bin/sh', ['sh', '-c', ' '.join(sys.argv[4:])])
+      print '*mock*'
+
+
+  def testShellSessionKill(self):
+    """Verifies that killing a finished command keeps its pooled session."""
+    if _IS_CLIENT:
+      try:
+        from lab_device_proxy import lab_device_proxy_server as lab_server
+      except ImportError:
+        import lab_device_proxy_server as lab_server
+      # An "adb -s SERIAL shell" that logs each session that it opens
+      adb = os.path.join(self._client_temp, 'adb')
+      sessions_fn = os.path.join(self._client_temp, 'sessions')
+      with open(adb, 'w') as f:
+        f.write('#!/bin/sh\necho "$2" >> %s\nexec /bin/sh\n' % sessions_fn)
+      os.chmod(adb, 0755)
+      pool = lab_server.ShellSessionPool(1)
+      try:
+        for word in ('one', 'two'):
+          proc = lab_server.ShellSessionProcess.Create(
+              [adb, '-s', 'serial0', 'shell', 'echo', word], pool)
+          self.assertEqual(proc.stdout.read(), word + '\n')
+          self.assertEqual(proc.wait(), 0)
+          proc.kill()  # As if its client were lost as it finished
+          proc.stdout.close()
+          proc.stderr.close()
+        with open(sessions_fn) as f:
+          self.assertEqual(f.read(), 'serial0\n')
+      finally:
+        pool.Stop()
+
+
+class LabDeviceProxyRecordTest(LabDeviceProxyTestCase):
+  """Runs testRecord against a server that records its traffic."""
+
+  _server_port = 9106
+  _server_args = ['--record_file=traffic.log']
+
+  def testRecord(self):
+    """Verifies that requests are recorded with file shapes, not content."""
+    if _IS_CLIENT:
+      from_file = os.path.join(self._client_temp, 'from_file')
+      with open(from_file, 'w') as f:
+        f.write('push_me')
+      to_file = os.path.join(self._client_temp, 'to_file')
+      self._ProxyCheckCall(['adb', 'push', from_file, 'to_dev'])
+      self._ProxyCheckCall(['adb', 'pull', 'from_dev', to_file])
+      client = lab_common.LabDeviceProxyClient(self._server_url, None, None)
+      client.CallFanout(['serial0', 'serial1'], lab_common.PARSER.parse_args(
+          ['adb', 'shell', 'ls']), parallel=2)
+
+      # The server records each request after its response
+      log_fn = os.path.join(self._server_temp, 'traffic.log')
+      timeout_time = time.time() + 3
+      while True:
+        with open(log_fn) as f:
+          entries = [json.loads(line) for line in f]
+        if len(entries) >= 3 or time.time() > timeout_time:
+          break
+        time.sleep(0.1)
+      self.assertEqual([entry['commands'] for entry in entries], [
+          [['adb', 'push', {'in': 'from_file', 'size': 7, 'files': 1},
+            'to_dev']],
+          [['adb', 'pull', 'from_dev',
+            {'out': 'to_file', 'size': 6, 'files': 1}]],
+          [['adb', 'shell', 'ls']]])
+      self.assertEqual([entry['status'] for entry in entries], [200] * 3)
+      self.assertEqual(sorted(entries[0]['phases']), [
+          'command', 'download', 'queue', 'upload', 'validate'])
+      self.assertEqual(entries[1]['bytes']['output'], 6)
+      self.assertEqual((entries[2]['devices'], entries[2]['parallel']),
+                       (['serial0', 'serial1'], 2))
+    else:
+      if sys.argv[1] == 'pull':
+        with open(sys.argv[3], 'w') as f:
+          f.write('pulled')
+      else:
+        print 'ok'
+
+
 if __name__ == '__main__':
   main()